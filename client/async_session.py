@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Any, Optional, cast
+
+from typing_extensions import Self
+
+from .session import (
+    QIsabelleServerError,
+    check_result,
+    many_state_names,
+    parse_chain_results,
+    parse_hammer_status,
+    parse_many_result,
+    read_goals,
+)
+from .proof_goals import GoalsCache, proof_state_hash
+from .timing import Timings
+from .transport import JSON, SERVER_TIME_KEY, AsyncHTTPTransport, AsyncTransport, Timeout
+
+
+class AsyncQIsabelleSession:
+    """Asyncio version of QIsabelleSession: the same methods, but awaitable.
+
+    Use as `async with AsyncQIsabelleSession(theory_path=p) as session: ...`,
+    which opens the Isabelle session on entry and closes it on exit
+    (or call `await session.open()` and `await session.close()` yourself).
+    Errors are raised as QIsabelleServerError, same as in QIsabelleSession.
+    """
+
+    def __init__(
+        self,
+        session_name: Optional[str] = None,
+        session_roots: Optional[list[Path]] = None,
+        theory_path: Optional[Path] = None,
+        port: int = 17000,
+        debug: bool = True,
+        transport: Optional[AsyncTransport] = None,
+        goals_mode: str = "full",
+        shared: bool = False,
+    ):
+        """
+        Either theory_path or (session_name and session_roots) must be provided.
+
+        If transport is given, port is ignored and the transport is not closed by the session.
+        For goals_mode and shared, see `QIsabelleSession`.
+        """
+        assert goals_mode in ("full", "diff"), goals_mode
+        if theory_path is not None:
+            assert (
+                session_name is None and session_roots is None
+            ), "Cannot use both theory_path or session_name."
+        else:
+            assert (
+                session_name is not None and session_roots is not None
+            ), "Either theory_path or (session_name and session_roots) must be provided."
+        self.session_name = session_name
+        self.session_roots = session_roots
+        self.theory_path = theory_path
+        self.port = port
+        self.debug = debug
+        self._owns_transport = transport is None
+        self.transport: AsyncTransport = transport or AsyncHTTPTransport(port=port)
+        self.timings = Timings()  # See `QIsabelleSession.timings`.
+        self.goals_mode = goals_mode
+        self.goals = GoalsCache()  # See `QIsabelleSession.goals`.
+        self.shared = shared
+        self.session_id = ""  # Assigned by the server on open.
+
+    async def open(self) -> None:
+        if self.debug:
+            print("AsyncQIsabelleSession initializing..")
+        if self.theory_path is not None:
+            r = await self._post(
+                "/openIsabelleSessionForTheory",
+                {"theoryPath": str(self.theory_path), "shared": self.shared},
+            )
+        else:
+            assert self.session_roots is not None
+            r = await self._post(
+                "/openIsabelleSession",
+                {
+                    "sessionName": self.session_name,
+                    "sessionRoots": [str(p) for p in self.session_roots],
+                    "workingDir": "/home/isabelle/",
+                    "shared": self.shared,
+                },
+            )
+        assert r["success"] == "success", r
+        self.session_id = cast(str, r["sessionId"])
+        if self.debug:
+            print("AsyncQIsabelleSession initialized.")
+
+    async def close(self) -> None:
+        try:
+            r = await self._post("/closeIsabelleSession")
+            assert r == {"success": "Closed"}, r
+        finally:
+            if self._owns_transport:
+                await self.transport.close()
+
+    async def _post(
+        self, path: str, json_data: Optional[dict[str, Any]] = None, timeout: Timeout = None
+    ) -> JSON:
+        json_data = json_data or {}
+        if self.session_id:
+            json_data = {**json_data, "sessionId": self.session_id}
+        start, start_counter = time.time(), time.perf_counter()
+        try:
+            result = await self.transport.post(path, json_data, timeout)
+        except Exception:
+            self.timings.record(path, start, time.perf_counter() - start_counter)
+            raise
+        server_ms = result.pop(SERVER_TIME_KEY, None)
+        self.timings.record(
+            path,
+            start,
+            time.perf_counter() - start_counter,
+            None if server_ms is None else server_ms / 1000,
+        )
+        return check_result(result)
+
+    async def __aenter__(self) -> Self:
+        await self.open()
+        return self
+
+    async def __aexit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        await self.close()
+
+    async def new_theory(
+        self,
+        theory_name: str,
+        new_state_name: str,
+        imports: list[str] = ["Main"],
+        master_dir: Path = Path("/home/isabelle/"),
+        only_import_from_session_heap: bool = True,
+    ) -> None:
+        self.goals.forget(new_state_name)
+        r = await self._post(
+            "/newTheory",
+            {
+                "theoryName": theory_name,
+                "newStateName": new_state_name,
+                "imports": imports,
+                "masterDir": str(master_dir),
+                "onlyImportFromSessionHeap": only_import_from_session_heap,
+            },
+        )
+        assert r == {"success": "success"}, r
+
+    async def load_theory(
+        self,
+        theory_path: Path,
+        until: str,
+        inclusive: bool,
+        new_state_name: str,
+        init_only: bool = False,
+    ) -> tuple[bool, str]:
+        goals_mode, _ = self.goals.request_mode(None, self.goals_mode)
+        r = await self._post(
+            "/loadTheory",
+            {
+                "theoryPath": str(theory_path),
+                "until": until,
+                "inclusive": inclusive,
+                "newStateName": new_state_name,
+                "initOnly": init_only,
+                "goalsMode": goals_mode,
+            },
+        )
+        return cast(bool, r["proofDone"]), read_goals(self.goals, r, "", new_state_name)
+
+    async def locate_lemma(self, theory_path: Path, lemma_statement: str) -> Optional[int]:
+        """See `QIsabelleSession.locate_lemma()`."""
+        r = await self._post(
+            "/locateLemma", {"theoryPath": str(theory_path), "lemmaStatement": lemma_statement}
+        )
+        return cast(int, r["transitionIndex"]) if r["found"] else None
+
+    async def describe_state(self, state_name: str) -> str:
+        r = await self._post("/describeState", {"stateName": state_name})
+        return cast(str, r["description"])
+
+    async def get_mode(self, state_name: str) -> str:
+        r = await self._post("/getMode", {"stateName": state_name})
+        return cast(str, r["description"])
+
+    async def get_theory(self, state_name: str) -> str:
+        r = await self._post("/getTheory", {"stateName": state_name})
+        return cast(str, r["description"])
+
+    async def get_proof_state_description(self, state_name: str) -> str:
+        r = await self._post("/getProofStateDescription", {"stateName": state_name})
+        return cast(str, r["description"])
+
+    async def execute(
+        self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0
+    ) -> tuple[bool, str]:
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
+        r = await self._post(
+            "/execute",
+            {
+                "stateName": state_name,
+                "isarCode": isar_code,
+                "newStateName": new_state_name,
+                "timeout": timeout,
+                "goalsMode": goals_mode,
+            },
+        )
+        return cast(bool, r["proofDone"]), read_goals(self.goals, r, parent_goals, new_state_name)
+
+    async def execute_hashed(
+        self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0
+    ) -> tuple[bool, str]:
+        """See `QIsabelleSession.execute_hashed()`."""
+        r = await self._post(
+            "/execute",
+            {
+                "stateName": state_name,
+                "isarCode": isar_code,
+                "newStateName": new_state_name,
+                "timeout": timeout,
+                "goalsMode": "none",
+            },
+        )
+        self.goals.read(r, "", new_state_name)
+        return cast(bool, r["proofDone"]), cast(str, r["proofStateHash"])
+
+    async def proof_goals(self, state_name: str) -> str:
+        """See `QIsabelleSession.proof_goals()`."""
+        goals = self.goals.goals(state_name)
+        if goals is None:
+            r = await self._post("/getProofGoals", {"stateName": state_name})
+            goals = read_goals(self.goals, r, "", state_name)
+        return goals
+
+    async def proof_state_hash(self, state_name: str) -> str:
+        return self.goals.hash(state_name) or proof_state_hash(await self.proof_goals(state_name))
+
+    async def execute_many(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        new_state_prefix: str = "",
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        """See `QIsabelleSession.execute_many()`."""
+        names = new_state_names or many_state_names(new_state_prefix, len(isar_codes))
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
+        r = await self._post(
+            "/executeMany",
+            {
+                "stateName": state_name,
+                "isarCodes": isar_codes,
+                "timeouts": timeouts or [],
+                "newStateNames": names,
+                "goalsMode": goals_mode,
+            },
+        )
+        return [
+            parse_many_result(result, self.goals, parent_goals, names[i] if i < len(names) else "")
+            for i, result in enumerate(r["results"])
+        ]
+
+    async def execute_chain(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        """See `QIsabelleSession.execute_chain()`."""
+        names = new_state_names or []
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
+        r = await self._post(
+            "/executeChain",
+            {
+                "stateName": state_name,
+                "isarCodes": isar_codes,
+                "timeouts": timeouts or [],
+                "newStateNames": names,
+                "goalsMode": goals_mode,
+            },
+        )
+        return parse_chain_results(r["results"], self.goals, parent_goals, names)
+
+    async def forget_state(self, state_name: str) -> None:
+        self.goals.forget(state_name)
+        r = await self._post("/forgetState", {"stateName": state_name})
+        assert r == {"success": "success"}, r
+
+    async def forget_all_states(self) -> None:
+        self.goals.clear()
+        r = await self._post("/forgetAllStates")
+        assert r == {"success": "success"}, r
+
+    async def hammer(
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
+    ) -> str:
+        r = await self._post(
+            "/hammer",
+            {
+                "stateName": state_name,
+                "addedFacts": added_facts,
+                "deletedFacts": deleted_facts,
+                "timeout": timeout,
+            },
+        )
+        return cast(str, r["proof"])
+
+    async def hammer_async(
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
+    ) -> str:
+        """See `QIsabelleSession.hammer_async()`."""
+        r = await self._post(
+            "/hammerAsync",
+            {
+                "stateName": state_name,
+                "addedFacts": added_facts,
+                "deletedFacts": deleted_facts,
+                "timeout": timeout,
+            },
+        )
+        return cast(str, r["jobId"])
+
+    async def hammer_status(self, job_id: str, wait: float = 0.0) -> tuple[str, str]:
+        """See `QIsabelleSession.hammer_status()`."""
+        r = await self._post("/hammerStatus", {"jobId": job_id, "waitSeconds": wait})
+        return parse_hammer_status(r)
+
+    async def hammer_cancel(self, job_id: str) -> tuple[str, str]:
+        """See `QIsabelleSession.hammer_cancel()`."""
+        return parse_hammer_status(await self._post("/hammerCancel", {"jobId": job_id}))
+
+    async def stats(self) -> JSON:
+        """See `QIsabelleSession.stats()`."""
+        return await self._post("/stats")
@@ -0,0 +1,269 @@
+"""Benchmarks of client overhead and throughput, against the mock server or a real one.
+
+With the mock server (default), this measures:
+- per-call client overhead (sync, async, and async with concurrent calls), with no latency;
+- throughput of execute, execute_many and hammer loops, with the configured latency, payload
+  size and error rates;
+- end-to-end throughput of `run_model_greedily` and `evaluate_model` (with one or more replicas).
+With `--port` (a real server), it loads a lemma and reports per-endpoint latency percentiles of
+execute, hammer and state queries on it.
+
+Results are printed and can be written as JSON (`--output`) for regression tracking.
+
+Run as `python -m client.benchmark --output bench.json`.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import platform
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable
+
+from .async_session import AsyncQIsabelleSession
+from .main import evaluate_model, run_model_greedily
+from .mock_server import MockConfig, MockQIsabelleServer
+from .model import DummyHammerModel
+from .session import QIsabelleServerError, QIsabelleSession
+from .test_cases import TestCase
+from .timing import latency_summary
+from .transport import JSON, HTTPTransport, Timeout, Transport, json_dumps
+
+MOCK_THEORY_PATH = Path("/afp/thys/Bench/Bench.thy")
+MOCK_LEMMA = 'lemma bench: "x = x"'
+
+
+class TimedTransport:
+    """A Transport wrapper recording the latency of each call, per endpoint."""
+
+    def __init__(self, transport: Transport):
+        self.transport = transport
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+
+    def post(self, path: str, json_data: JSON, timeout: Timeout = None) -> JSON:
+        start = time.perf_counter()
+        try:
+            return self.transport.post(path, json_data, timeout)
+        finally:
+            self.latencies[path].append(time.perf_counter() - start)
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def summary(self) -> dict[str, JSON]:
+        return {path: latency_summary(latencies) for path, latencies in self.latencies.items()}
+
+
+def throughput(n: int, seconds: float) -> JSON:
+    return {"n": n, "seconds": seconds, "per_second": n / seconds, "mean_ms": 1000 * seconds / n}
+
+
+def timed(n: int, f: Callable[[], Any]) -> JSON:
+    """Call f() n times, return the throughput."""
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return throughput(n, time.perf_counter() - start)
+
+
+def bench_overhead(port: int, n: int) -> dict[str, JSON]:
+    """Per-call overhead of a cheap endpoint, to be run on a mock server without latency."""
+    results = dict[str, JSON]()
+    with QIsabelleSession(theory_path=MOCK_THEORY_PATH, port=port, debug=False) as session:
+        session.load_theory(MOCK_THEORY_PATH, MOCK_LEMMA, True, "s")
+        results["sync_call"] = timed(n, lambda: session.get_mode("s"))
+
+    async def run_async() -> None:
+        async with AsyncQIsabelleSession(
+            theory_path=MOCK_THEORY_PATH, port=port, debug=False
+        ) as session:
+            await session.load_theory(MOCK_THEORY_PATH, MOCK_LEMMA, True, "s")
+            start = time.perf_counter()
+            for _ in range(n):
+                await session.get_mode("s")
+            results["async_call"] = throughput(n, time.perf_counter() - start)
+            start = time.perf_counter()
+            await asyncio.gather(*[session.get_mode("s") for _ in range(n)])
+            results["async_concurrent_call"] = throughput(n, time.perf_counter() - start)
+
+    asyncio.run(run_async())
+    return results
+
+
+def bench_loops(
+    session: QIsabelleSession, theory_path: Path, lemma: str, step: str, n: int, hammer: bool
+) -> dict[str, JSON]:
+    """Throughput of execute, execute_many and hammer loops on a loaded lemma."""
+    results = dict[str, JSON]()
+    session.load_theory(theory_path, lemma, True, "s")
+
+    def execute() -> None:
+        with contextlib.suppress(QIsabelleServerError):
+            session.execute("s", step, "s.0")
+
+    results["execute"] = timed(n, execute)
+    batch = 8
+    start = time.perf_counter()
+    for _ in range(max(1, n // batch)):
+        session.execute_many("s", [step] * batch, "m")
+    results["execute_many_step"] = throughput(
+        max(1, n // batch) * batch, time.perf_counter() - start
+    )
+    if hammer:
+
+        def hammer_once() -> None:
+            with contextlib.suppress(QIsabelleServerError):
+                session.hammer("s")
+
+        results["hammer"] = timed(max(1, n // 10), hammer_once)
+    session.forget_all_states()
+    return results
+
+
+def bench_end_to_end(port: int, ports: list[int], n: int) -> dict[str, JSON]:
+    """Throughput of run_model_greedily and evaluate_model with a hammer-only model."""
+    results = dict[str, JSON]()
+    model = DummyHammerModel()
+    with QIsabelleSession(theory_path=MOCK_THEORY_PATH, port=port, debug=False) as session:
+
+        def run_once() -> None:
+            with contextlib.suppress(QIsabelleServerError):
+                run_model_greedily(model, MOCK_THEORY_PATH, MOCK_LEMMA, session, out=io.StringIO())
+
+        results["run_model_greedily"] = timed(n, run_once)
+
+    # Tests spread over a few sessions, like PISA tests are over AFP entries.
+    tests = [
+        TestCase(f"bench_{i}", Path(f"Bench{i % 4}/Bench{i % 16}.thy"), MOCK_LEMMA)
+        for i in range(n)
+    ]
+    for replicas in sorted({1, len(ports)}):
+        for prefetch in (False, True):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                evaluate_model(model, tests, ports=ports[:replicas], prefetch=prefetch)
+            name = f"evaluate_model_{replicas}_replicas" + ("_prefetch" if prefetch else "")
+            results[name] = throughput(n, time.perf_counter() - start)
+    return results
+
+
+def run_mock_benchmarks(
+    config: MockConfig, n: int, replicas: int, goals_mode: str = "full"
+) -> JSON:
+    results: JSON = {}
+    with MockQIsabelleServer(MockConfig(seed=config.seed)) as server:
+        results["overhead"] = bench_overhead(server.port, n)
+
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(MockQIsabelleServer(config)) for _ in range(replicas)]
+        ports = [server.port for server in servers]
+        transport = TimedTransport(HTTPTransport(port=ports[0]))
+        with QIsabelleSession(
+            theory_path=MOCK_THEORY_PATH, debug=False, transport=transport, goals_mode=goals_mode
+        ) as session:
+            results["loops"] = bench_loops(
+                session, MOCK_THEORY_PATH, MOCK_LEMMA, "apply simp", n, hammer=True
+            )
+        transport.close()
+        results["endpoints"] = transport.summary()
+        results["end_to_end"] = bench_end_to_end(ports[0], ports, n)
+    return results
+
+
+def run_server_benchmarks(
+    port: int,
+    theory_path: Path,
+    lemma: str,
+    step: str,
+    n: int,
+    hammer: bool,
+    goals_mode: str = "full",
+) -> JSON:
+    transport = TimedTransport(HTTPTransport(port=port))
+    results: JSON = {}
+    with QIsabelleSession(
+        theory_path=theory_path, debug=False, transport=transport, goals_mode=goals_mode
+    ) as session:
+        results["loops"] = bench_loops(session, theory_path, lemma, step, n, hammer)
+        session.load_theory(theory_path, lemma, True, "s")
+        timed(n, lambda: session.describe_state("s"))
+    transport.close()
+    results["endpoints"] = transport.summary()
+    return results
+
+
+def print_results(results: JSON, prefix: str = "") -> None:
+    for name, value in results.items():
+        if isinstance(value, dict) and not any(isinstance(v, dict) for v in value.values()):
+            fields = ", ".join(
+                f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items()
+            )
+            print(f"{prefix}{name}: {fields}")
+        elif isinstance(value, dict):
+            print(f"{prefix}{name}:")
+            print_results(value, prefix + "    ")
+        else:
+            print(f"{prefix}{name}: {value}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", type=Path, help="Write results as JSON to this file.")
+    parser.add_argument("-n", type=int, default=1000, help="Number of calls per benchmark.")
+    parser.add_argument("--port", type=int, help="Benchmark a real server on this port.")
+    parser.add_argument("--theory-path", type=Path, help="Real server: theory to load.")
+    parser.add_argument("--lemma", help="Real server: lemma statement to load.")
+    parser.add_argument("--step", default="apply simp", help="Proof step to execute.")
+    parser.add_argument("--hammer", action="store_true", help="Real server: also run hammer.")
+    parser.add_argument("--goals-mode", choices=["full", "diff"], default="full")
+    parser.add_argument("--replicas", type=int, default=2, help="Mock: number of mock servers.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock: seconds per call.")
+    parser.add_argument("--hammer-latency", type=float, default=0.0, help="Mock: hammer seconds.")
+    parser.add_argument("--open-latency", type=float, default=0.0, help="Mock: session open.")
+    parser.add_argument("--max-sessions", type=int, default=2, help="Mock: sessions per server.")
+    parser.add_argument("--goals-padding", type=int, default=0, help="Mock: chars per state.")
+    parser.add_argument("--execute-error-rate", type=float, default=0.0)
+    parser.add_argument("--hammer-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    results: JSON = {"python": platform.python_version(), "time": time.time(), "n": args.n}
+    results["goals_mode"] = args.goals_mode
+    if args.port is None:
+        config = MockConfig(
+            latency={
+                "/hammer": args.hammer_latency,
+                "/openIsabelleSessionForTheory": args.open_latency,
+            },
+            default_latency=args.latency,
+            goals_padding=args.goals_padding,
+            execute_error_rate=args.execute_error_rate,
+            hammer_error_rate=args.hammer_error_rate,
+            max_sessions=args.max_sessions,
+        )
+        results["mode"] = "mock"
+        results["config"] = vars(config)
+        results |= run_mock_benchmarks(config, args.n, args.replicas, args.goals_mode)
+    else:
+        assert args.theory_path and args.lemma, "--theory-path and --lemma are needed with --port."
+        results["mode"] = "server"
+        results |= run_server_benchmarks(
+            args.port,
+            args.theory_path,
+            args.lemma,
+            args.step,
+            args.n,
+            args.hammer,
+            args.goals_mode,
+        )
+
+    print_results(results)
+    if args.output is not None:
+        args.output.write_bytes(json_dumps(results))
+
+
+if __name__ == "__main__":
+    main()
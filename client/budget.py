@@ -0,0 +1,184 @@
+"""Time budgets for evaluating a model on a whole test suite within a given wall-clock time.
+
+A fixed time limit per test wastes most of the time on tests that can't be solved quickly (about
+half of PISA tests end in hammer timeouts, see `main.test_pisa`), while some of them would be
+solved with more time. `BudgetScheduler` instead:
+- runs each test once with a fair share of the remaining time (capped by `max_search_time`), and
+  short hammer timeouts;
+- then, while time remains, retries tests that timed out with a `retry_factor` times larger
+  hammer timeout or search time (whichever was hit), if the retry fits in the remaining time;
+- stops handing out tests at the deadline, and caps budgets so that running tests end by then.
+Results of previous runs (see `results.py`) are used as priors: tests solved before go first with
+a budget based on their previous duration, tests that timed out before are retried directly with
+larger budgets after all others, and tests that failed otherwise go last in the first pass.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .results import TestResult
+from .test_cases import TestCase
+
+# Result kinds that could change with more time.
+TIMEOUT_KINDS = ("timeout-soft", "timeout-mid", "timeout-hard", "search-timeout")
+
+# Soft hammer timeout used by the server when none is given.
+DEFAULT_HAMMER_TIMEOUT = 30.0
+# Seconds a hammer call can take beyond its soft timeout.
+HAMMER_GRACE = 10.0
+
+
+@dataclass
+class Budget:
+    search_time: float  # Seconds for the whole proof search (`max_proof_search_time`).
+    hammer_timeout: float  # Soft timeout of each hammer call in seconds (see `session.hammer`).
+    attempt: int = 0  # 0 for the first run of a test, then 1, 2, ... for retries.
+
+
+@dataclass
+class _Pending:
+    test: TestCase
+    budget: Optional[Budget]  # None means a fair share, computed when the test starts.
+    attempt: int = 0
+
+
+class BudgetScheduler:
+    """Hands out test cases with time budgets, so that a suite finishes within total_time.
+
+    Thread-safe: workers call `next()` to get a test and its budget, then must `report()` its
+    result (since a test that times out may be retried, `next()` waits for running tests to be
+    reported before it says there are no tests left).
+    """
+
+    def __init__(
+        self,
+        tests: list[TestCase],
+        total_time: float,
+        n_workers: int = 1,
+        priors: dict[str, TestResult] = {},
+        min_search_time: float = 30.0,
+        max_search_time: float = 500.0,
+        hammer_timeout: float = 10.0,
+        max_hammer_timeout: float = 120.0,
+        retry_factor: float = 2.0,
+        max_attempts: int = 3,
+    ):
+        """
+        Args:
+        - tests: test cases, in the order they should run when there is no prior about them.
+        - total_time: wall-clock seconds for the whole suite, starting now.
+        - n_workers: number of tests running at once.
+        - priors: results of previous runs, by test name.
+        - min_search_time, max_search_time: bounds of search time budgets of first runs.
+        - hammer_timeout: hammer timeout of first runs.
+        - max_hammer_timeout: hammer timeout can't grow beyond that on retries.
+        - retry_factor: the hammer timeout or search time grows by this factor on each retry.
+        - max_attempts: maximum number of runs of a test.
+        """
+        self.deadline = time.time() + total_time
+        self.n_workers = n_workers
+        self.min_search_time = min_search_time
+        self.max_search_time = max_search_time
+        self.hammer_timeout = hammer_timeout
+        self.max_hammer_timeout = max_hammer_timeout
+        self.retry_factor = retry_factor
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+        self.n_running = 0
+
+        solved, unknown, failed = list[_Pending](), list[_Pending](), list[_Pending]()
+        self.retries = list[_Pending]()
+        for test in tests:
+            prior = priors.get(test.name)
+            if prior is None:
+                unknown.append(_Pending(test, None))
+            elif prior.kind == "success":
+                search_time = max(self.min_search_time, 2 * prior.duration)
+                budget = Budget(
+                    min(self.max_search_time, search_time),
+                    prior.hammer_timeout or DEFAULT_HAMMER_TIMEOUT,
+                )
+                solved.append(_Pending(test, budget))
+            elif prior.kind in TIMEOUT_KINDS:
+                budget = Budget(
+                    prior.search_time or self.max_search_time,
+                    prior.hammer_timeout or DEFAULT_HAMMER_TIMEOUT,
+                )
+                self.retries.append(_Pending(test, self._grow(budget, prior.kind), attempt=1))
+            else:
+                failed.append(_Pending(test, None))
+        # Quickest previous successes first, to secure them.
+        solved.sort(key=lambda p: p.budget.search_time if p.budget else 0.0)
+        self.first_pass = solved + unknown + failed
+        self.first_pass.reverse()  # We pop from the end.
+
+    def next(self) -> Optional[tuple[TestCase, Budget]]:
+        """The next test to run and its budget, or None if there's no test left or no time left."""
+        with self.condition:
+            while True:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    return None
+                pending = self._pop(remaining)
+                if pending is not None:
+                    assert pending.budget is not None
+                    self.n_running += 1
+                    return pending.test, pending.budget
+                if self.n_running == 0:
+                    return None
+                self.condition.wait(timeout=remaining)
+
+    def peek(self) -> Optional[TestCase]:
+        """The test `next()` will likely return (without taking it), e.g. to prepare for it."""
+        with self.condition:
+            return self.first_pass[-1].test if self.first_pass else None
+
+    def report(self, test: TestCase, budget: Budget, result: TestResult) -> None:
+        """Record the result of a test, to retry it later if it timed out."""
+        with self.condition:
+            self.n_running -= 1
+            if result.kind in TIMEOUT_KINDS and budget.attempt + 1 < self.max_attempts:
+                retry_budget = self._grow(budget, result.kind)
+                self.retries.append(_Pending(test, retry_budget, budget.attempt + 1))
+            self.condition.notify_all()
+
+    @property
+    def n_pending(self) -> int:
+        with self.condition:
+            return len(self.first_pass) + len(self.retries)
+
+    def _pop(self, remaining: float) -> Optional[_Pending]:
+        """Take the next test to run, with its budget set (capped to the remaining time)."""
+        if self.first_pass:
+            pending = self.first_pass.pop()
+            pending.budget = pending.budget or self._fair_budget(remaining)
+        else:
+            # Smallest retries first, if they fit in the remaining time.
+            self.retries.sort(key=lambda p: -p.budget.search_time if p.budget else 0.0)
+            if not self.retries or self.retries[-1].budget is None:
+                return None
+            if self.retries[-1].budget.search_time > remaining:
+                return None
+            pending = self.retries.pop()
+        assert pending.budget is not None
+        pending.budget.attempt = pending.attempt
+        pending.budget.search_time = min(pending.budget.search_time, remaining)
+        return pending
+
+    def _fair_budget(self, remaining: float) -> Budget:
+        """An equal share of the remaining worker time for each test of the first pass."""
+        n_tests = len(self.first_pass) + 1
+        share = remaining * self.n_workers / max(1, n_tests)
+        search_time = min(self.max_search_time, max(self.min_search_time, share))
+        return Budget(search_time, min(self.hammer_timeout, search_time))
+
+    def _grow(self, budget: Budget, kind: str) -> Budget:
+        """A larger budget, after a timeout of a given kind (the limit that was hit grows)."""
+        if kind == "search-timeout":
+            return Budget(budget.search_time * self.retry_factor, budget.hammer_timeout)
+        hammer_timeout = min(self.max_hammer_timeout, budget.hammer_timeout * self.retry_factor)
+        # Leave time for the hammer call (which can take 10s more than its timeout) and others.
+        return Budget(max(budget.search_time, 2 * hammer_timeout + 10), hammer_timeout)
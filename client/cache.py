@@ -0,0 +1,429 @@
+"""Persistent on-disk cache of execute and hammer results."""
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from .proof_goals import proof_state_hash
+from .session import (
+    PROCESS_FAILURES,
+    SESSION_FAILURES,
+    QIsabelleServerError,
+    QIsabelleSession,
+    guess_session_name,
+)
+from .transport import JSON, json_dumps, json_loads
+
+
+class ResultCache:
+    """A content-addressed cache of JSON values in an SQLite file.
+
+    Keys are JSON-serializable values (hashed with SHA-256). When the total size of stored values
+    exceeds max_size_bytes, least recently used entries are deleted.
+    The cache can be shared by threads and (thanks to SQLite locking) by processes.
+    """
+
+    def __init__(self, path: Path, max_size_bytes: int = 2**30):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60.0, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results"
+            " (key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.db.commit()
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evicted = 0
+        self._n_puts_since_eviction = 0
+
+    def get(self, key: Any) -> Optional[JSON]:
+        h = _hash(key)
+        with self.lock:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (h,)).fetchone()
+            if row is None:
+                self.n_misses += 1
+                return None
+            self.n_hits += 1
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), h))
+            self.db.commit()
+        value = json_loads(row[0])
+        assert isinstance(value, dict)
+        return value
+
+    def put(self, key: Any, value: JSON) -> None:
+        data = json_dumps(value)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (_hash(key), data, len(data), time.time()),
+            )
+            self.db.commit()
+            self._n_puts_since_eviction += 1
+            if self._n_puts_since_eviction >= 100:
+                self._n_puts_since_eviction = 0
+                self._evict()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            n_entries, size = self.db.execute("SELECT COUNT(*), SUM(size) FROM results").fetchone()
+        return {
+            "hits": self.n_hits,
+            "misses": self.n_misses,
+            "evicted": self.n_evicted,
+            "entries": n_entries,
+            "size_bytes": size or 0,
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def _evict(self) -> None:
+        """Delete least recently used entries until the total size is at most 90% of the limit."""
+        (total_size,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total_size <= self.max_size_bytes:
+            return
+        to_free = total_size - int(0.9 * self.max_size_bytes)
+        freed = 0
+        keys = list[bytes]()
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY last_used"):
+            if freed >= to_free:
+                break
+            keys.append(key)
+            freed += size
+        self.db.executemany("DELETE FROM results WHERE key = ?", [(k,) for k in keys])
+        self.db.commit()
+        self.n_evicted += len(keys)
+
+
+def _hash(key: Any) -> bytes:
+    return hashlib.sha256(json_dumps(key)).digest()
+
+
+@dataclass
+class _StateRecord:
+    """How a state was reached: from a root (load_theory/new_theory call) by a chain of steps."""
+
+    root: tuple[Any, ...]  # Arguments of the call that made the root state.
+    steps: tuple[tuple[str, int], ...]  # (isar_code, timeout) pairs executed from the root.
+    parent: Optional[str]  # Name of the state the last step was executed on.
+    materialized: bool  # Whether the state actually exists on the server.
+
+
+class CachedQIsabelleSession(QIsabelleSession):
+    """A QIsabelleSession that caches results of load_theory, execute, execute_many and hammer.
+
+    Results are keyed by the Isabelle session, the root of the state (theory path, lemma, etc.),
+    the exact chain of steps executed since (with timeouts), and for hammer the added/deleted facts.
+    Errors raised by the server (like timeouts) are cached as well.
+
+    On a cache hit, the new state is not created on the server: it's only created when needed
+    (when a later call misses the cache), by replaying steps from its nearest existing ancestor.
+    States created in other ways (e.g. by `execute_chain`) are not cached.
+    """
+
+    def __init__(self, cache: ResultCache, **kwargs: Any):
+        """kwargs are passed to QIsabelleSession."""
+        super().__init__(**kwargs)
+        self.cache = cache
+        if self.theory_path is not None:
+            self.cache_session_key = guess_session_name(self.theory_path)
+        else:
+            self.cache_session_key = f"{self.session_name}:{self.session_roots}"
+        self.records: dict[str, _StateRecord] = {}
+
+    def new_theory(
+        self,
+        theory_name: str,
+        new_state_name: str,
+        imports: list[str] = ["Main"],
+        master_dir: Path = Path("/home/isabelle/"),
+        only_import_from_session_heap: bool = True,
+    ) -> None:
+        super().new_theory(
+            theory_name, new_state_name, imports, master_dir, only_import_from_session_heap
+        )
+        root = ("new_theory", theory_name, imports, str(master_dir), only_import_from_session_heap)
+        self.records[new_state_name] = _StateRecord(root, (), None, True)
+
+    def load_theory(
+        self,
+        theory_path: Path,
+        until: str,
+        inclusive: bool,
+        new_state_name: str,
+        init_only: bool = False,
+    ) -> tuple[bool, str]:
+        root = ("load_theory", str(theory_path), until, inclusive, init_only)
+        key = (self.cache_session_key, root)
+        self.records.pop(new_state_name, None)
+        value = self.cache.get(key)
+        if value is None:
+            try:
+                result = super().load_theory(
+                    theory_path, until, inclusive, new_state_name, init_only
+                )
+            except QIsabelleServerError as e:
+                self._put_error(key, e)
+                raise
+            self.cache.put(key, {"result": result})
+            self.records[new_state_name] = _StateRecord(root, (), None, True)
+            return result
+        if "result" in value:
+            self.records[new_state_name] = _StateRecord(root, (), None, False)
+        return self._cached_result(value, new_state_name)
+
+    def execute(
+        self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0
+    ) -> tuple[bool, str]:
+        record = self.records.get(state_name)
+        if record is None:
+            self.records.pop(new_state_name, None)
+            return super().execute(state_name, isar_code, new_state_name, timeout)
+        steps = record.steps + ((isar_code, timeout),)
+        key = (self.cache_session_key, record.root, steps)
+        value = self.cache.get(key)
+        if value is None:
+            self._materialize(state_name)
+            try:
+                result = super().execute(state_name, isar_code, new_state_name, timeout)
+            except QIsabelleServerError as e:
+                self._put_error(key, e)
+                raise
+            self.cache.put(key, {"result": result})
+            self.records[new_state_name] = _StateRecord(record.root, steps, state_name, True)
+            return result
+        if "result" in value:
+            new_record = _StateRecord(record.root, steps, state_name, False)
+            self._replace_record(new_state_name, new_record, state_name)
+        return self._cached_result(value, new_state_name)
+
+    def execute_many(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        new_state_prefix: str = "",
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        record = self.records.get(state_name)
+        if record is None:
+            return super().execute_many(
+                state_name, isar_codes, new_state_prefix, timeouts, new_state_names
+            )
+        names = new_state_names or [
+            f"{new_state_prefix}.{i}" if new_state_prefix else "" for i in range(len(isar_codes))
+        ]
+        all_timeouts = (timeouts or []) + [0] * (len(isar_codes) - len(timeouts or []))
+        results: list[Optional[tuple[bool, str] | QIsabelleServerError]] = []
+        misses = list[int]()
+        for isar_code, timeout, name in zip(isar_codes, all_timeouts, names):
+            steps = record.steps + ((isar_code, timeout),)
+            value = self.cache.get((self.cache_session_key, record.root, steps))
+            if value is None:
+                misses.append(len(results))
+                results.append(None)
+                continue
+            if "result" in value and name:
+                new_record = _StateRecord(record.root, steps, state_name, False)
+                self._replace_record(name, new_record, state_name)
+            try:
+                results.append(self._cached_result(value, name))
+            except QIsabelleServerError as e:
+                results.append(e)
+
+        if misses:
+            self._materialize(state_name)
+            miss_results = super().execute_many(
+                state_name,
+                [isar_codes[i] for i in misses],
+                timeouts=[all_timeouts[i] for i in misses],
+                new_state_names=[names[i] for i in misses],
+            )
+            for i, result in zip(misses, miss_results):
+                steps = record.steps + ((isar_codes[i], all_timeouts[i]),)
+                key = (self.cache_session_key, record.root, steps)
+                if isinstance(result, QIsabelleServerError):
+                    self._put_error(key, result)
+                else:
+                    self.cache.put(key, {"result": result})
+                    if names[i]:
+                        self.records[names[i]] = _StateRecord(record.root, steps, state_name, True)
+                results[i] = result
+        return [r for r in results if r is not None]
+
+    def execute_chain(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        # Not cached, see the class docstring.
+        self._materialize(state_name)
+        for name in new_state_names or []:
+            self.records.pop(name, None)
+        return super().execute_chain(state_name, isar_codes, timeouts, new_state_names)
+
+    def hammer(
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
+    ) -> str:
+        record = self.records.get(state_name)
+        if record is None:
+            return super().hammer(state_name, added_facts, deleted_facts, timeout)
+        key: tuple[Any, ...] = (
+            self.cache_session_key,
+            record.root,
+            record.steps,
+            "hammer",
+            sorted(added_facts),
+            sorted(deleted_facts),
+        )
+        if timeout:  # Keep keys of calls with the default timeout as they were.
+            key += (timeout,)
+        value = self.cache.get(key)
+        if value is None:
+            self._materialize(state_name)
+            try:
+                proof = super().hammer(state_name, added_facts, deleted_facts, timeout)
+            except QIsabelleServerError as e:
+                self._put_error(key, e)
+                raise
+            self.cache.put(key, {"proof": proof})
+            return proof
+        if "error" in value:
+            raise QIsabelleServerError(value["error"])
+        return str(value["proof"])
+
+    def hammer_async(
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
+    ) -> str:
+        # Hammer jobs are not cached (their results depend on when they're cancelled).
+        self._materialize(state_name)
+        return super().hammer_async(state_name, added_facts, deleted_facts, timeout)
+
+    def execute_hashed(
+        self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0
+    ) -> tuple[bool, str]:
+        # Cached results have goals anyway.
+        proof_done, proof_goals = self.execute(state_name, isar_code, new_state_name, timeout)
+        return proof_done, proof_state_hash(proof_goals)
+
+    def proof_goals(self, state_name: str) -> str:
+        if self.goals.goals(state_name) is None:
+            self._materialize(state_name)
+        return super().proof_goals(state_name)
+
+    def describe_state(self, state_name: str) -> str:
+        self._materialize(state_name)
+        return super().describe_state(state_name)
+
+    def get_mode(self, state_name: str) -> str:
+        self._materialize(state_name)
+        return super().get_mode(state_name)
+
+    def get_theory(self, state_name: str) -> str:
+        self._materialize(state_name)
+        return super().get_theory(state_name)
+
+    def get_proof_state_description(self, state_name: str) -> str:
+        self._materialize(state_name)
+        return super().get_proof_state_description(state_name)
+
+    def forget_state(self, state_name: str) -> None:
+        record = self.records.pop(state_name, None)
+        if record is None or record.materialized:
+            super().forget_state(state_name)
+        else:
+            self.goals.forget(state_name)
+
+    def forget_all_states(self) -> None:
+        self.records.clear()
+        super().forget_all_states()
+
+    def _replace_record(self, state_name: str, record: _StateRecord, source_name: str) -> None:
+        """Record a state that's not materialized, forgetting any old one on the server."""
+        old_record = self.records.get(state_name)
+        if old_record is not None and old_record.materialized and state_name != source_name:
+            super().forget_state(state_name)
+        self.records[state_name] = record
+
+    def _materialize(self, state_name: str) -> None:
+        """Make sure a state exists on the server, replaying steps from its nearest ancestor."""
+        record = self.records.get(state_name)
+        if record is None or record.materialized:
+            return
+        parent = self.records.get(record.parent) if record.parent is not None else None
+        if not record.steps:
+            self._make_root(record.root, state_name)
+        elif (
+            parent is not None
+            and parent.root == record.root
+            and parent.steps == record.steps[:-1]
+        ):
+            assert record.parent is not None
+            self._materialize(record.parent)
+            isar_code, timeout = record.steps[-1]
+            super().execute(record.parent, isar_code, state_name, timeout)
+        else:
+            # The parent was forgotten or replaced, replay all steps from the root.
+            tmp_name = f"{state_name}.__replay"
+            self._make_root(record.root, tmp_name)
+            for isar_code, timeout in record.steps[:-1]:
+                super().execute(tmp_name, isar_code, tmp_name, timeout)
+            isar_code, timeout = record.steps[-1]
+            super().execute(tmp_name, isar_code, state_name, timeout)
+            super().forget_state(tmp_name)
+        record.materialized = True
+
+    def _make_root(self, root: tuple[Any, ...], state_name: str) -> None:
+        """Redo the call that made a root state, without caching."""
+        if root[0] == "load_theory":
+            _, theory_path, until, inclusive, init_only = root
+            super().load_theory(Path(theory_path), until, inclusive, state_name, init_only)
+        else:
+            _, theory_name, imports, master_dir, only_import_from_session_heap = root
+            super().new_theory(
+                theory_name, state_name, imports, Path(master_dir), only_import_from_session_heap
+            )
+
+    def _cached_result(self, value: JSON, new_state_name: str) -> tuple[bool, str]:
+        """The result of a cache hit; its goals are remembered as those of the new state."""
+        result = _result_or_raise(value)
+        if new_state_name:
+            self.goals.put(new_state_name, result[1])
+        return result
+
+    def _put_error(self, key: Any, e: QIsabelleServerError) -> None:
+        """Cache an error, unless it's not about the proof.
+
+        That is, unless it's about the client's use of states or sessions, or the Isabelle process
+        died (see `router.py`).
+        """
+        transient = ("State not found", "State evicted") + SESSION_FAILURES + PROCESS_FAILURES
+        if not any(failure in str(e) for failure in transient):
+            self.cache.put(key, {"error": str(e)})
+
+
+def _result_or_raise(value: JSON) -> tuple[bool, str]:
+    if "error" in value:
+        raise QIsabelleServerError(value["error"])
+    proof_done, proof_goals = value["result"]
+    return bool(proof_done), str(proof_goals)
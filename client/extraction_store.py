@@ -0,0 +1,343 @@
+"""Compact, memory-mapped, indexed storage of extractions (see `extractions.py`).
+
+`build_extraction_store()` compiles extractions into a single file with deduplicated strings,
+offset arrays, and two hash tables: one from (thy_file, lemma statement) to the lemma's span of
+translations, and one from proof states to their known next step. `ExtractionStore` then reads
+it lazily, in O(1) per lookup, without loading everything in memory.
+
+Build with `python -m client.extraction_store build EXTRACTIONS_DIR OUTPUT_FILE`.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Callable, Iterable, Iterator
+from pathlib import Path
+from typing import Any, BinaryIO, Literal, Optional
+
+from typing_extensions import Self
+
+from .extractions import Extraction, iter_extractions
+from .model import Model
+from .utils import normalize_goals, normalize_whitespace
+
+_MAGIC = b"QIEXT001"
+# Magic, then: n_strings, string_bytes_size, n_translations, n_extractions, n_lemmas,
+# lemma_table_size, step_table_size.
+_HEADER = struct.Struct("<8s7Q")
+_EXTRACTION_FIELDS = 6  # thy_file, working_directory, translations start/end, lemmas start/end.
+_LEMMA_FIELDS = 4  # extraction index, statement, translations start/end.
+
+assert sys.byteorder == "little", "The extraction store format is little-endian."
+
+
+class ExtractionStore:
+    """Read-only access to an extraction store file.
+
+    Use as `with ExtractionStore(path) as store: ...`. Translations are (proof_state, proof_step)
+    pairs as in `Extraction.translations`, numbered globally over all extractions.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._views = list[memoryview]()
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:  # Like ValueError for an empty file.
+            self._file.close()
+            raise
+        try:
+            self._read_sections()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read_sections(self) -> None:
+        if len(self._mmap) < _HEADER.size or self._mmap[: len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"Not an extraction store: {self.path}")
+        view = memoryview(self._mmap)
+        self._views.append(view)
+        _magic, *counts = _HEADER.unpack_from(view)
+        n_strings, string_bytes_size, n_translations, n_extractions, n_lemmas = counts[:5]
+        lemma_table_size, step_table_size = counts[5:]
+        self.n_translations: int = n_translations
+        self.n_extractions: int = n_extractions
+        self.n_lemmas: int = n_lemmas
+
+        offset = _HEADER.size
+
+        def section(size: int, format: Literal["B", "I", "Q"]) -> memoryview:
+            nonlocal offset
+            section_view = view[offset : offset + size]
+            offset += _padded(size)
+            if format != "B":
+                self._views.append(section_view)
+                section_view = section_view.cast(format)
+            self._views.append(section_view)
+            return section_view
+
+        self._string_offsets = section(8 * (n_strings + 1), "Q")
+        self._string_bytes = section(string_bytes_size, "B")
+        self._states = section(4 * n_translations, "I")
+        self._steps = section(4 * n_translations, "I")
+        self._extractions = section(4 * _EXTRACTION_FIELDS * n_extractions, "I")
+        self._lemmas = section(4 * _LEMMA_FIELDS * n_lemmas, "I")
+        self._lemma_table = section(4 * lemma_table_size, "I")
+        self._step_table = section(4 * step_table_size, "I")
+
+    def close(self) -> None:
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.close()
+
+    def string(self, i: int) -> str:
+        start, end = self._string_offsets[i], self._string_offsets[i + 1]
+        return str(self._string_bytes[start:end], "utf-8")
+
+    def translation(self, i: int) -> tuple[str, str]:
+        return self.string(self._states[i]), self.string(self._steps[i])
+
+    def translations(self, start: int, end: int) -> Iterator[tuple[str, str]]:
+        return (self.translation(i) for i in range(start, end))
+
+    def lemma_span(self, thy_file: Path, lemma_statement: str) -> Optional[tuple[int, int]]:
+        """The (start, end) span of translations of a lemma, starting with ("", statement).
+
+        thy_file is relative to "/afp/thys/"; whitespace in the statement is ignored.
+        Returns None for unknown lemmas; the span is empty if the lemma's proof wasn't extracted.
+        """
+        lemma = self._find_lemma(thy_file, lemma_statement)
+        if lemma is None:
+            return None
+        row = _LEMMA_FIELDS * lemma
+        return self._lemmas[row + 2], self._lemmas[row + 3]
+
+    def lemma_translations(self, thy_file: Path, lemma_statement: str) -> list[tuple[str, str]]:
+        span = self.lemma_span(thy_file, lemma_statement)
+        return [] if span is None else list(self.translations(*span))
+
+    def next_step(self, proof_state: str) -> Optional[str]:
+        """The known next step from a proof state (whitespace is ignored), if any.
+
+        If the same proof state appears several times, the step from the first one is returned.
+        """
+        key = normalize_goals(proof_state)
+        i = self._probe(
+            self._step_table, key, lambda i: normalize_goals(self.string(self._states[i])) == key
+        )
+        return None if i is None else self.string(self._steps[i])
+
+    def extraction(self, i: int) -> Extraction:
+        """Load a whole extraction in memory (in the order they were added)."""
+        row = _EXTRACTION_FIELDS * i
+        thy_file, work_dir, start, end, lemmas_start, lemmas_end = self._extractions[
+            row : row + _EXTRACTION_FIELDS
+        ]
+        return Extraction(
+            thy_file=Path(self.string(thy_file)),
+            working_directory=Path(self.string(work_dir)),
+            lemma_statements=[
+                self.string(self._lemmas[_LEMMA_FIELDS * j + 1])
+                for j in range(lemmas_start, lemmas_end)
+            ],
+            translations=list(self.translations(start, end)),
+        )
+
+    def thy_file(self, i: int) -> Path:
+        """The thy_file of an extraction, without loading it."""
+        return Path(self.string(self._extractions[_EXTRACTION_FIELDS * i]))
+
+    def __iter__(self) -> Iterator[Extraction]:
+        return (self.extraction(i) for i in range(self.n_extractions))
+
+    def _find_lemma(self, thy_file: Path, lemma_statement: str) -> Optional[int]:
+        key = _lemma_key(thy_file, lemma_statement)
+
+        def matches(lemma: int) -> bool:
+            row = _LEMMA_FIELDS * lemma
+            extraction_thy_file = self._extractions[_EXTRACTION_FIELDS * self._lemmas[row]]
+            statement = self.string(self._lemmas[row + 1])
+            return _lemma_key(Path(self.string(extraction_thy_file)), statement) == key
+
+        return self._probe(self._lemma_table, key, matches)
+
+    @staticmethod
+    def _probe(table: memoryview, key: str, matches: Callable[[int], bool]) -> Optional[int]:
+        """Find a value in an open-addressing hash table (values are stored +1, 0 is empty)."""
+        mask = len(table) - 1
+        slot = _hash(key) & mask
+        while table[slot] != 0:
+            if matches(table[slot] - 1):
+                return int(table[slot] - 1)
+            slot = (slot + 1) & mask
+        return None
+
+
+class KnownNextStepModel(Model):
+    """Model that answers the known next step of the proof state, if it's in the store."""
+
+    def __init__(self, store: ExtractionStore):
+        self.store = store
+
+    def __call__(
+        self,
+        context: str,
+        proof_state: str,
+        known_solution: str = "",
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[tuple[str, float]]:
+        step = self.store.next_step(proof_state)
+        return [] if step is None else [(step, 0.1)]
+
+
+def build_extraction_store(extractions: Iterable[Extraction], path: Path) -> None:
+    """Compile extractions into an extraction store file (overwriting it)."""
+    strings = dict[str, int]()  # Interned strings.
+    string_offsets = array("Q", [0])
+    string_bytes = bytearray()
+    states, steps = array("I"), array("I")
+    extraction_rows, lemma_rows = array("I"), array("I")
+    lemma_keys, step_keys = list[tuple[str, int]](), list[tuple[str, int]]()
+    seen_lemma_keys, seen_step_keys = set[str](), set[str]()
+
+    def intern(s: str) -> int:
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings)
+            string_bytes.extend(s.encode("utf-8"))
+            string_offsets.append(len(string_bytes))
+        return i
+
+    for extraction in extractions:
+        start = len(states)
+        spans = dict[str, tuple[int, int]]()  # Normalized lemma statement -> span.
+        span_statement, span_start = "", start
+        for proof_state, proof_step in extraction.translations:
+            if proof_state == "":
+                if span_statement:
+                    spans.setdefault(span_statement, (span_start, len(states)))
+                span_statement, span_start = normalize_whitespace(proof_step), len(states)
+            else:
+                key = normalize_goals(proof_state)
+                if key not in seen_step_keys:
+                    seen_step_keys.add(key)
+                    step_keys.append((key, len(states)))
+            states.append(intern(proof_state))
+            steps.append(intern(proof_step))
+        if span_statement:
+            spans.setdefault(span_statement, (span_start, len(states)))
+
+        lemmas_start = len(lemma_rows) // _LEMMA_FIELDS
+        for statement in extraction.lemma_statements:
+            span = spans.get(normalize_whitespace(statement), (len(states), len(states)))
+            key = _lemma_key(extraction.thy_file, statement)
+            if key not in seen_lemma_keys:
+                seen_lemma_keys.add(key)
+                lemma_keys.append((key, len(lemma_rows) // _LEMMA_FIELDS))
+            extraction_index = len(extraction_rows) // _EXTRACTION_FIELDS
+            lemma_rows.extend([extraction_index, intern(statement), *span])
+        extraction_rows.extend(
+            [
+                intern(str(extraction.thy_file)),
+                intern(str(extraction.working_directory)),
+                start,
+                len(states),
+                lemmas_start,
+                len(lemma_rows) // _LEMMA_FIELDS,
+            ]
+        )
+
+    lemma_table, step_table = _hash_table(lemma_keys), _hash_table(step_keys)
+    with open(path, "wb") as f:
+        f.write(
+            _HEADER.pack(
+                _MAGIC,
+                len(strings),
+                len(string_bytes),
+                len(states),
+                len(extraction_rows) // _EXTRACTION_FIELDS,
+                len(lemma_rows) // _LEMMA_FIELDS,
+                len(lemma_table),
+                len(step_table),
+            )
+        )
+        sections: list[array[int] | bytearray] = [
+            string_offsets,
+            string_bytes,
+            states,
+            steps,
+            extraction_rows,
+            lemma_rows,
+            lemma_table,
+            step_table,
+        ]
+        for section in sections:
+            _write_padded(f, section)
+
+
+def _lemma_key(thy_file: Path, lemma_statement: str) -> str:
+    return str(thy_file) + "\0" + normalize_whitespace(lemma_statement)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _hash_table(items: list[tuple[str, int]]) -> array[int]:
+    """Open-addressing hash table with linear probing, at most half full, values stored +1."""
+    size = 1
+    while size < 2 * len(items):
+        size *= 2
+    table = array("I", bytes(4 * size))
+    mask = size - 1
+    for key, value in items:
+        slot = _hash(key) & mask
+        while table[slot] != 0:
+            slot = (slot + 1) & mask
+        table[slot] = value + 1
+    return table
+
+
+def _padded(size: int) -> int:
+    """Sections are 8-byte aligned."""
+    return (size + 7) // 8 * 8
+
+
+def _write_padded(f: BinaryIO, data: array[int] | bytearray) -> None:
+    size = len(data) * (data.itemsize if isinstance(data, array) else 1)
+    f.write(data)
+    f.write(bytes(_padded(size) - size))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Compile extraction .json files.")
+    build_parser.add_argument("extractions_dir", type=Path)
+    build_parser.add_argument("output_file", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_extraction_store(iter_extractions(args.extractions_dir), args.output_file)
+        with ExtractionStore(args.output_file) as store:
+            print(
+                f"{store.n_extractions} extractions, {store.n_lemmas} lemmas, "
+                f"{store.n_translations} translations, {args.output_file.stat().st_size} bytes."
+            )
+
+
+if __name__ == "__main__":
+    main()
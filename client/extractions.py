@@ -1,6 +1,11 @@
+from __future__ import annotations
+
 import json
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
 
 @dataclass
@@ -21,6 +26,63 @@ def load_extractions(afp_extractions_dir: Path) -> list[Extraction]:
     return list(_load_extraction(p) for p in afp_extractions_dir.glob("**/*.json"))
 
 
+def iter_extractions(
+    afp_extractions_dir: Path,
+    thy_files: Optional[Iterable[Path]] = None,
+    working_directories: Optional[Iterable[Path]] = None,
+    max_workers: Optional[int] = None,
+    max_pending: int = 64,
+) -> Iterator[Extraction]:
+    """
+    Parse extraction files in a process pool, yielding them as they complete (in any order).
+
+    Args:
+    - afp_extractions_dir: directory searched for "**/*.json" files.
+    - thy_files: if given, only yield extractions of these theory files (relative to
+        "/afp/thys/", like "Valuation/Valuation1.thy").
+    - working_directories: if given, only yield extractions from these directories (like
+        "Valuation").
+    - max_workers: number of worker processes (None means the number of CPUs).
+    - max_pending: maximum number of files submitted and not yet yielded, to bound memory use
+        when the consumer is slower than the workers.
+
+    Filtering happens in the workers, so extractions that are filtered out are never sent back.
+    """
+    thy_file_set = None if thy_files is None else frozenset(thy_files)
+    work_dir_set = None if working_directories is None else frozenset(working_directories)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set[Future[Optional[Extraction]]]()
+        for path in sorted(afp_extractions_dir.glob("**/*.json")):
+            pending.add(executor.submit(_load_filtered, path, thy_file_set, work_dir_set))
+            if len(pending) < max_pending:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _results(done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _results(done)
+
+
+def _results(futures: Iterable[Future[Optional[Extraction]]]) -> Iterator[Extraction]:
+    for future in futures:
+        extraction = future.result()  # Re-raises AssertionErrors from the worker.
+        if extraction is not None:
+            yield extraction
+
+
+def _load_filtered(
+    afp_extraction_file: Path,
+    thy_files: Optional[frozenset[Path]],
+    working_directories: Optional[frozenset[Path]],
+) -> Optional[Extraction]:
+    extraction = _load_extraction(afp_extraction_file)
+    if thy_files is not None and extraction.thy_file not in thy_files:
+        return None
+    if working_directories is not None and extraction.working_directory not in working_directories:
+        return None
+    return extraction
+
+
 def _load_extraction(afp_extraction_file: Path) -> Extraction:
     with open(afp_extraction_file) as f:
         o = json.load(f)
@@ -0,0 +1,168 @@
+"""Offline index of lemma statements in AFP theories, to validate test cases without a server.
+
+The server finds a lemma by parsing its theory (see `/locateLemma`), which needs an Isabelle
+session with the theory's imports. Here we only scan theory files as text: each statement
+(a line starting with "lemma", "theorem", ...) is indexed by its first two words, and a lookup
+checks that the file really contains the whole statement there (ignoring whitespace, like the
+server). This catches missing files and lemmas (the "no-such-file" and "not-found" exception
+kinds) in bulk, before spending sessions on them.
+
+Build with `python -m client.lemma_index build AFP_THYS_DIR OUTPUT_FILE`.
+"""
+from __future__ import annotations
+
+import argparse
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from .test_cases import TestCase
+from .transport import json_dumps, json_loads
+from .utils import normalize_whitespace
+
+_STATEMENT_START = re.compile(
+    r"^[ \t]*(?:lemma|theorem|corollary|proposition|schematic_goal|lemmas)\b", re.MULTILINE
+)
+
+
+@dataclass(frozen=True)
+class LemmaLocation:
+    thy_file: Path  # Relative to the thys directory, like "Valuation/Valuation1.thy".
+    line: int  # Line where the statement starts (1-based).
+
+
+class LemmaIndex:
+    """An index from lemma statements to their locations in theory files.
+
+    Lookups read the candidate theory files (relative to thys_dir) to check the whole statement,
+    keeping the last few in memory.
+    """
+
+    def __init__(self, thys_dir: Path, entries: dict[str, list[tuple[str, int, int]]]):
+        """entries maps statement keys (see `_key`) to (thy_file, char offset, line) triples."""
+        self.thys_dir = thys_dir
+        self.entries = entries
+        self._texts = dict[Path, Optional[str]]()
+
+    @classmethod
+    def build(cls, thys_dir: Path, thy_files: Optional[Iterable[Path]] = None) -> LemmaIndex:
+        """Index all .thy files in thys_dir, or only the given ones (relative to thys_dir)."""
+        entries = defaultdict[str, list[tuple[str, int, int]]](list)
+        if thy_files is None:
+            paths = sorted(thys_dir.glob("**/*.thy"))
+        else:
+            paths = sorted(p for p in {thys_dir / f for f in thy_files} if p.exists())
+        for path in paths:
+            thy_file = str(path.relative_to(thys_dir))
+            text = path.read_text(errors="replace")
+            line, line_offset = 1, 0
+            for match in _STATEMENT_START.finditer(text):
+                start = match.end() - len(match.group().lstrip())
+                line += text.count("\n", line_offset, start)
+                line_offset = start
+                entries[_key(text[start : start + 1000])].append((thy_file, start, line))
+        return cls(thys_dir, dict(entries))
+
+    @classmethod
+    def load(cls, path: Path, thys_dir: Path) -> LemmaIndex:
+        entries = json_loads(path.read_bytes())
+        return cls(thys_dir, {k: [(f, o, n) for f, o, n in v] for k, v in entries.items()})
+
+    def save(self, path: Path) -> None:
+        path.write_bytes(json_dumps(self.entries))
+
+    def find(self, lemma_statement: str) -> list[LemmaLocation]:
+        """All locations of a statement (whitespace is ignored when comparing)."""
+        statement = normalize_whitespace(lemma_statement)
+        return [
+            LemmaLocation(Path(thy_file), line)
+            for thy_file, offset, line in self.entries.get(_key(statement), [])
+            if self._matches(Path(thy_file), offset, statement)
+        ]
+
+    def locate(self, thy_file: Path, lemma_statement: str) -> Optional[LemmaLocation]:
+        """The first location of a statement in a given theory file, if any."""
+        statement = normalize_whitespace(lemma_statement)
+        for f, offset, line in self.entries.get(_key(statement), []):
+            if Path(f) == thy_file and self._matches(thy_file, offset, statement):
+                return LemmaLocation(thy_file, line)
+        return None
+
+    def exists(self, thy_file: Path) -> bool:
+        return self._text(thy_file) is not None
+
+    def _matches(self, thy_file: Path, offset: int, statement: str) -> bool:
+        """Whether the file contains the (normalized) statement at a given offset."""
+        text = self._text(thy_file)
+        if text is None:
+            return False
+        # Normalizing only shrinks text, so take raw chunks until we have enough.
+        size = len(statement) + 1
+        while True:
+            chunk = normalize_whitespace(text[offset : offset + size])
+            if len(chunk) > len(statement) or offset + size >= len(text):
+                break
+            size *= 2
+        if not chunk.startswith(statement):
+            return False
+        # The statement must end where a word ends.
+        rest = chunk[len(statement) :]
+        return not rest or not (rest[0].isalnum() and statement[-1].isalnum())
+
+    def _text(self, thy_file: Path) -> Optional[str]:
+        if thy_file not in self._texts:
+            if len(self._texts) >= 16:
+                del self._texts[next(iter(self._texts))]
+            path = self.thys_dir / thy_file
+            self._texts[thy_file] = path.read_text(errors="replace") if path.exists() else None
+        return self._texts[thy_file]
+
+
+def validate_test_cases(
+    tests: list[TestCase], index: LemmaIndex
+) -> tuple[list[TestCase], dict[str, list[TestCase]]]:
+    """
+    Split test cases into those that can be loaded, and those that can't.
+
+    Returns (valid_tests, invalid_tests), where invalid_tests maps the exception kind loading them
+    would give ("no-such-file" or "not-found", see `get_exception_kind`) to test cases.
+    """
+    valid = list[TestCase]()
+    invalid = defaultdict[str, list[TestCase]](list)
+    # Sorting by file makes the index read each file once.
+    for test in sorted(tests, key=lambda t: t.thy_file):
+        if not index.exists(test.thy_file):
+            invalid["no-such-file"].append(test)
+        elif index.locate(test.thy_file, test.lemma_statement) is None:
+            invalid["not-found"].append(test)
+        else:
+            valid.append(test)
+    valid_ids = {id(t) for t in valid}
+    return [t for t in tests if id(t) in valid_ids], dict(invalid)
+
+
+def _key(statement: str) -> str:
+    """First two words of a statement, like "lemma foo:" or 'lemma "x'."""
+    return " ".join(statement.split(maxsplit=2)[:2])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Index all .thy files in a directory.")
+    build_parser.add_argument("thys_dir", type=Path)
+    build_parser.add_argument("output_file", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = LemmaIndex.build(args.thys_dir)
+        index.save(args.output_file)
+        n_statements = sum(len(v) for v in index.entries.values())
+        print(f"Indexed {n_statements} statements.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,166 @@
+"""Evaluating models on PISA test suites with QIsabelle servers, and examples of the API.
+
+Run as `python -m client.main run --suite quick --ports 17000 17001 --results results.jsonl`.
+To split a suite over several machines, run with `--shard i/n` on machine i (0 <= i < n), each with
+its own results file (see `shards.py`), then `python -m client.main merge OUTPUT RESULTS_FILE...`.
+"""
+import argparse
+import contextlib
+import io
 import os
-import textwrap
+import sys
+import threading
 import time
-from collections import defaultdict
+from collections.abc import Callable, Iterator
 from pathlib import Path
+from queue import Empty, Queue
+from typing import Optional, TextIO
 
+from .budget import TIMEOUT_KINDS, Budget, BudgetScheduler
+from .cache import ResultCache
+from .extraction_store import ExtractionStore, KnownNextStepModel
+from .lemma_index import LemmaIndex, validate_test_cases
 from .model import DummyHammerModel, Model
+from .results import ResultsLog, TestResult, load_results, merge_results, report, summarize
+from .router import ReplicaRouter
 from .session import QIsabelleSession, get_exception_kind
-from .test_cases import TestCase, load_quick_test_cases
-from .utils import read_env_dict
+from .session_manager import SessionManager, group_by_session
+from .shards import parse_shard, shard_tests
+from .test_cases import TestCase, load_all_test_cases, load_quick_test_cases
+from .timing import Timings
+from .utils import header, indent, read_env_dict
+
+
+LEMMA_STATE_NAME = "s"  # The state run_model_greedily loads the lemma under.
+ROOT_DIR = Path(__file__).parent.parent
 
 
 def main() -> None:
-    # test_new_theory()
-    # test_going_into_theory()
-    # test_pisa()
-    test_complex()
-    # test_from_start()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Evaluate a model on a test suite.")
+    run_parser.add_argument("--suite", choices=["quick", "all"], default="quick")
+    run_parser.add_argument(
+        "--test-dir", type=Path, default=ROOT_DIR / "test_theorems" / "PISA", help="PISA tests."
+    )
+    run_parser.add_argument("--model", choices=["hammer", "known-step"], default="hammer")
+    run_parser.add_argument(
+        "--extraction-store", type=Path, help="For the known-step model (see extraction_store.py)."
+    )
+    run_parser.add_argument("--ports", type=int, nargs="+", default=[17000])
+    run_parser.add_argument("--total-time", type=float, help="Seconds for the whole run.")
+    run_parser.add_argument("--results", type=Path, help="Append results to this file.")
+    run_parser.add_argument("--resume", action="store_true", help="Skip tests in --results.")
+    run_parser.add_argument("--shard", type=parse_shard, help="Only run shard i/n of the tests.")
+    run_parser.add_argument(
+        "--costs",
+        type=Path,
+        nargs="+",
+        default=[],
+        help="Results files of previous runs, to balance shards by test duration.",
+    )
+    run_parser.add_argument("--cache", type=Path, help="Cache server results in this file.")
+    run_parser.add_argument("--trace", type=Path, help="Export timings to this file.")
+    run_parser.add_argument("--prefetch", action="store_true", help="Prefetch next sessions.")
+    run_parser.add_argument(
+        "--failover", action="store_true", help="Route sessions to healthy replicas, fail over."
+    )
+    run_parser.add_argument(
+        "--no-validate", action="store_true", help="Don't skip tests missing from our AFP."
+    )
+    merge_parser = subparsers.add_parser("merge", help="Merge results files (e.g. of shards).")
+    merge_parser.add_argument("output", type=Path)
+    merge_parser.add_argument("results_files", type=Path, nargs="+")
+    example_parser = subparsers.add_parser("example", help="Run an example of the API.")
+    example_parser.add_argument("name", choices=sorted(EXAMPLES))
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+    elif args.command == "merge":
+        n = merge_results(args.results_files, args.output)
+        print(f"Wrote {n} results to {args.output}.")
+        print(report([args.output]))
+    elif args.command == "example":
+        EXAMPLES[args.name]()
+
+
+def run(args: argparse.Namespace) -> None:
+    """The `run` command, see `main()`."""
+    tests = load_suite(args.suite, args.test_dir)
+    print(f"Loaded {len(tests)} tests.")
+    if args.shard is not None:
+        # Shard before validating, so that all machines agree regardless of their AFP.
+        shard, n_shards = args.shard
+        tests = shard_tests(tests, shard, n_shards, load_results(args.costs))
+        print(f"Shard {shard}/{n_shards}: {len(tests)} tests.")
+    skipped = list[TestResult]()
+    if not args.no_validate:
+        tests, skipped = skip_invalid_tests(tests)
+
+    with contextlib.ExitStack() as stack:
+        model: Model
+        if args.model == "known-step":
+            assert args.extraction_store, "The known-step model needs --extraction-store."
+            model = KnownNextStepModel(stack.enter_context(ExtractionStore(args.extraction_store)))
+        else:
+            model = DummyHammerModel()
+        cache = None
+        if args.cache is not None:
+            cache = ResultCache(args.cache)
+            stack.callback(cache.close)
+        evaluate_model(
+            model,
+            tests,
+            skipped=skipped,
+            ports=args.ports,
+            cache=cache,
+            trace_path=args.trace,
+            results_path=args.results,
+            resume=args.resume,
+            total_time=args.total_time,
+            prefetch=args.prefetch,
+            failover=args.failover,
+        )
+
+
+def load_suite(suite: str, test_dir: Path = ROOT_DIR / "test_theorems" / "PISA") -> list[TestCase]:
+    """Load the PISA test cases of a suite: "quick" (600 tests) or "all" (3600 tests)."""
+    print("Loading tests from", test_dir)
+    if suite == "quick":
+        return load_quick_test_cases(test_dir)
+    elif suite == "all":
+        return load_all_test_cases(test_dir)
+    else:
+        raise ValueError(f"Unknown test suite: {suite}")
+
+
+def skip_invalid_tests(tests: list[TestCase]) -> tuple[list[TestCase], list[TestResult]]:
+    """Skip tests whose theory file or lemma is not in our AFP version (see `lemma_index.py`).
+
+    Returns the tests to run, and results for the skipped ones, of the kind loading them would give
+    ("no-such-file" or "not-found"), so that they are still recorded and counted (see
+    `evaluate_model`).
+    This needs a local copy of the AFP (AFP_DIR in `.env`); without one, no test is skipped (tests
+    that can't be loaded then fail on the server, as usual).
+    """
+    env_file = ROOT_DIR / ".env"
+    environment = (read_env_dict(env_file) if env_file.is_file() else {}) | os.environ
+    afp_dir = ROOT_DIR / environment.get("AFP_DIR", "")  # Relative to ROOT_DIR, unless absolute.
+    if "AFP_DIR" not in environment or not (afp_dir / "thys").is_dir():
+        print(f"Warning: no local AFP (AFP_DIR={afp_dir}), not validating tests.")
+        return tests, []
+    index = LemmaIndex.build(afp_dir / "thys", thy_files=[test.thy_file for test in tests])
+    tests, invalid_tests = validate_test_cases(tests, index)
+    skipped = list[TestResult]()
+    for kind, invalid in invalid_tests.items():
+        print(f"Skipping {len(invalid)} tests ({kind}):", ", ".join(t.name for t in invalid))
+        error = f"Skipped, {kind} in the local AFP ({afp_dir})"
+        for test in invalid:
+            result = TestResult(test.name, str(test.thy_file), kind, error=error)
+            result.finish_time = time.time()
+            skipped.append(result)
+    return tests, skipped
 
 
 def test_new_theory() -> None:
@@ -121,63 +266,252 @@ def test_from_start() -> None:
         )
         print(session.describe_state("state0"))
 
-def test_pisa() -> None:
+def test_pisa(results_path: Optional[Path] = None, resume: bool = False) -> None:
     """Run the 600 'quick' tests from PISA on a model that just uses Sledgehammer at every step.
 
-    This takes hours on a powerful server.
+    This takes hours on a powerful server. Pass a results_path to record results as they finish,
+    and resume=True to continue an interrupted run from it (see `evaluate_model`).
 
     Currently on default settings the results for this model are roughly:
     * success: 179
     * timeout-soft: 118, timeout-mid: 1, timeout-hard: 283 (hammer timeouts)
     * execution-timeout: 6 (proof, or theory up to lemma statement, takes too long to execute)
     * failed-proof: 1 (proof given by hammer fails)
-    * not_found: 10, no_such_file: 1  (test extracted from a different version of AFP than we have).
+    * not_found: 10, no_such_file: 1  (test extracted from a different version of AFP than we have);
+      these are now found upfront (see `lemma_index.py`), and recorded without running them.
 
     With larger hammer timeouts (60s) we can get to ~203 successes, so this varies with computing power.
+    Same as `python -m client.main run --suite quick`.
     """
-    ROOT_DIR = Path(__file__).parent.parent
-    ENVIRONMENT = read_env_dict(ROOT_DIR / ".env") | os.environ
-    AFP_DIR = Path(ENVIRONMENT["AFP_DIR"])
-    if not AFP_DIR.is_absolute():
-        AFP_DIR = ROOT_DIR / AFP_DIR
-
-    test_dir = ROOT_DIR / "test_theorems" / "PISA"
-    print("Loading tests from", test_dir)
-    tests = load_quick_test_cases(test_dir)
+    tests = load_suite("quick")
     print(f"Loaded {len(tests)} tests.")
+    tests, skipped = skip_invalid_tests(tests)
+    evaluate_model(
+        DummyHammerModel(), tests, skipped=skipped, results_path=results_path, resume=resume
+    )
 
-    # Warn about theory files not in tests but not in our AFP version.
-    for test in tests:
-        thy_file = AFP_DIR / "thys" / test.thy_file
-        if not thy_file.exists():
-            print(f"Warning ({test.name}): no such theory file: {thy_file}")
 
-    evaluate_model(DummyHammerModel(), tests)
+EXAMPLES: dict[str, Callable[[], None]] = {
+    "new-theory": test_new_theory,
+    "going-into-theory": test_going_into_theory,
+    "complex": test_complex,
+    "from-start": test_from_start,
+    "pisa": test_pisa,
+}
 
 
-def evaluate_model(model: Model, tests: list[TestCase]) -> None:
-    summary: dict[str, int] = defaultdict(int)
-    for i, test_case in enumerate(tests):
-        print(header(f"Test case {test_case.name}, thy file: {test_case.thy_file}"))
-        print(header("Lemma statement"))
-        print(indent(test_case.lemma_statement))
+def evaluate_model(
+    model: Model,
+    tests: list[TestCase],
+    skipped: list[TestResult] = [],
+    ports: list[int] = [17000],
+    cache: Optional[ResultCache] = None,
+    trace_path: Optional[Path] = None,
+    results_path: Optional[Path] = None,
+    resume: bool = False,
+    total_time: Optional[float] = None,
+    prefetch: bool = False,
+    failover: bool = False,
+) -> None:
+    """
+    Evaluate a model on test cases, with one worker per server replica.
 
-        theory_path = Path("/afp/thys") / test_case.thy_file
-        try:
-            print(header("Server init"))
-            with QIsabelleSession(theory_path=theory_path) as session:
-                r = run_model_greedily(model, theory_path, test_case.lemma_statement, session)
-            result = "success" if r else "failure"
-        except Exception as e:
-            print(header("Exception"))
-            print(indent(str(e)))
-            result = get_exception_kind(e)
+    Test cases are grouped by the Isabelle session they need (see `group_by_session`).
+    Each worker has its own SessionManager on its port and pulls groups from a shared queue,
+    so a session is opened once per group and reused (with states forgotten) between its tests.
+    With more than one port, the output of each test case is buffered and printed at once
+    when it finishes (so the model must be safe to call from several threads; wrap it in a
+    `BatchingModel` to batch the calls of concurrent workers).
 
-        summary[result] += 1
-        print(header(result, "$"))
-        print(f"Did {i + 1} / {len(tests)} tests so far:", dict(summary.items()))
-        print("\n\n\n")
-    print(f"Finished evaluation. Results:\n    {dict(summary.items())} / {len(tests)}")
+    Args:
+    - model
+    - tests: test cases to run.
+    - skipped: results of test cases not to run (see `skip_invalid_tests`); they are recorded and
+      counted like the others.
+    - ports: ports of server replicas to use (see `docker-compose.yaml`).
+    - cache: if given, results of load_theory, execute and hammer are cached in it
+      (see `CachedQIsabelleSession`), so reruns mostly come from cache.
+    - trace_path: if given, timings of all requests and model calls are exported there
+      (as JSONL if it ends with ".jsonl", else as a Chrome trace; see `timing.py`).
+    - results_path: if given, the result of each test case is appended there as it finishes
+      (see `results.py`).
+    - resume: skip test cases already recorded in results_path, and count them in the summary.
+    - total_time: if given, wall-clock seconds for the whole evaluation; tests then get search
+      time and hammer timeout budgets from a `BudgetScheduler`, which retries tests that time out
+      if time remains (including those recorded in results_path, when resuming).
+    - prefetch: while a test runs, open the session of the worker's next test and load its lemma
+      in the background, on the same replica (see `SessionManager`; needs QISABELLE_MAX_SESSIONS
+      of at least 2 on the servers).
+    - failover: workers open sessions on the least loaded healthy replica instead of their own,
+      and move to another replica (replaying the proof so far) if theirs dies (see `router.py`;
+      can't be used with a cache).
+    """
+    results = dict[str, TestResult]()  # Latest result of each test case.
+    priors = dict[str, TestResult]()
+    if resume:
+        assert results_path is not None, "Resuming needs a results_path."
+        priors = load_results([results_path])
+        for test in tests:
+            prior = priors.get(test.name)
+            # With a time budget, tests that timed out are retried (with larger budgets).
+            if prior and (total_time is None or prior.kind not in TIMEOUT_KINDS):
+                results[test.name] = prior
+        tests = [t for t in tests if t.name not in results]
+        print(f"Resuming: skipping {len(results)} tests already in {results_path}.")
+    results_log = None if results_path is None else ResultsLog(results_path)
+    for result in skipped:
+        if result.name in priors:
+            result = priors[result.name]  # Already recorded.
+        elif results_log is not None:
+            results_log.append(result)
+        results[result.name] = result
+    n_total = len(tests) + len(results)
+    timings = Timings()
+    queue: Queue[list[TestCase]] = Queue()
+    groups = group_by_session(tests)
+    for group in groups:
+        queue.put(group)
+    scheduler: Optional[BudgetScheduler] = None
+    if total_time is not None:
+        ordered_tests = [test for group in groups for test in group]
+        scheduler = BudgetScheduler(ordered_tests, total_time, len(ports), priors=priors)
+    lock = threading.Lock()
+    router = ReplicaRouter(ports) if failover else None
+
+    # Tests to run with their budget, and the test likely to come next (to prefetch its session).
+    def queued_tests() -> Iterator[tuple[TestCase, Optional[Budget], Optional[TestCase]]]:
+        while True:
+            try:
+                group = queue.get_nowait()
+            except Empty:
+                return
+            for i, test_case in enumerate(group):
+                if i + 1 < len(group):
+                    yield test_case, None, group[i + 1]
+                    continue
+                with queue.mutex:  # Peek at the next group (another worker may take it).
+                    next_test = queue.queue[0][0] if queue.queue else None
+                yield test_case, None, next_test
+
+    def scheduled_tests() -> Iterator[tuple[TestCase, Optional[Budget], Optional[TestCase]]]:
+        assert scheduler is not None
+        while (item := scheduler.next()) is not None:
+            yield *item, scheduler.peek()
+
+    def worker(port: int) -> None:
+        debug = len(ports) == 1
+        with SessionManager(port, debug, cache, prefetch, router) as sessions:
+            tests = scheduled_tests() if scheduler else queued_tests()
+            for test_case, budget, next_test in tests:
+                out = None if len(ports) == 1 else io.StringIO()
+                test_timings = Timings(test_case.name)
+                if budget is not None:
+                    print(header(f"Budget {budget}"), file=out)
+                result = evaluate_test_case(
+                    model,
+                    test_case,
+                    sessions,
+                    out,
+                    test_timings,
+                    max_proof_search_time=budget.search_time if budget else 500.0,
+                    hammer_timeout=budget.hammer_timeout if budget else 0.0,
+                    next_test=next_test,
+                )
+                if scheduler is not None and budget is not None:
+                    scheduler.report(test_case, budget, result)
+                print(header("Timings"), file=out)
+                print(indent(test_timings.table()), file=out)
+                timings.extend(test_timings)
+                if results_log is not None:
+                    results_log.append(result)
+                with lock:
+                    results[test_case.name] = result
+                    summary = summarize(results.values())
+                    if out is not None:
+                        print(out.getvalue(), end="")
+                    print(header(result.kind, "$"))
+                    print(f"Did {len(results)} / {n_total} tests so far:", summary)
+                    print("\n\n\n")
+                    sys.stdout.flush()
+
+    workers = [threading.Thread(target=worker, args=(port,), name=f"port-{port}") for port in ports]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if results_log is not None:
+        results_log.close()
+    print(header("Timings"))
+    print(timings.table())
+    if trace_path is not None:
+        timings.export(trace_path)
+        print("Trace written to", trace_path)
+    print(f"Finished evaluation. Results:\n    {summarize(results.values())} / {n_total}")
+    if cache is not None:
+        print("Cache:", cache.stats())
+
+
+def evaluate_test_case(
+    model: Model,
+    test_case: TestCase,
+    sessions: SessionManager,
+    out: Optional[TextIO] = None,
+    timings: Optional[Timings] = None,
+    max_proof_search_time: float = 500.0,
+    hammer_timeout: float = 0.0,
+    next_test: Optional[TestCase] = None,
+) -> TestResult:
+    """
+    Run a model on a single test case; return its result.
+
+    The result kind is "success", "failure", or an exception kind (see `get_exception_kind`).
+
+    Args:
+    - model
+    - test_case
+    - sessions: gives a session for the test's theory (reused if possible).
+    - out: where to print output (None means sys.stdout).
+    - timings: where to record timings of the test's requests and model calls.
+    - max_proof_search_time, hammer_timeout: see `run_model_greedily`.
+    - next_test: if given, its session is prefetched (if enabled in sessions) during this test.
+    """
+    timings = timings or Timings(test_case.name)
+    print(header(f"Test case {test_case.name}, thy file: {test_case.thy_file}"), file=out)
+    print(header("Lemma statement"), file=out)
+    print(indent(test_case.lemma_statement), file=out)
+
+    theory_path = Path("/afp/thys") / test_case.thy_file
+    result = TestResult(test_case.name, str(test_case.thy_file), "failure")
+    result.search_time, result.hammer_timeout = max_proof_search_time, hammer_timeout
+    start = time.time()
+    try:
+        print(header("Server init"), file=out)
+        with timings.span("session"):
+            session = sessions.get(theory_path)
+        session.timings = timings
+        if next_test is not None:
+            next_path = Path("/afp/thys") / next_test.thy_file
+            sessions.prefetch(next_path, next_test.lemma_statement, LEMMA_STATE_NAME)
+        result.proof = run_model_greedily(
+            model,
+            theory_path,
+            test_case.lemma_statement,
+            session,
+            max_proof_search_time,
+            hammer_timeout,
+            out,
+        )
+        if result.proof is not None:
+            result.kind = "success"
+    except Exception as e:
+        print(header("Exception"), file=out)
+        print(indent(str(e)), file=out)
+        result.kind = get_exception_kind(e)
+        result.error = str(e)
+    result.finish_time = time.time()
+    result.duration = result.finish_time - start
+    result.timings = {name: s["total_s"] for name, s in timings.summary().items()}
+    return result
 
 
 def run_model_greedily(
@@ -186,62 +520,62 @@ def run_model_greedily(
     lemma_statement: str,
     session: QIsabelleSession,
     max_proof_search_time: float = 500.0,
-) -> bool:
+    hammer_timeout: float = 0.0,
+    out: Optional[TextIO] = None,
+) -> Optional[list[str]]:
     """
     Run a model greedily, until it finds a proof, runs out of time, or fails to change the state.
 
+    Returns the proof steps found (after the lemma statement), or None if the model gave up.
+    Raises TimeoutError "Proof search timeout" if it runs out of time.
+
     Args:
     - model
     - theory_path: path to .thy file in server.
     - lemma_statement: statement of lemma to prove (should appear in the theory file).
     - session: QIsabelleSession initialized with a session containing the theory (or all its imports).
     - max_proof_search_time: float seconds, maximum time to search for a proof.
+    - hammer_timeout: soft timeout of each hammer call in seconds (0 means the server's default).
+    - out: where to print output (None means sys.stdout).
     """
-    print(" Load theory ".center(100, "%"))
-    state_name = "s"
+    print(" Load theory ".center(100, "%"), file=out)
+    state_name = LEMMA_STATE_NAME
     prev_proof_step = lemma_statement
     is_proof_done, proof_goals = session.load_theory(theory_path, lemma_statement, True, state_name)
     assert not is_proof_done
+    proof = list[str]()
 
     end_time = time.time() + max_proof_search_time
     while time.time() < end_time:
-        print(header("Proof state"))
-        print(indent(proof_goals))
+        print(header("Proof state"), file=out)
+        print(indent(proof_goals), file=out)
 
-        generated_steps = model(prev_proof_step, proof_goals)
+        with session.timings.span("model"):
+            generated_steps = model(prev_proof_step, proof_goals)
         if not generated_steps:
-            return False
+            return None
         proof_step, subscore = generated_steps[0]
-        print(header(f"Model gave (with {subscore=})"))
-        print(indent(proof_step))
+        print(header(f"Model gave (with {subscore=})"), file=out)
+        print(indent(proof_step), file=out)
         new_state_name = f"{state_name}.0"
 
         if proof_step.strip() == "normalhammer":
-            proof_step = session.hammer(state_name)
-            print(header("Hammer gave"))
-            print(indent(proof_step))
-        is_proof_done, new_proof_state = session.execute(state_name, proof_step, new_state_name)
+            proof_step = session.hammer(state_name, timeout=hammer_timeout)
+            print(header("Hammer gave"), file=out)
+            print(indent(proof_step), file=out)
+        is_proof_done, proof_goals = session.execute(state_name, proof_step, new_state_name)
 
-        if new_proof_state == proof_goals:
-            print("Proof state unchanged :(")
-            return False
+        if session.proof_state_hash(new_state_name) == session.proof_state_hash(state_name):
+            print("Proof state unchanged :(", file=out)
+            return None
 
+        proof.append(proof_step)
         if is_proof_done:
-            return True
+            return proof
         prev_proof_step = proof_step
         state_name = new_state_name
 
-    return False
-
-
-def indent(text: str, indentation: str = "\t") -> str:
-    """Indend text with tabs, strip the final newline."""
-    return textwrap.indent(text.strip(), indentation)
-
-
-def header(title: str, fill_char: str = "%") -> str:
-    """Center a string in % chars."""
-    return (" " + title + " ").center(100, fill_char)
+    raise TimeoutError(f"Proof search timeout after {max_proof_search_time:.1f}s")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,486 @@
+"""A local stand-in for the QIsabelle server, for testing clients without Isabelle.
+
+It implements the JSON API of `server/src/QIsabelleServer.scala` with fake semantics:
+- loadTheory gives a proof state with one goal, the lemma statement;
+- execute proves the goal with "by ...", "done", "qed" or "sorry", fails on steps containing
+  "fail", leaves the state unchanged on "-", and otherwise appends the step to the goal;
+- hammer proves anything with "by auto" (hammer jobs take the "/hammer" latency to finish),
+  unless the goal is too difficult for the call's timeout (see `MockConfig.hammer_difficulty`).
+Latencies, payload sizes and error rates are configurable, see `MockConfig`.
+Like the server, it sends goals in the requested goals mode, gzips large responses, and keeps
+states per client session (closing least recently used sessions beyond `MockConfig.max_sessions`).
+Shared sessions skip the open latency if a session with the same Isabelle process is open
+(theories in the same directory are taken to be in the same Isabelle session).
+
+Run as `python -m client.mock_server --port 17000`.
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from typing_extensions import Self
+
+from .proof_goals import GOALS_MODES, goals_json
+from .transport import JSON, SERVER_TIME_HEADER, json_dumps, json_loads
+
+
+@dataclass
+class MockConfig:
+    latency: dict[str, float] = field(default_factory=dict)  # Seconds per endpoint, like "/hammer".
+    default_latency: float = 0.0  # Seconds for endpoints not in `latency`.
+    goals_padding: int = 0  # Number of chars added to each proof state, to simulate large goals.
+    execute_error_rate: float = 0.0  # Probability that an execute fails anyway.
+    hammer_error_rate: float = 0.0  # Probability that a hammer call times out.
+    # Maximum seconds hammer needs to prove a goal (each goal needs a fixed pseudo-random fraction
+    # of it); hammer waits that long, or times out if its timeout (default 30s) is shorter.
+    hammer_difficulty: float = 0.0
+    max_concurrent_hammers: int = 2  # Hammer jobs running at once, others are queued.
+    max_sessions: int = 1  # Like QISABELLE_MAX_SESSIONS.
+    seed: int = 0
+
+
+@dataclass
+class _State:
+    mode: str  # "Theory" or "Proof".
+    goals: str  # Like the server's "proofGoals".
+
+
+@dataclass
+class _HammerJob:
+    submit_time: float
+    start_time: float
+    end_time: float
+    result: JSON  # Status once finished: {"status": "success" | "failure", ...}.
+    cancelled: bool = False
+
+
+class MockQIsabelleServer:
+    """A fake QIsabelle server running in a background thread.
+
+    Use as `with MockQIsabelleServer() as server:`, then connect to `server.port`.
+    """
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = "localhost", port: int = 0):
+        """port=0 means any free port."""
+        self.config = config or MockConfig()
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        # States of each open session by id, least recently used session first.
+        self.sessions: OrderedDict[str, dict[str, _State]] = OrderedDict()
+        self.session_processes = dict[str, str]()  # Session id -> key of its Isabelle process.
+        self.closed_sessions = set[str]()
+        self.default_session = ""  # Id of the session opened last ("" once closed).
+        self.n_sessions_opened = 0
+        self.n_requests: dict[str, int] = {}
+        self.n_active_requests = 0
+        self.hammer_jobs: dict[str, _HammerJob] = {}
+        self.hammer_slots = [0.0] * self.config.max_concurrent_hammers  # When each slot is free.
+        self.http = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.http.daemon_threads = True
+        self.port: int = self.http.server_address[1]
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.http.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.http.shutdown()
+        self.http.server_close()
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.stop()
+
+    def handle(self, path: str, args: JSON) -> JSON:
+        """Handle a POST request to an endpoint, return the JSON response (maybe an error)."""
+        endpoint = self.endpoints()[path]
+        with self.lock:
+            self.n_requests[path] = self.n_requests.get(path, 0) + 1
+        latency = self.config.latency.get(path, self.config.default_latency)
+        if path.startswith("/openIsabelleSession") and args.get("shared"):
+            with self.lock:
+                if _process_key(args) in self.session_processes.values():
+                    latency = 0.0  # Reusing an open Isabelle process.
+        with self.lock:
+            self.n_active_requests += 1
+        try:
+            time.sleep(latency)
+            return endpoint(args)
+        except _MockError as e:
+            return {"error": str(e), "traceback": ""}
+        finally:
+            with self.lock:
+                self.n_active_requests -= 1
+
+    def endpoints(self) -> dict[str, Callable[[JSON], JSON]]:
+        return {
+            "/openIsabelleSession": self.open_isabelle_session,
+            "/openIsabelleSessionForTheory": self.open_isabelle_session,
+            "/closeIsabelleSession": self.close_isabelle_session,
+            "/newTheory": self.new_theory,
+            "/loadTheory": self.load_theory,
+            "/locateLemma": self.locate_lemma,
+            "/describeState": self.describe_state,
+            "/getMode": self.get_mode,
+            "/getTheory": self.get_theory,
+            "/getProofStateDescription": self.get_proof_state_description,
+            "/getProofGoals": self.get_proof_goals,
+            "/execute": self.execute,
+            "/executeMany": self.execute_many,
+            "/executeChain": self.execute_chain,
+            "/forgetState": self.forget_state,
+            "/forgetAllStates": self.forget_all_states,
+            "/hammer": self.hammer,
+            "/hammerAsync": self.hammer_async,
+            "/hammerStatus": self.hammer_status,
+            "/hammerCancel": self.hammer_cancel,
+            "/stats": self.stats,
+        }
+
+    @property
+    def states(self) -> dict[str, _State]:
+        """States of the default session (empty if none)."""
+        with self.lock:
+            return self.sessions.get(self.default_session, {})
+
+    def open_isabelle_session(self, args: JSON) -> JSON:
+        with self.lock:
+            while len(self.sessions) >= self.config.max_sessions:
+                self._close_session(next(iter(self.sessions)))
+            self.n_sessions_opened += 1
+            session_id = f"session-{self.n_sessions_opened}"
+            self.sessions[session_id] = {}
+            self.session_processes[session_id] = _process_key(args)
+            self.default_session = session_id
+        return {"success": "success", "sessionId": session_id}
+
+    def close_isabelle_session(self, args: JSON) -> JSON:
+        with self.lock:
+            session_id = args.get("sessionId", "") or self.default_session
+            if session_id not in self.sessions:
+                return {"error": "Already closed", "traceback": ""}
+            self._close_session(session_id)
+        return {"success": "Closed"}
+
+    def new_theory(self, args: JSON) -> JSON:
+        self._put_state(args, args["newStateName"], _State("Theory", ""))
+        return {"success": "success"}
+
+    def load_theory(self, args: JSON) -> JSON:
+        if not args["theoryPath"].endswith(".thy"):
+            raise _MockError(f"java.nio.file.NoSuchFileException: {args['theoryPath']}")
+        if args["until"] and args["inclusive"] and not args["initOnly"]:
+            state = _State("Proof", self._goals(args["until"]))
+        else:
+            state = _State("Theory", "")
+        mode = self._goals_mode(args)
+        self._put_state(args, args["newStateName"], state)
+        return self._state_json(state, mode, "")
+
+    def locate_lemma(self, args: JSON) -> JSON:
+        if not args["theoryPath"].endswith(".thy"):
+            raise _MockError(f"java.nio.file.NoSuchFileException: {args['theoryPath']}")
+        return {"found": True, "transitionIndex": 1, "transitionCount": 2}
+
+    def describe_state(self, args: JSON) -> JSON:
+        state = self._get_state(args, args["stateName"])
+        return {"description": f"State[mode={state.mode}, proofState='''\n{state.goals}\n''']"}
+
+    def get_mode(self, args: JSON) -> JSON:
+        return {"description": self._get_state(args, args["stateName"]).mode}
+
+    def get_theory(self, args: JSON) -> JSON:
+        self._get_state(args, args["stateName"])
+        return {"description": "theory Mock"}
+
+    def get_proof_state_description(self, args: JSON) -> JSON:
+        return {"description": self._get_state(args, args["stateName"]).goals.strip()}
+
+    def get_proof_goals(self, args: JSON) -> JSON:
+        return self._state_json(self._get_state(args, args["stateName"]), "full", "")
+
+    def execute(self, args: JSON) -> JSON:
+        mode = self._goals_mode(args)
+        parent = self._get_state(args, args["stateName"])
+        state = self._execute(parent, args["isarCode"])
+        self._put_state(args, args["newStateName"], state)
+        return self._state_json(state, mode, parent.goals)
+
+    def execute_many(self, args: JSON) -> JSON:
+        mode = self._goals_mode(args)
+        state = self._get_state(args, args["stateName"])
+        new_state_names = args.get("newStateNames", [])
+        results = list[JSON]()
+        for i, isar_code in enumerate(args["isarCodes"]):
+            try:
+                new_state = self._execute(state, isar_code)
+            except _MockError as e:
+                results.append({"error": str(e), "traceback": ""})
+                continue
+            if i < len(new_state_names) and new_state_names[i]:
+                self._put_state(args, new_state_names[i], new_state)
+            results.append(self._state_json(new_state, mode, state.goals))
+        return {"results": results}
+
+    def execute_chain(self, args: JSON) -> JSON:
+        mode = self._goals_mode(args)
+        state = self._get_state(args, args["stateName"])
+        new_state_names = args.get("newStateNames", [])
+        results = list[JSON]()
+        for i, isar_code in enumerate(args["isarCodes"]):
+            try:
+                new_state = self._execute(state, isar_code)
+            except _MockError as e:
+                results.append({"error": str(e), "traceback": ""})
+                break
+            if i < len(new_state_names) and new_state_names[i]:
+                self._put_state(args, new_state_names[i], new_state)
+            results.append(self._state_json(new_state, mode, state.goals))
+            state = new_state
+        return {"results": results}
+
+    def forget_state(self, args: JSON) -> JSON:
+        with self.lock:
+            self._states(args).pop(args["stateName"], None)
+        return {"success": "success"}
+
+    def forget_all_states(self, args: JSON) -> JSON:
+        with self.lock:
+            self._states(args).clear()
+        return {"success": "success"}
+
+    def hammer(self, args: JSON) -> JSON:
+        duration, result = self._hammer_outcome(args)
+        time.sleep(duration)
+        if result["status"] == "failure":
+            raise _MockError(result["message"])
+        return {"proof": result["proof"]}
+
+    def hammer_async(self, args: JSON) -> JSON:
+        duration, result = self._hammer_outcome(args)
+        now = time.time()
+        duration += self.config.latency.get("/hammer", self.config.default_latency)
+        with self.lock:
+            slot = min(range(len(self.hammer_slots)), key=lambda i: self.hammer_slots[i])
+            start_time = max(now, self.hammer_slots[slot])
+            self.hammer_slots[slot] = start_time + duration
+            job_id = f"hammer-{len(self.hammer_jobs) + 1}"
+            self.hammer_jobs[job_id] = _HammerJob(now, start_time, start_time + duration, result)
+        return {"jobId": job_id}
+
+    def hammer_status(self, args: JSON) -> JSON:
+        job = self._get_hammer_job(args["jobId"])
+        if not job.cancelled:
+            time.sleep(min(max(0.0, job.end_time - time.time()), args.get("waitSeconds", 0.0)))
+        now = time.time()
+        if job.cancelled:
+            result = {"status": "cancelled", "proof": "", "message": ""}
+        elif now >= job.end_time:
+            result = dict(job.result)
+        else:
+            status = "running" if now >= job.start_time else "queued"
+            result = {"status": status, "proof": "", "message": ""}
+        return result | {"elapsed": now - job.submit_time}
+
+    def hammer_cancel(self, args: JSON) -> JSON:
+        job = self._get_hammer_job(args["jobId"])
+        if time.time() < job.end_time:
+            job.cancelled = True
+        return self.hammer_status({"jobId": args["jobId"]})
+
+    def stats(self, args: JSON) -> JSON:
+        with self.lock:
+            session_id = args.get("sessionId", "")
+            n_states = len(self._states(args)) if session_id or self.default_session else 0
+            n_sessions = len(self.sessions)
+            n_processes = len(set(self.session_processes.values()))
+        return {
+            "stateCount": n_states,
+            "pinnedStateCount": 0,
+            "stateCapacity": 2000,
+            "evictionCount": 0,
+            "jvmHeapUsed": 0,
+            "jvmHeapMax": 0,
+            "ml": {},
+            "checkpoints": {},
+            "pendingHammerCount": self._pending_hammer_count(),
+            "sessionCount": n_sessions,
+            "sessionCapacity": self.config.max_sessions,
+            "processCount": n_processes,
+        }
+
+    def health(self) -> JSON:
+        """Like GET /health: status and load, without latency."""
+        with self.lock:
+            return {
+                "status": "ok",
+                "activeRequests": self.n_active_requests,
+                "sessionCount": len(self.sessions),
+                "sessionCapacity": self.config.max_sessions,
+                "processCount": len(set(self.session_processes.values())),
+                "pendingHammerCount": self._pending_hammer_count(),
+            }
+
+    def _pending_hammer_count(self) -> int:
+        now = time.time()
+        jobs = list(self.hammer_jobs.values())
+        return sum(not job.cancelled and job.end_time > now for job in jobs)
+
+    def _execute(self, state: _State, isar_code: str) -> _State:
+        code = isar_code.strip()
+        if "fail" in code or self._chance(self.config.execute_error_rate):
+            raise _MockError("IsabelleMLException: Failed to apply initial proof method")
+        if state.mode != "Proof" or code == "-":
+            return state
+        if code.startswith("by ") or code in ("done", "qed", ".", "..") or "sorry" in code:
+            return _State("Theory", "")
+        return _State("Proof", state.goals.rstrip() + " " + code.replace("\n", " ") + "\n")
+
+    def _goals(self, lemma_statement: str) -> str:
+        padding = "x" * self.config.goals_padding
+        return f"proof (prove)\ngoal (1 subgoal):\n 1. {lemma_statement} {padding}\n"
+
+    def _goals_mode(self, args: JSON) -> str:
+        mode = args.get("goalsMode", "full")
+        if mode not in GOALS_MODES:
+            raise _MockError(f"Unknown goals mode: {mode} (expected {', '.join(GOALS_MODES)})")
+        return str(mode)
+
+    def _state_json(self, state: _State, goals_mode: str, parent_goals: str) -> JSON:
+        return goals_json(state.goals, state.mode != "Proof", goals_mode, parent_goals)
+
+    def _hammer_outcome(self, args: JSON) -> tuple[float, JSON]:
+        """Seconds the hammer call takes (besides latency), and its status like /hammerStatus."""
+        state = self._get_state(args, args["stateName"])
+        if state.mode != "Proof":
+            raise _MockError("Sledgehammer error: not in proof mode")
+        timeout = args.get("timeout", 0.0) or 30.0
+        needed = self.config.hammer_difficulty * (zlib.crc32(state.goals.encode()) % 1000) / 1000
+        if needed > timeout or self._chance(self.config.hammer_error_rate):
+            message = "Sledgehammer timeout: Timed out"
+            return min(needed, timeout), {"status": "failure", "proof": "", "message": message}
+        return needed, {"status": "success", "proof": "by auto", "message": ""}
+
+    def _chance(self, p: float) -> bool:
+        with self.lock:
+            return p > 0 and self.random.random() < p
+
+    def _get_hammer_job(self, job_id: str) -> _HammerJob:
+        with self.lock:
+            if job_id not in self.hammer_jobs:
+                raise _MockError(f"Job not found: {job_id}")
+            return self.hammer_jobs[job_id]
+
+    def _close_session(self, session_id: str) -> None:
+        """Forget an open session (call with the lock held)."""
+        del self.sessions[session_id]
+        del self.session_processes[session_id]
+        self.closed_sessions.add(session_id)
+        if session_id == self.default_session:
+            self.default_session = ""
+
+    def _states(self, args: JSON) -> dict[str, _State]:
+        """States of the request's session (call with the lock held)."""
+        session_id = args.get("sessionId", "") or self.default_session
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+        if not session_id:
+            raise _MockError("No Isabelle session open")
+        if session_id in self.closed_sessions:
+            raise _MockError(f"Session closed: {session_id}")
+        raise _MockError(f"Session not found: {session_id}")
+
+    def _get_state(self, args: JSON, state_name: str) -> _State:
+        with self.lock:
+            states = self._states(args)
+            if state_name not in states:
+                raise _MockError(f"State not found: {state_name}")
+            return states[state_name]
+
+    def _put_state(self, args: JSON, state_name: str, state: _State) -> None:
+        with self.lock:
+            self._states(args)[state_name] = state
+
+
+class _MockError(Exception):
+    pass
+
+
+def _process_key(args: JSON) -> str:
+    """Which Isabelle process an /openIsabelleSession(ForTheory) request needs."""
+    return str(args.get("sessionName") or Path(args["theoryPath"]).parent)
+
+
+def _make_handler(server: MockQIsabelleServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Allows keep-alive.
+        disable_nagle_algorithm = True
+
+        def do_GET(self) -> None:
+            if self.path == "/":
+                self._respond(200, b"Hello from QIsabelle", "text/plain")
+            elif self.path == "/health":
+                self._respond(200, json_dumps(server.health()), "application/json")
+            else:
+                self._respond(404, b"Not found", "text/plain")
+
+        def do_POST(self) -> None:
+            content = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path not in server.endpoints():
+                self._respond(404, b"Not found", "text/plain")
+                return
+            start = time.perf_counter()
+            result = server.handle(self.path, json_loads(content or b"{}"))
+            headers = {SERVER_TIME_HEADER: f"{1000 * (time.perf_counter() - start):.3f}"}
+            content = json_dumps(result)
+            if "gzip" in self.headers.get("Accept-Encoding", "") and len(content) >= 1024:
+                content = gzip.compress(content)
+                headers["Content-Encoding"] = "gzip"
+            self._respond(200, content, "application/json", headers)
+
+        def _respond(
+            self, status: int, content: bytes, content_type: str, headers: dict[str, str] = {}
+        ) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=17000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request.")
+    args = parser.parse_args()
+    config = MockConfig(default_latency=args.latency)
+    server = MockQIsabelleServer(config, host=args.host, port=args.port)
+    print(f"Mock QIsabelle server listening on {args.host}:{server.port}")
+    server.http.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,15 @@
+from __future__ import annotations
+
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from queue import Empty, Queue
+from typing import Any, Optional
+
+from typing_extensions import Self
 
 
 class Model(ABC):
@@ -13,6 +24,25 @@ class Model(ABC):
     ) -> list[tuple[str, float]]:
         pass
 
+    def batch(
+        self,
+        inputs: list[tuple[str, str]],
+        known_solutions: Optional[list[str]] = None,
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[list[tuple[str, float]]]:
+        """
+        Generate steps for several (context, proof_state) pairs at once.
+
+        By default this calls the model on each pair; models that can do batched inference
+        should override it.
+        """
+        known_solutions = known_solutions or [""] * len(inputs)
+        return [
+            self(context, proof_state, known_solution, temperature, max_expansion)
+            for (context, proof_state), known_solution in zip(inputs, known_solutions)
+        ]
+
 
 class DummyHammerModel(Model):
     """Dummy model that always answers "normalhammer"."""
@@ -40,3 +70,153 @@ class DummyKnownSolutionModel(Model):
         max_expansion: int = 32,
     ) -> list[tuple[str, float]]:
         return [(known_solution, 0.1)]
+
+
+@dataclass
+class _Request:
+    context: str
+    proof_state: str
+    known_solution: str
+    temperature: float
+    max_expansion: int
+    future: Future[list[tuple[str, float]]] = field(default_factory=Future)
+
+
+class BatchingModel(Model):
+    """
+    A model that collects calls from concurrent threads into batched calls of another model.
+
+    Each call waits until a batch is full (max_batch_size requests), or until max_wait seconds
+    have passed since the first request in the batch arrived, whichever comes first. Requests
+    with different temperature or max_expansion are sent in separate `batch()` calls.
+    This is useful with several searches running in parallel (e.g. `evaluate_model` with several
+    ports), since each search only asks for one proof state at a time.
+
+    Use as `with BatchingModel(model) as batching_model: ...` (the batching thread stops on exit).
+    """
+
+    def __init__(self, model: Model, max_batch_size: int = 16, max_wait: float = 0.05):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.n_batches = 0
+        self.n_requests = 0
+        self._queue: Queue[Optional[_Request]] = Queue()
+        self._lock = threading.Lock()  # So that nothing is queued after close().
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="model-batcher", daemon=True)
+        self._thread.start()
+
+    def __call__(
+        self,
+        context: str,
+        proof_state: str,
+        known_solution: str = "",
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[tuple[str, float]]:
+        request = _Request(context, proof_state, known_solution, temperature, max_expansion)
+        self._submit([request])
+        return request.future.result()
+
+    def batch(
+        self,
+        inputs: list[tuple[str, str]],
+        known_solutions: Optional[list[str]] = None,
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[list[tuple[str, float]]]:
+        """Add all inputs to the queue at once (they may be batched with concurrent calls)."""
+        known_solutions = known_solutions or [""] * len(inputs)
+        requests = [
+            _Request(context, proof_state, known_solution, temperature, max_expansion)
+            for (context, proof_state), known_solution in zip(inputs, known_solutions)
+        ]
+        self._submit(requests)
+        return [request.future.result() for request in requests]
+
+    def close(self) -> None:
+        """Stop the batching thread, after answering requests already queued."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        # Fail requests the thread left (it only does if it died), so that no caller hangs.
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                return
+            if request is not None and not request.future.done():
+                request.future.set_exception(RuntimeError("BatchingModel is closed."))
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.close()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "batches": self.n_batches,
+            "requests": self.n_requests,
+            "mean_batch_size": self.n_requests / max(1, self.n_batches),
+        }
+
+    def _submit(self, requests: list[_Request]) -> None:
+        with self._lock:
+            if self._closed or not self._thread.is_alive():
+                raise RuntimeError("BatchingModel is closed.")
+            for request in requests:
+                self._queue.put(request)
+
+    def _run(self) -> None:
+        closing = False
+        while not closing:
+            first = self._queue.get()
+            if first is None:
+                break
+            requests = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(requests) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                requests.append(request)
+            self._run_batch(requests)
+        # Answer requests that arrived concurrently with close().
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                return
+            if request is not None:
+                self._run_batch([request])
+
+    def _run_batch(self, requests: list[_Request]) -> None:
+        groups = defaultdict[tuple[float, int], list[_Request]](list)
+        for request in requests:
+            groups[(request.temperature, request.max_expansion)].append(request)
+        for (temperature, max_expansion), group in groups.items():
+            self.n_batches += 1
+            self.n_requests += len(group)
+            try:
+                outputs = self.model.batch(
+                    [(r.context, r.proof_state) for r in group],
+                    [r.known_solution for r in group],
+                    temperature=temperature,
+                    max_expansion=max_expansion,
+                )
+                assert len(outputs) == len(group), "Model.batch() must return one output per input."
+            except Exception as e:
+                for r in group:
+                    r.future.set_exception(e)
+                continue
+            for r, output in zip(group, outputs):
+                r.future.set_result(output)
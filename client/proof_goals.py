@@ -0,0 +1,132 @@
+"""Compact encodings of proof goals in server responses (see `server/src/ProofGoals.scala`).
+
+Responses with a proof state have a "proofStateHash", and the goals text itself depending on the
+requested goals mode: in full ("proofGoals"), as a diff against the goals of the state executed on
+("proofGoalsDiff"), or not at all (then `/getProofGoals` fetches it). `GoalsCache` remembers the
+goals of a session's states, to reconstruct goals from diffs.
+"""
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, cast
+
+from .transport import JSON
+
+GOALS_MODES = ("full", "diff", "none")
+
+
+def proof_state_hash(goals: str) -> str:
+    """Same as `ProofGoals.hash`: the first 16 hex digits of the SHA-256 of the goals."""
+    return hashlib.sha256(goals.encode("utf-8")).hexdigest()[:16]
+
+
+def goals_diff(parent: str, goals: str) -> JSON:
+    """Same as `ProofGoals.diff`: {"prefix": int, "suffix": int, "middle": str}."""
+    max_length = min(len(parent), len(goals))
+    prefix = _common_length(lambda n: parent[:n] == goals[:n], max_length)
+    suffix = _common_length(
+        lambda n: parent[len(parent) - n :] == goals[len(goals) - n :], max_length - prefix
+    )
+    return {"prefix": prefix, "suffix": suffix, "middle": goals[prefix : len(goals) - suffix]}
+
+
+def _common_length(is_common: Callable[[int], bool], max_length: int) -> int:
+    """The largest n <= max_length such that is_common(n) (which must be monotonous)."""
+    low, high = 0, max_length  # is_common(low) holds, is_common(n) fails for n > high.
+    while low < high:
+        middle = (low + high + 1) // 2
+        if is_common(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def apply_goals_diff(parent: str, diff: JSON) -> str:
+    prefix, suffix = cast(int, diff["prefix"]), cast(int, diff["suffix"])
+    return parent[:prefix] + cast(str, diff["middle"]) + parent[len(parent) - suffix :]
+
+
+def goals_json(goals: str, proof_done: bool, mode: str, parent_goals: str = "") -> JSON:
+    """Same as `ProofGoals.json`: the JSON of a proof state with its goals in a given mode."""
+    result: JSON = {"proofDone": proof_done, "proofStateHash": proof_state_hash(goals)}
+    if mode == "full":
+        result["proofGoals"] = goals
+    elif mode == "diff":
+        result["proofGoalsDiff"] = goals_diff(parent_goals, goals)
+    elif mode != "none":
+        raise ValueError(f"Unknown goals mode: {mode}")
+    return result
+
+
+class GoalsCache:
+    """Hashes and goals of a session's most recent states, by state name.
+
+    Goals are None for states whose goals weren't sent (goals mode "none") and not fetched yet.
+    Thread-safe, like sessions.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[str, Optional[str]]] = OrderedDict()
+
+    def hash(self, state_name: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(state_name)
+        return None if entry is None else entry[0]
+
+    def goals(self, state_name: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(state_name)
+        return None if entry is None else entry[1]
+
+    def put(self, state_name: str, goals: str, goals_hash: Optional[str] = None) -> None:
+        self._put(state_name, goals_hash or proof_state_hash(goals), goals)
+
+    def request_mode(self, parent_name: Optional[str], goals_mode: str) -> tuple[str, str]:
+        """The goals mode to request for results of a state, and the parent goals a diff is against.
+
+        A diff is only requested if we know the parent's goals (parent_name None means no parent,
+        like for `load_theory`, where a diff would be the full goals anyway).
+        """
+        if goals_mode != "diff":
+            return goals_mode, ""
+        parent_goals = None if parent_name is None else self.goals(parent_name)
+        if parent_goals is None:
+            return "full", ""
+        return "diff", parent_goals
+
+    def read(self, result: JSON, parent_goals: str, new_state_name: str) -> Optional[str]:
+        """Get the goals from a result (None if not sent), remember them under new_state_name."""
+        goals: Optional[str] = None
+        if "proofGoals" in result:
+            goals = cast(str, result["proofGoals"])
+        elif "proofGoalsDiff" in result:
+            goals = apply_goals_diff(parent_goals, result["proofGoalsDiff"])
+        goals_hash = cast(Optional[str], result.get("proofStateHash"))
+        if goals_hash is None:
+            assert goals is not None, "The server sent neither goals nor their hash."
+            goals_hash = proof_state_hash(goals)
+        elif goals is not None and "proofGoalsDiff" in result:
+            assert proof_state_hash(goals) == goals_hash, "Proof goals diff applied to wrong goals."
+        if new_state_name:
+            self._put(new_state_name, goals_hash, goals)
+        return goals
+
+    def forget(self, state_name: str) -> None:
+        with self.lock:
+            self.entries.pop(state_name, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def _put(self, state_name: str, goals_hash: str, goals: Optional[str]) -> None:
+        with self.lock:
+            self.entries[state_name] = (goals_hash, goals)
+            self.entries.move_to_end(state_name)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
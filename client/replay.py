@@ -0,0 +1,217 @@
+"""Replaying proofs of AFP extractions on live servers, to check recorded proof states.
+
+For each lemma of an extraction store (see `extraction_store.py`), the theory is loaded up to the
+lemma statement, then all recorded proof steps are executed in a single `execute_chain` request.
+The proof state before each step is compared (ignoring whitespace) to the recorded one.
+Extractions are spread over server replicas, grouped by the Isabelle session they need so that
+sessions are reused, like test cases in `main.evaluate_model`.
+
+Run as `python -m client.replay STORE_FILE --ports 17000 17001 --output replay.jsonl`.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from queue import Empty, Queue
+from typing import BinaryIO, Optional
+
+from .extraction_store import ExtractionStore
+from .session import QIsabelleServerError, QIsabelleSession, get_exception_kind, guess_session_name
+from .session_manager import AFP_THYS_DIR, SessionManager
+from .transport import json_dumps
+from .utils import normalize_goals
+
+
+@dataclass
+class ReplayResult:
+    thy_file: str  # Relative to "/afp/thys/".
+    lemma_statement: str
+    # "match" (all states matched), "mismatch" (a live state differed from the recorded one),
+    # "step-error" (a recorded step failed), or an exception kind (see `get_exception_kind`).
+    kind: str
+    n_steps: int
+    n_matched: int = 0  # Number of recorded states that matched live ones.
+    index: Optional[int] = None  # Step before which states first differed, or that failed.
+    expected: str = ""  # Recorded state at index (for mismatches).
+    actual: str = ""  # Live state at index, or error message.
+    proof_done: bool = False  # Whether the last step finished the proof.
+    duration: float = 0.0
+
+
+def replay_lemma(
+    session: QIsabelleSession,
+    thy_file: Path,
+    lemma_statement: str,
+    translations: list[tuple[str, str]],
+    timeout: int = 0,
+) -> ReplayResult:
+    """
+    Replay the recorded proof of a lemma and compare proof states.
+
+    Args:
+    - session: session in which the theory can be loaded.
+    - thy_file: relative to "/afp/thys/".
+    - lemma_statement
+    - translations: recorded (proof_state, proof_step) pairs of the proof (after the statement).
+    - timeout: per-transition timeout of each step (0 means the server's default).
+    """
+    result = ReplayResult(str(thy_file), lemma_statement, "match", len(translations))
+    start = time.time()
+    steps = [step for _, step in translations]
+    try:
+        _, goals = session.load_theory(AFP_THYS_DIR / thy_file, lemma_statement, True, "replay")
+        outcomes = [(False, goals)] + (
+            session.execute_chain("replay", steps, [timeout] * len(steps)) if steps else []
+        )
+    except Exception as e:
+        result.kind, result.actual = get_exception_kind(e), str(e)
+        result.duration = time.time() - start
+        return result
+
+    # outcomes[i] is the live state before step i (or the error of step i - 1).
+    for i, outcome in enumerate(outcomes):
+        if isinstance(outcome, QIsabelleServerError):
+            if result.kind == "match":
+                result.kind, result.index, result.actual = "step-error", i - 1, str(outcome)
+            break
+        if i == len(translations):
+            result.proof_done = outcome[0]
+            break
+        recorded = translations[i][0]
+        if normalize_goals(outcome[1]) == normalize_goals(recorded):
+            result.n_matched += 1
+        elif result.kind == "match":
+            result.kind, result.index = "mismatch", i
+            result.expected, result.actual = recorded, outcome[1]
+    result.duration = time.time() - start
+    return result
+
+
+def _replay_extraction(
+    store: ExtractionStore, i: int, sessions: SessionManager, timeout: int
+) -> list[ReplayResult]:
+    """Replay the lemmas of the i-th extraction of a store."""
+    extraction = store.extraction(i)
+    lemmas = list[tuple[str, list[tuple[str, str]]]]()
+    spans = set[tuple[int, int]]()
+    for statement in extraction.lemma_statements:
+        span = store.lemma_span(extraction.thy_file, statement)
+        if span is None or span[0] == span[1] or span in spans:
+            continue  # Proof not extracted, or same statement as another.
+        spans.add(span)
+        lemmas.append((statement, list(store.translations(span[0] + 1, span[1]))))
+    try:
+        session = sessions.get(AFP_THYS_DIR / extraction.thy_file)
+    except Exception as e:
+        return [
+            ReplayResult(
+                str(extraction.thy_file),
+                statement,
+                get_exception_kind(e),
+                len(translations),
+                actual=str(e),
+            )
+            for statement, translations in lemmas
+        ]
+    return [
+        replay_lemma(session, extraction.thy_file, statement, translations, timeout)
+        for statement, translations in lemmas
+    ]
+
+
+def replay_store(
+    store: ExtractionStore,
+    ports: list[int] = [17000],
+    thy_files: Optional[set[Path]] = None,
+    output: Optional[BinaryIO] = None,
+    timeout: int = 0,
+) -> Counter[str]:
+    """
+    Replay all lemmas of an extraction store, with one worker per server replica.
+
+    Args:
+    - store
+    - ports: ports of server replicas to use.
+    - thy_files: if given, only replay extractions of these theory files.
+    - output: if given, each ReplayResult is written there as a JSON line.
+    - timeout: see `replay_lemma`.
+
+    Returns the number of lemmas of each result kind.
+    """
+    groups: dict[str, list[int]] = defaultdict(list)
+    for i in range(store.n_extractions):
+        thy_file = store.thy_file(i)
+        if thy_files is None or thy_file in thy_files:
+            groups[guess_session_name(AFP_THYS_DIR / thy_file)].append(i)
+    queue: Queue[list[int]] = Queue()
+    for group in sorted(groups.values(), key=len, reverse=True):
+        queue.put(group)
+    n_extractions = sum(len(group) for group in groups.values())
+    kinds = Counter[str]()
+    n_done, n_steps, n_matched = 0, 0, 0
+    start = time.time()
+    lock = threading.Lock()
+
+    def worker(port: int) -> None:
+        nonlocal n_done, n_steps, n_matched
+        with SessionManager(port=port, debug=False) as sessions:
+            while True:
+                try:
+                    group = queue.get_nowait()
+                except Empty:
+                    return
+                for i in group:
+                    results = _replay_extraction(store, i, sessions, timeout)
+                    with lock:
+                        n_done += 1
+                        for result in results:
+                            kinds[result.kind] += 1
+                            n_steps += result.n_steps
+                            n_matched += result.n_matched
+                            if output is not None:
+                                output.write(json_dumps(asdict(result)) + b"\n")
+                        if output is not None:
+                            output.flush()
+                        print(
+                            f"Did {n_done} / {n_extractions} extractions"
+                            f" ({time.time() - start:.0f}s): {dict(kinds.most_common())},"
+                            f" {n_matched} / {n_steps} states matched."
+                        )
+                        sys.stdout.flush()
+
+    workers = [threading.Thread(target=worker, args=(port,), name=f"port-{port}") for port in ports]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return kinds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("store_file", type=Path, help="Built with `client.extraction_store`.")
+    parser.add_argument("--ports", type=int, nargs="+", default=[17000])
+    parser.add_argument(
+        "--thy-file", type=Path, action="append", help="Only replay this theory (repeatable)."
+    )
+    parser.add_argument("--output", type=Path, help="Write results as JSON lines to this file.")
+    parser.add_argument("--timeout", type=int, default=0, help="Seconds per transition.")
+    args = parser.parse_args()
+
+    thy_files = None if args.thy_file is None else set(args.thy_file)
+    with ExtractionStore(args.store_file) as store:
+        if args.output is None:
+            kinds = replay_store(store, args.ports, thy_files, timeout=args.timeout)
+        else:
+            with open(args.output, "wb") as output:
+                kinds = replay_store(store, args.ports, thy_files, output, args.timeout)
+    print(f"Finished replay: {dict(kinds.most_common())}")
+
+
+if __name__ == "__main__":
+    main()
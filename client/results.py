@@ -0,0 +1,154 @@
+"""Persistent results of evaluation runs, so that interrupted runs can be resumed.
+
+`evaluate_model` appends one JSON line per finished test case to a results file (see `TestResult`).
+Resuming a run skips test cases whose names are already recorded there. Several results files
+(e.g. of runs on different machines, or of a run resumed several times) can be aggregated with
+`python -m client.results report FILE...`, or merged into one with `merge_results`.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import threading
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+from typing_extensions import Self
+
+from .transport import JSON, json_dumps, json_loads
+
+
+@dataclass
+class TestResult:
+    name: str  # Name of the test case.
+    thy_file: str  # Relative to "/afp/thys/".
+    kind: str  # "success", "failure", or an exception kind (see `get_exception_kind`).
+    proof: Optional[list[str]] = None  # Proof steps found, on success.
+    error: str = ""  # Exception message, if any.
+    duration: float = 0.0  # Wall time in seconds.
+    search_time: Optional[float] = None  # Budgets the test ran with, if any (see `budget.py`).
+    hammer_timeout: Optional[float] = None
+    timings: dict[str, float] = field(default_factory=dict)  # Total seconds per request/phase.
+    finish_time: float = 0.0  # Unix time.
+
+    @classmethod
+    def from_json(cls, o: JSON) -> TestResult:
+        return cls(**{k: v for k, v in o.items() if k in cls.__dataclass_fields__})
+
+
+class ResultsLog:
+    """An append-only JSONL file of test results, safe to share between threads.
+
+    Each result is flushed and synced to disk as soon as it's appended, so at most the line being
+    written is lost if the process dies (such a truncated line is skipped when loading).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._file = open(path, "ab")
+        # Don't append to a line truncated by a crash.
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write(b"\n")
+
+    def append(self, result: TestResult) -> None:
+        line = json_dumps(asdict(result)) + b"\n"
+        with self.lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.close()
+
+
+def load_results(paths: Iterable[Path]) -> dict[str, TestResult]:
+    """Load results files, mapping test names to results (later results override earlier ones).
+
+    Missing files are ignored (like a new run), lines that don't parse are skipped with a warning.
+    """
+    results = dict[str, TestResult]()
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path, "rb") as f:
+            for i, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    result = TestResult.from_json(json_loads(line))
+                except (ValueError, TypeError, AttributeError) as e:  # Not a result object.
+                    print(f"Skipping malformed line {i} of {path}: {e}", file=sys.stderr)
+                    continue
+                results[result.name] = result
+    return results
+
+
+def merge_results(paths: list[Path], output: Path) -> int:
+    """Write the results of several results files into one (see `load_results`).
+
+    The output may be one of the inputs; it's overwritten. Returns the number of results written.
+    """
+    results = load_results(paths)
+    with open(output, "wb") as f:
+        for result in results.values():
+            f.write(json_dumps(asdict(result)) + b"\n")
+    return len(results)
+
+
+def summarize(results: Iterable[TestResult]) -> dict[str, int]:
+    """Number of results of each kind, most common first."""
+    summary: dict[str, int] = defaultdict(int)
+    for result in results:
+        summary[result.kind] += 1
+    return dict(sorted(summary.items(), key=lambda item: (-item[1], item[0])))
+
+
+def report(paths: list[Path]) -> str:
+    """A text report aggregating results files: counts per result kind, per file and in total."""
+    lines = list[str]()
+    for path in paths:
+        results = load_results([path])
+        lines.append(f"{path}: {len(results)} tests, {summarize(results.values())}")
+    results = load_results(paths)
+    n = len(results)
+    n_success = sum(r.kind == "success" for r in results.values())
+    total_time = sum(r.duration for r in results.values())
+    lines.append(f"Total: {n} distinct tests")
+    for kind, count in summarize(results.values()).items():
+        lines.append(f"    {kind:<24}{count:>7}{100 * count / n:>8.1f}%")
+    if n:
+        lines.append(
+            f"Success rate: {100 * n_success / n:.1f}%, "
+            f"test time: {total_time / 3600:.2f} h (mean {total_time / n:.1f} s), "
+            f"successes per test hour: {n_success / max(total_time / 3600, 1e-9):.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Aggregate results files.")
+    report_parser.add_argument("results_files", type=Path, nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        print(report(args.results_files))
+
+
+if __name__ == "__main__":
+    main()
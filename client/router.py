@@ -0,0 +1,314 @@
+"""Routing sessions between server replicas, with health checks and failover.
+
+`ReplicaRouter` probes QIsabelle servers on several ports (GET /health) and picks the least loaded
+healthy one for each new session. `RoutedQIsabelleSession` is a QIsabelleSession opened through a
+router that survives its replica dying: it reopens on another replica, replays what it needs of
+its states there, and retries the request.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+
+import requests
+
+from .budget import DEFAULT_HAMMER_TIMEOUT, HAMMER_GRACE
+from .session import PROCESS_FAILURES, SESSION_FAILURES, QIsabelleServerError, QIsabelleSession
+from .transport import JSON, HTTPTransport, Timeout
+
+_OPEN_PATHS = ("/openIsabelleSession", "/openIsabelleSessionForTheory")
+_CONNECT_TIMEOUT = 10.0  # Like HTTPTransport's default.
+_FAILOVER_STATE_NAME = "__failover__"  # Temporary root state when replaying a state.
+
+
+class NoHealthyReplicaError(RuntimeError):
+    pass
+
+
+def is_replica_failure(e: Exception) -> bool:
+    """Whether an error from a request means the replica (or our session on it) is gone.
+
+    That's a transport error (connection refused or reset, read timeout of a wedged replica, HTTP
+    error; requests raises OSErrors), or a server error in SESSION_FAILURES or PROCESS_FAILURES.
+    """
+    if isinstance(e, QIsabelleServerError):
+        return any(failure in str(e) for failure in SESSION_FAILURES + PROCESS_FAILURES)
+    return isinstance(e, OSError)
+
+
+class ReplicaRouter:
+    """Chooses, among QIsabelle servers (replicas) on several ports, where to open sessions.
+
+    Replicas are probed with GET /health (see `QIsabelleServer.scala`) when picking one.
+    New sessions go to the least loaded healthy replica with a free session slot (see
+    QISABELLE_MAX_SESSIONS), or the least loaded one if none has a free slot. The load of a replica
+    is the number of requests it's handling, hammer jobs pending and sessions open or being opened
+    (sessions this router is opening count too, so concurrent opens from several threads spread
+    out). Ties go to the first port. Replicas that failed (didn't answer a probe, or were reported
+    with `report_failure`) are skipped for `retry_after` seconds.
+
+    The router can be shared by threads.
+    """
+
+    def __init__(
+        self,
+        ports: Iterable[int],
+        host: str = "localhost",
+        probe_timeout: float = 2.0,
+        retry_after: float = 30.0,
+    ):
+        self.ports = list(ports)
+        assert self.ports, "ReplicaRouter needs at least one port."
+        self.host = host
+        self.probe_timeout = probe_timeout
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self._opening = Counter[int]()  # Sessions being opened on each port, by this router.
+        self._down_until = dict[int, float]()  # Port -> when to probe it again.
+        self.n_failures = 0
+
+    def probe(self, port: int) -> Optional[JSON]:
+        """The /health response of a replica, or None if it's not healthy."""
+        try:
+            r = requests.get(f"http://{self.host}:{port}/health", timeout=self.probe_timeout)
+            r.raise_for_status()
+            health = r.json()
+        except (OSError, ValueError):
+            health = None
+        if not isinstance(health, dict) or health.get("status") != "ok":
+            with self.lock:
+                self._down_until[port] = time.time() + self.retry_after
+            return None
+        return health
+
+    def health(self) -> dict[int, Optional[JSON]]:
+        """Probe all replicas, including those recently failed."""
+        return {port: self.probe(port) for port in self.ports}
+
+    def pick(self, exclude: Iterable[int] = ()) -> int:
+        """Pick the replica to open a session on (see the class docstring).
+
+        The caller must then call `done_opening(port)` once it tried to open the session.
+        Raises NoHealthyReplicaError if no replica (other than the excluded ones) is healthy.
+        """
+        candidates = list[tuple[bool, int, int]]()  # (full, load, index of port)
+        for i, port in enumerate(self.ports):
+            if port in exclude or self._down_until.get(port, 0.0) > time.time():
+                continue
+            health = self.probe(port)
+            if health is None:
+                continue
+            with self.lock:
+                n_sessions = health.get("sessionCount", 0) + self._opening[port]
+            load = n_sessions + health.get("activeRequests", 0)
+            load += health.get("pendingHammerCount", 0)
+            full = n_sessions >= health.get("sessionCapacity", 1)
+            candidates.append((full, load, i))
+        if not candidates:
+            raise NoHealthyReplicaError(f"No healthy QIsabelle replica among ports {self.ports}")
+        port = self.ports[min(candidates)[2]]
+        with self.lock:
+            self._opening[port] += 1
+        return port
+
+    def done_opening(self, port: int) -> None:
+        """A session picked with `pick()` was opened (or failed to)."""
+        with self.lock:
+            self._opening[port] -= 1
+
+    def report_failure(self, port: int) -> None:
+        """Don't pick a replica for a while, because a session on it failed."""
+        with self.lock:
+            self.n_failures += 1
+            self._down_until[port] = time.time() + self.retry_after
+
+
+@dataclass
+class _StateOrigin:
+    """How a state was made: by a root request (loadTheory/newTheory) and a chain of steps."""
+
+    root_path: str
+    root_args: JSON  # Arguments of the root request, except the new state name and goals mode.
+    steps: tuple[tuple[str, int], ...]  # (isar_code, timeout) pairs executed from the root.
+
+    def then(self, isar_code: str, timeout: int) -> _StateOrigin:
+        return _StateOrigin(self.root_path, self.root_args, self.steps + ((isar_code, timeout),))
+
+
+class RoutedQIsabelleSession(QIsabelleSession):
+    """A QIsabelleSession on a replica chosen by a ReplicaRouter, failing over to another one.
+
+    When a request fails because the replica or the session on it is gone (see
+    `is_replica_failure`), the session is reopened on another replica (or on any replica, if only
+    the session was gone) and the request retried, at most `max_failovers` times per request.
+    States the request uses are first re-established there by replaying how they were made: the
+    load_theory or new_theory call, then the steps executed since (in a single /executeChain
+    request). States made in other ways (e.g. from a state that couldn't be replayed) and hammer
+    jobs are lost.
+
+    So that a wedged replica is failed over like a dead one, requests have a read timeout: for
+    hammer calls, their own timeout (or the wait of /hammerStatus) plus timeout_margin, and
+    read_timeout for others (loading theories can take minutes).
+    """
+
+    def __init__(
+        self,
+        router: ReplicaRouter,
+        max_failovers: int = 2,
+        read_timeout: float = 600.0,
+        timeout_margin: float = 30.0,
+        **kwargs: Any,
+    ):
+        """kwargs are passed to QIsabelleSession (except port and transport)."""
+        assert "port" not in kwargs and "transport" not in kwargs, "The router chooses the port."
+        self.router = router
+        self.max_failovers = max_failovers
+        self.read_timeout = read_timeout
+        self.timeout_margin = timeout_margin
+        self.n_failovers = 0
+        self.origins = dict[str, _StateOrigin]()  # Replayable states, by name.
+        self._live = set[str]()  # States that exist on the current replica.
+        super().__init__(port=router.pick(), **kwargs)
+
+    def _post(
+        self, path: str, json_data: Optional[dict[str, Any]] = None, timeout: Timeout = None
+    ) -> JSON:
+        if path == "/closeIsabelleSession":
+            if not self.session_id:  # Failed over, not reopened yet ("" would close another one).
+                return {"success": "Closed"}
+            return self._post_once(path, json_data, timeout)
+        json_data = json_data or {}
+        failed_ports = set[int]()
+        n_retries = 0
+        while True:
+            try:
+                if path in _OPEN_PATHS:
+                    try:
+                        result = self._post_once(path, json_data, timeout)
+                    finally:
+                        self.router.done_opening(self.port)
+                    return result
+                if not self.session_id:
+                    self._reopen()
+                state_name = json_data.get("stateName")
+                if state_name is not None and state_name not in self._live:
+                    self._replay(state_name)
+                result = self._post_once(path, json_data, timeout)
+                break
+            except Exception as e:
+                if n_retries >= self.max_failovers or not is_replica_failure(e):
+                    raise
+                n_retries += 1
+                self._switch_replica(failed_ports, e)
+        self._record(path, json_data, result)
+        return result
+
+    def _post_once(
+        self, path: str, json_data: Optional[dict[str, Any]] = None, timeout: Timeout = None
+    ) -> JSON:
+        """Post a request to the current replica (no failover), with a read timeout."""
+        if timeout is None:
+            args = json_data or {}
+            if path == "/hammer":
+                read_timeout = (args.get("timeout") or DEFAULT_HAMMER_TIMEOUT) + HAMMER_GRACE
+                read_timeout += self.timeout_margin
+            elif path == "/hammerStatus":
+                read_timeout = args.get("waitSeconds", 0.0) + self.timeout_margin
+            else:
+                read_timeout = self.read_timeout
+            timeout = (_CONNECT_TIMEOUT, read_timeout)
+        return super()._post(path, json_data, timeout)
+
+    def _switch_replica(self, failed_ports: set[int], error: Exception) -> None:
+        """Move to another replica (the session is reopened by the next request)."""
+        print(f"RoutedQIsabelleSession: session on port {self.port} failed, failing over: {error}")
+        if not any(failure in str(error) for failure in SESSION_FAILURES):
+            self.router.report_failure(self.port)
+            failed_ports.add(self.port)
+        port = self.router.pick(exclude=failed_ports)
+        if self._owns_transport:
+            self.transport.close()
+        self.port, self.transport, self._owns_transport = port, HTTPTransport(port=port), True
+        self.session_id = ""
+        self._preloaded = None
+        self._live.clear()
+        self.n_failovers += 1
+
+    def _reopen(self) -> None:
+        try:
+            r = self._post_once(*self._open_request())
+        finally:
+            self.router.done_opening(self.port)
+        assert r["success"] == "success", r
+        self.session_id = r["sessionId"]
+
+    def _replay(self, state_name: str) -> None:
+        """Re-establish a state on the current replica, if we know how it was made."""
+        origin = self.origins.get(state_name)
+        if origin is None:
+            return
+        root_name = _FAILOVER_STATE_NAME if origin.steps else state_name
+        root_args = {**origin.root_args, "newStateName": root_name}
+        if origin.root_path == "/loadTheory":
+            root_args["goalsMode"] = "none"
+        self._post_once(origin.root_path, root_args)
+        if origin.steps:
+            r = self._post_once(
+                "/executeChain",
+                {
+                    "stateName": root_name,
+                    "isarCodes": [code for code, _ in origin.steps],
+                    "timeouts": [timeout for _, timeout in origin.steps],
+                    "newStateNames": [""] * (len(origin.steps) - 1) + [state_name],
+                    "goalsMode": "none",
+                },
+            )
+            self._post_once("/forgetState", {"stateName": root_name})
+            results = r["results"]
+            if len(results) < len(origin.steps) or "error" in results[-1]:
+                error = results[-1].get("error") if results else "no results"
+                raise QIsabelleServerError(f"Failover: replaying {state_name} failed: {error}")
+        self._live.add(state_name)
+
+    def _record(self, path: str, args: JSON, result: JSON) -> None:
+        """Remember how states made by a successful request can be replayed."""
+        if path in ("/loadTheory", "/newTheory"):
+            root_args = {k: v for k, v in args.items() if k not in ("newStateName", "goalsMode")}
+            self._made(args["newStateName"], _StateOrigin(path, root_args, ()))
+        elif path == "/execute":
+            origin = self.origins.get(args["stateName"])
+            step = None if origin is None else origin.then(args["isarCode"], args["timeout"])
+            self._made(args["newStateName"], step)
+        elif path in ("/executeMany", "/executeChain"):
+            # Steps of /executeMany all start from stateName, those of /executeChain are chained.
+            chained = path == "/executeChain"
+            names, timeouts = args.get("newStateNames", []), args.get("timeouts", [])
+            parent = self.origins.get(args["stateName"])
+            for i, r in enumerate(result["results"]):
+                if "error" in r:
+                    if chained:
+                        break
+                    continue
+                timeout = timeouts[i] if i < len(timeouts) else 0
+                origin = None if parent is None else parent.then(args["isarCodes"][i], timeout)
+                if chained:
+                    parent = origin
+                if i < len(names) and names[i]:
+                    self._made(names[i], origin)
+        elif path == "/forgetState":
+            self.origins.pop(args["stateName"], None)
+            self._live.discard(args["stateName"])
+        elif path == "/forgetAllStates":
+            self.origins.clear()
+            self._live.clear()
+
+    def _made(self, state_name: str, origin: Optional[_StateOrigin]) -> None:
+        """A state now exists on the current replica, replayable if origin is given."""
+        if origin is None:
+            self.origins.pop(state_name, None)
+        else:
+            self.origins[state_name] = origin
+        self._live.add(state_name)
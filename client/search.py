@@ -0,0 +1,276 @@
+"""Best-first and beam proof search, an alternative to `main.run_model_greedily`."""
+from __future__ import annotations
+
+import heapq
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Literal, Optional, TextIO
+
+from .budget import DEFAULT_HAMMER_TIMEOUT, HAMMER_GRACE
+from .model import Model
+from .session import HAMMER_JOB_FINISHED, QIsabelleServerError, QIsabelleSession
+from .utils import header, indent, normalize_goals
+
+
+@dataclass(order=True)
+class _Node:
+    priority: float  # Negated score, since heapq pops the smallest.
+    index: int  # Order of creation, to break ties deterministically.
+    state_name: str = field(compare=False)
+    proof_goals: str = field(compare=False)
+    steps: list[str] = field(compare=False)  # Proof steps leading from the lemma to this state.
+
+    @property
+    def score(self) -> float:
+        return -self.priority
+
+
+def search_proof(
+    model: Model,
+    theory_path: Path,
+    lemma_statement: str,
+    session: QIsabelleSession,
+    mode: Literal["best-first", "beam"] = "best-first",
+    max_expansion: int = 8,
+    beam_width: int = 8,
+    max_frontier: int = 256,
+    max_nodes: int = 1024,
+    max_proof_search_time: float = 500.0,
+    hammer_timeout: float = 0.0,
+    out: Optional[TextIO] = None,
+) -> Optional[list[str]]:
+    """
+    Search for a proof by expanding states with all steps proposed by the model.
+
+    The score of a state is the sum of subscores given by the model along the steps leading to it.
+    - "best-first" always expands the best state in the frontier (of at most max_frontier states).
+    - "beam" expands all states at a given depth, keeping the best beam_width of their children.
+    States with the same (normalized) proof goals as an already reached state are not expanded
+    again. States that are expanded or pruned are forgotten by the server.
+
+    Args:
+    - model
+    - theory_path: path to .thy file in server.
+    - lemma_statement: statement of lemma to prove (should appear in the theory file).
+    - session: QIsabelleSession initialized with a session containing the theory (or all its
+      imports).
+    - mode: "best-first" or "beam".
+    - max_expansion: maximum number of steps to ask the model for, at each state.
+    - beam_width: number of states kept at each depth, in beam mode.
+    - max_frontier: maximum number of states waiting for expansion, in best-first mode.
+    - max_nodes: maximum number of states to create (successfully executed steps).
+    - max_proof_search_time: float seconds, maximum time to search for a proof.
+    - hammer_timeout: soft timeout of each hammer call in seconds (0 means the server's default);
+      a node's expansion waits for its hammer job at most that plus HAMMER_GRACE seconds.
+    - out: where to print output (None means sys.stdout).
+
+    Returns the list of proof steps found, or None.
+    """
+    print(" Load theory ".center(100, "%"), file=out)
+    is_proof_done, proof_goals = session.load_theory(theory_path, lemma_statement, True, "s")
+    assert not is_proof_done
+
+    search = _Search(
+        model,
+        session,
+        lemma_statement,
+        max_expansion,
+        max_nodes,
+        max_proof_search_time,
+        hammer_timeout,
+        out,
+    )
+    root = search.add_node("s", proof_goals, [], 0.0)
+    assert root is not None
+    if mode == "best-first":
+        return search.best_first(root, max_frontier)
+    elif mode == "beam":
+        return search.beam(root, beam_width)
+    else:
+        raise ValueError(f"Unknown search mode: {mode}")
+
+
+class _Search:
+    def __init__(
+        self,
+        model: Model,
+        session: QIsabelleSession,
+        lemma_statement: str,
+        max_expansion: int,
+        max_nodes: int,
+        max_proof_search_time: float,
+        hammer_timeout: float,
+        out: Optional[TextIO],
+    ):
+        self.model = model
+        self.session = session
+        self.lemma_statement = lemma_statement
+        self.max_expansion = max_expansion
+        self.max_nodes = max_nodes
+        self.end_time = time.time() + max_proof_search_time
+        self.hammer_timeout = hammer_timeout
+        self.out = out
+        self.seen_goals = set[str]()  # Transposition table.
+        self.n_nodes = 0
+        self.proof: Optional[list[str]] = None
+
+    def out_of_budget(self) -> bool:
+        return self.n_nodes >= self.max_nodes or time.time() >= self.end_time
+
+    def best_first(self, root: _Node, max_frontier: int) -> Optional[list[str]]:
+        frontier = [root]
+        while frontier and not self.out_of_budget() and self.proof is None:
+            node = heapq.heappop(frontier)
+            for child in self.expand(node):
+                heapq.heappush(frontier, child)
+            if len(frontier) > max_frontier:
+                frontier.sort()
+                self.forget(frontier[max_frontier:])
+                del frontier[max_frontier:]
+        self.forget(frontier)
+        return self.proof
+
+    def beam(self, root: _Node, beam_width: int) -> Optional[list[str]]:
+        beam = [root]
+        while beam and not self.out_of_budget():
+            # Ask the model about the whole beam at once (see `Model.batch`).
+            with self.session.timings.span("model"):
+                generated = self.model.batch(
+                    [(self.context(node), node.proof_goals) for node in beam],
+                    max_expansion=self.max_expansion,
+                )
+            children = list[_Node]()
+            for i, (node, generated_steps) in enumerate(zip(beam, generated)):
+                if self.out_of_budget() or self.proof is not None:
+                    self.forget(beam[i:])
+                    break
+                children.extend(self.expand(node, generated_steps))
+            if self.proof is not None:
+                self.forget(children)
+                return self.proof
+            children.sort()
+            self.forget(children[beam_width:])
+            beam = children[:beam_width]
+        self.forget(beam)
+        return None
+
+    def context(self, node: _Node) -> str:
+        return node.steps[-1] if node.steps else self.lemma_statement
+
+    def expand(
+        self, node: _Node, generated_steps: Optional[list[tuple[str, float]]] = None
+    ) -> list[_Node]:
+        """Execute all steps the model proposes for a node, return the new nodes.
+
+        The model is called unless generated_steps are given.
+
+        If the model proposes "normalhammer", Sledgehammer runs in the background while the other
+        steps are executed; it is cancelled if one of them finishes the proof, or if it takes
+        longer than its timeout (plus HAMMER_GRACE).
+        If one of the steps finishes the proof, self.proof is set.
+        The node's state is forgotten afterwards.
+        """
+        print(header(f"Expanding {node.state_name} (score={node.score:.3f})"), file=self.out)
+        print(indent(node.proof_goals), file=self.out)
+        if generated_steps is None:
+            with self.session.timings.span("model"):
+                generated_steps = self.model(
+                    self.context(node), node.proof_goals, max_expansion=self.max_expansion
+                )
+        generated_steps = generated_steps[: self.max_expansion]
+
+        hammer_job: Optional[tuple[str, float, float]] = None  # (job id, subscore, deadline)
+        steps = list[str]()
+        subscores = list[float]()
+        for proof_step, subscore in generated_steps:
+            if proof_step.strip() == "normalhammer":
+                if hammer_job is None:
+                    timeout = self.hammer_timeout or DEFAULT_HAMMER_TIMEOUT
+                    deadline = min(self.end_time, time.time() + timeout + HAMMER_GRACE)
+                    job_id = self.session.hammer_async(node.state_name, timeout=self.hammer_timeout)
+                    hammer_job = (job_id, subscore, deadline)
+                continue
+            steps.append(proof_step)
+            subscores.append(subscore)
+
+        children = list[_Node]()
+        results = []
+        if steps:
+            results = self.session.execute_many(node.state_name, steps, node.state_name)
+        for i, (step, subscore, result) in enumerate(zip(steps, subscores, results)):
+            if self.proof is None:
+                self.add_child(node, f"{node.state_name}.{i}", step, subscore, result, children)
+            elif not isinstance(result, QIsabelleServerError):
+                self.session.forget_state(f"{node.state_name}.{i}")  # Not needed after a proof.
+
+        if hammer_job is not None:
+            job_id, subscore, deadline = hammer_job
+            if self.proof is not None:
+                self.session.hammer_cancel(job_id)
+            else:
+                hammer_step = self.wait_for_hammer(job_id, deadline)
+                if hammer_step is not None:
+                    child_name = f"{node.state_name}.{len(steps)}"
+                    try:
+                        result = self.session.execute(node.state_name, hammer_step, child_name)
+                    except QIsabelleServerError as e:
+                        result = e
+                    self.add_child(node, child_name, hammer_step, subscore, result, children)
+        self.forget([node])
+        return children
+
+    def wait_for_hammer(self, job_id: str, deadline: float) -> Optional[str]:
+        """Wait for a hammer job (cancelling it past deadline), return its proof or None."""
+        status, proof_or_message = self.session.hammer_status(job_id)
+        while status not in HAMMER_JOB_FINISHED:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                status, proof_or_message = self.session.hammer_cancel(job_id)
+                break
+            status, proof_or_message = self.session.hammer_status(job_id, min(remaining, 10.0))
+        if status == "success":
+            return proof_or_message
+        print(header(f"Hammer {status}"), file=self.out)
+        print(indent(proof_or_message.split("\n")[0]), file=self.out)
+        return None
+
+    def add_child(
+        self,
+        node: _Node,
+        child_name: str,
+        step: str,
+        subscore: float,
+        result: tuple[bool, str] | QIsabelleServerError,
+        children: list[_Node],
+    ) -> None:
+        """Add the result of executing a step on a node to children, or set self.proof."""
+        if isinstance(result, QIsabelleServerError):
+            return
+        self.n_nodes += 1
+        is_proof_done, proof_goals = result
+        if is_proof_done:
+            print(header(f"Proof found by {step!r}"), file=self.out)
+            self.proof = node.steps + [step]
+            self.session.forget_state(child_name)
+            return
+        child = self.add_node(child_name, proof_goals, node.steps + [step], node.score + subscore)
+        if child is None:
+            self.session.forget_state(child_name)
+        else:
+            children.append(child)
+
+    def add_node(
+        self, state_name: str, proof_goals: str, steps: list[str], score: float
+    ) -> Optional[_Node]:
+        """Make a node, unless its proof goals were already reached."""
+        normalized_goals = normalize_goals(proof_goals)
+        if normalized_goals in self.seen_goals:
+            return None
+        self.seen_goals.add(normalized_goals)
+        return _Node(-score, self.n_nodes, state_name, proof_goals, steps)
+
+    def forget(self, nodes: list[_Node]) -> None:
+        for node in nodes:
+            self.session.forget_state(node.state_name)
+
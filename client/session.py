@@ -1,12 +1,14 @@
 from __future__ import annotations
 
+import time
 from pathlib import Path
 from typing import Any, Optional, cast
 
-import requests
 from typing_extensions import Self
 
-JSON = dict[str, Any]
+from .proof_goals import GoalsCache, proof_state_hash
+from .timing import Timings
+from .transport import JSON, SERVER_TIME_KEY, HTTPTransport, Timeout, Transport
 
 
 class QIsabelleServerError(RuntimeError):
@@ -18,6 +20,14 @@ class QIsabelleSession:
 
     This is just a simple wrapper around the server's HTTP API.
     For documentation, do see `server/src/QISabelleServer.scala`.
+
+    Requests go through a Transport, by default a keep-alive HTTPTransport to localhost:port.
+    To see each request, enable DEBUG logging for `client.transport`.
+    The client and server time of each request is recorded in `timings` (see `timing.py`).
+    Proof goals of states are remembered in `goals` (see `proof_goals.py`), so that in goals_mode
+    "diff" the server only sends what changed from the state executed on.
+    Each request carries the `session_id` the server assigned, so several sessions (from one or
+    more clients) can use the same server, up to its QISABELLE_MAX_SESSIONS.
     """
 
     def __init__(
@@ -27,58 +37,96 @@ class QIsabelleSession:
         theory_path: Optional[Path] = None,
         port: int = 17000,
         debug: bool = True,
+        transport: Optional[Transport] = None,
+        goals_mode: str = "full",
+        shared: bool = False,
     ):
         """
         Either theory_path or (session_name and session_roots) must be provided.
+
+        If transport is given, port is ignored and the transport is not closed by the session.
+        goals_mode is how the server sends proof goals of results: "full" or "diff" (the returned
+        goals are the same, diffs are applied by the client).
+        If shared, the server reuses an Isabelle process already open for the same session by
+        another shared session, if any (states are still separate).
         """
+        assert goals_mode in ("full", "diff"), goals_mode
         self.port = port
         self.debug = debug
+        self.session_name = session_name
+        self.session_roots = session_roots
+        self.theory_path = theory_path
+        self._owns_transport = transport is None
+        self.transport: Transport = transport or HTTPTransport(port=port)
+        self.timings = Timings()  # Replace to collect timings elsewhere (e.g. per test case).
+        self.goals_mode = goals_mode
+        self.goals = GoalsCache()
+        self.session_id = ""  # Assigned by the server.
+        # Arguments and result of a load_theory run ahead of time (see `preload_theory`).
+        self._preloaded: Optional[tuple[tuple[str, str, bool, str, bool], tuple[bool, str]]] = None
+        self.shared = shared
         if debug:
             print("QIsabelleSession initializing..")
-        if theory_path is not None:
+        r = self._post(*self._open_request())
+        assert r["success"] == "success", r
+        self.session_id = cast(str, r["sessionId"])
+        if debug:
+            print("QIsabelleSession initialized.")
+
+    def _open_request(self) -> tuple[str, dict[str, Any]]:
+        """Path and arguments of the request opening this session on the server."""
+        if self.theory_path is not None:
             assert (
-                session_name is None and session_roots is None
+                self.session_name is None and self.session_roots is None
             ), "Cannot use both theory_path or session_name."
-            r = self._post(
+            return (
                 "/openIsabelleSessionForTheory",
-                {"theoryPath": str(theory_path)},
-            )
-        else:
-            assert (
-                session_name is not None and session_roots is not None
-            ), "Either theory_path or (session_name and session_roots) must be provided."
-            r = self._post(
-                "/openIsabelleSession",
-                {
-                    "sessionName": session_name,
-                    "sessionRoots": [str(p) for p in session_roots],
-                    "workingDir": "/home/isabelle/",
-                },
+                {"theoryPath": str(self.theory_path), "shared": self.shared},
             )
-        assert r == {"success": "success"}, r
-        if debug:
-            print("QIsabelleSession initialized.")
+        assert (
+            self.session_name is not None and self.session_roots is not None
+        ), "Either theory_path or (session_name and session_roots) must be provided."
+        return (
+            "/openIsabelleSession",
+            {
+                "sessionName": self.session_name,
+                "sessionRoots": [str(p) for p in self.session_roots],
+                "workingDir": "/home/isabelle/",
+                "shared": self.shared,
+            },
+        )
 
-    def _post(self, path: str, json_data: Optional[dict[str, Any]] = None) -> JSON:
-        if self.debug:
-            print(f"Request to http://localhost:{self.port}{path} with {json_data}")
-        response = requests.post(f"http://localhost:{self.port}{path}", json=json_data or {})
-        response.raise_for_status()
-        result = response.json()
-        assert isinstance(result, dict)
-        if "error" in result:
-            msg = result["error"]
-            if result.get("traceback"):
-                msg += "\nTraceback:\n" + result["traceback"]
-            raise QIsabelleServerError(msg)
-        return cast(JSON, result)
+    def _post(
+        self, path: str, json_data: Optional[dict[str, Any]] = None, timeout: Timeout = None
+    ) -> JSON:
+        json_data = json_data or {}
+        if self.session_id:
+            json_data = {**json_data, "sessionId": self.session_id}
+        start, start_counter = time.time(), time.perf_counter()
+        try:
+            result = self.transport.post(path, json_data, timeout)
+        except Exception:
+            self.timings.record(path, start, time.perf_counter() - start_counter)
+            raise
+        server_ms = result.pop(SERVER_TIME_KEY, None)
+        self.timings.record(
+            path,
+            start,
+            time.perf_counter() - start_counter,
+            None if server_ms is None else server_ms / 1000,
+        )
+        return check_result(result)
 
     def __enter__(self) -> Self:
         return self
 
     def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
-        r = self._post("/closeIsabelleSession")
-        assert r == {"success": "Closed"}, r
+        try:
+            r = self._post("/closeIsabelleSession")
+            assert r == {"success": "Closed"}, r
+        finally:
+            if self._owns_transport:
+                self.transport.close()
 
     def new_theory(
         self,
@@ -88,6 +136,7 @@ class QIsabelleSession:
         master_dir: Path = Path("/home/isabelle/"),
         only_import_from_session_heap: bool = True,
     ) -> None:
+        self.goals.forget(new_state_name)
         r = self._post(
             "/newTheory",
             {
@@ -103,6 +152,34 @@ class QIsabelleSession:
     def load_theory(
         self, theory_path: Path, until: str, inclusive: bool, new_state_name: str, init_only: bool = False
     ) -> tuple[bool, str]:
+        preloaded, self._preloaded = self._preloaded, None
+        key = (str(theory_path), until, inclusive, new_state_name, init_only)
+        if preloaded and preloaded[0] == key:
+            return preloaded[1]
+        return self._load_theory(theory_path, until, inclusive, new_state_name, init_only)
+
+    def preload_theory(
+        self,
+        theory_path: Path,
+        until: str,
+        inclusive: bool,
+        new_state_name: str,
+        init_only: bool = False,
+    ) -> tuple[bool, str]:
+        """Run load_theory ahead of time (e.g. in the background, before the session is used).
+
+        The next load_theory call, if it has the same arguments, then returns this result without
+        a request. Forgetting the state (or all states) cancels that.
+        """
+        result = self._load_theory(theory_path, until, inclusive, new_state_name, init_only)
+        key = (str(theory_path), until, inclusive, new_state_name, init_only)
+        self._preloaded = (key, result)
+        return result
+
+    def _load_theory(
+        self, theory_path: Path, until: str, inclusive: bool, new_state_name: str, init_only: bool
+    ) -> tuple[bool, str]:
+        goals_mode, _ = self.goals.request_mode(None, self.goals_mode)
         r = self._post(
             "/loadTheory",
             {
@@ -111,9 +188,20 @@ class QIsabelleSession:
                 "inclusive": inclusive,
                 "newStateName": new_state_name,
                 "initOnly": init_only,
+                "goalsMode": goals_mode,
             },
         )
-        return cast(bool, r["proofDone"]), cast(str, r["proofGoals"])
+        return cast(bool, r["proofDone"]), read_goals(self.goals, r, "", new_state_name)
+
+    def locate_lemma(self, theory_path: Path, lemma_statement: str) -> Optional[int]:
+        """Index of the lemma statement's transition in the theory (None if not found).
+
+        This parses the theory but executes nothing (see `lemma_index.py` for an offline check).
+        """
+        r = self._post(
+            "/locateLemma", {"theoryPath": str(theory_path), "lemmaStatement": lemma_statement}
+        )
+        return cast(int, r["transitionIndex"]) if r["found"] else None
 
     def describe_state(self, state_name: str) -> str:
         r = self._post("/describeState", {"stateName": state_name})
@@ -132,34 +220,280 @@ class QIsabelleSession:
         return cast(str, r["description"])
 
     def execute(self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0) -> tuple[bool, str]:
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
         r = self._post(
             "/execute",
-            {"stateName": state_name, "isarCode": isar_code, "newStateName": new_state_name, "timeout": timeout},
+            {
+                "stateName": state_name,
+                "isarCode": isar_code,
+                "newStateName": new_state_name,
+                "timeout": timeout,
+                "goalsMode": goals_mode,
+            },
         )
-        return cast(bool, r["proofDone"]), cast(str, r["proofGoals"])
+        return cast(bool, r["proofDone"]), read_goals(self.goals, r, parent_goals, new_state_name)
+
+    def execute_hashed(
+        self, state_name: str, isar_code: str, new_state_name: str, timeout: int = 0
+    ) -> tuple[bool, str]:
+        """Like `execute()`, but return (proof_done, proof_state_hash) without receiving the goals.
+
+        Use `proof_goals(new_state_name)` to get them when needed.
+        """
+        r = self._post(
+            "/execute",
+            {
+                "stateName": state_name,
+                "isarCode": isar_code,
+                "newStateName": new_state_name,
+                "timeout": timeout,
+                "goalsMode": "none",
+            },
+        )
+        self.goals.read(r, "", new_state_name)
+        return cast(bool, r["proofDone"]), cast(str, r["proofStateHash"])
+
+    def proof_goals(self, state_name: str) -> str:
+        """Proof goals of a state, as `execute()` returned them (only requested if not known)."""
+        goals = self.goals.goals(state_name)
+        if goals is None:
+            r = self._post("/getProofGoals", {"stateName": state_name})
+            goals = read_goals(self.goals, r, "", state_name)
+        return goals
+
+    def proof_state_hash(self, state_name: str) -> str:
+        """A hash of the proof goals of a state (see `proof_goals.proof_state_hash`)."""
+        return self.goals.hash(state_name) or proof_state_hash(self.proof_goals(state_name))
+
+    def execute_many(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        new_state_prefix: str = "",
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        """Execute several alternative Isar snippets, each one on the same state, in one request.
+
+        Args:
+        - state_name: state to execute each snippet on.
+        - isar_codes: snippets to execute.
+        - new_state_prefix: if non-empty, save the result of isar_codes[i]
+          as f"{new_state_prefix}.{i}" (unless it failed).
+        - timeouts: per-transition timeouts for each snippet, like `timeout` in `execute()`.
+        - new_state_names: explicit names to save results under instead ("" means don't save).
+
+        Returns a list with, for each snippet, either (proof_done, proof_goals) as in `execute()`,
+        or the error it raised (not raised, so that one bad snippet doesn't fail the rest).
+        """
+        names = new_state_names or many_state_names(new_state_prefix, len(isar_codes))
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
+        r = self._post(
+            "/executeMany",
+            {
+                "stateName": state_name,
+                "isarCodes": isar_codes,
+                "timeouts": timeouts or [],
+                "newStateNames": names,
+                "goalsMode": goals_mode,
+            },
+        )
+        return [
+            parse_many_result(result, self.goals, parent_goals, names[i] if i < len(names) else "")
+            for i, result in enumerate(r["results"])
+        ]
+
+    def execute_chain(
+        self,
+        state_name: str,
+        isar_codes: list[str],
+        timeouts: Optional[list[int]] = None,
+        new_state_names: Optional[list[str]] = None,
+    ) -> list[tuple[bool, str] | QIsabelleServerError]:
+        """Execute Isar snippets one after the other (each on the result of the previous one).
+
+        Args:
+        - state_name: state to execute the first snippet on.
+        - isar_codes: snippets to execute, in order.
+        - timeouts: per-transition timeouts for each snippet, like `timeout` in `execute()`.
+        - new_state_names: names to save results under ("" or missing means don't save).
+
+        Returns a list with, for each snippet until the first one that failed, either
+        (proof_done, proof_goals) as in `execute()`, or the error it raised (the last item).
+        """
+        names = new_state_names or []
+        goals_mode, parent_goals = self.goals.request_mode(state_name, self.goals_mode)
+        r = self._post(
+            "/executeChain",
+            {
+                "stateName": state_name,
+                "isarCodes": isar_codes,
+                "timeouts": timeouts or [],
+                "newStateNames": names,
+                "goalsMode": goals_mode,
+            },
+        )
+        return parse_chain_results(r["results"], self.goals, parent_goals, names)
 
     def forget_state(self, state_name: str) -> None:
+        if self._preloaded and self._preloaded[0][3] == state_name:
+            self._preloaded = None
+        self.goals.forget(state_name)
         r = self._post("/forgetState", {"stateName": state_name})
         assert r == {"success": "success"}, r
 
     def forget_all_states(self) -> None:
+        self._preloaded = None
+        self.goals.clear()
         r = self._post("/forgetAllStates")
         assert r == {"success": "success"}, r
 
     def hammer(
-        self, state_name: str, added_facts: list[str] = [], deleted_facts: list[str] = []
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
     ) -> str:
+        """Run Sledgehammer on a state, return a proof (not guaranteed to work).
+
+        timeout is the soft timeout in seconds (0 means the server's default, 30s); the call can
+        take 10s longer.
+        """
         r = self._post(
             "/hammer",
-            {"stateName": state_name, "addedFacts": added_facts, "deletedFacts": deleted_facts},
+            {
+                "stateName": state_name,
+                "addedFacts": added_facts,
+                "deletedFacts": deleted_facts,
+                "timeout": timeout,
+            },
         )
         return cast(str, r["proof"])
 
+    def hammer_async(
+        self,
+        state_name: str,
+        added_facts: list[str] = [],
+        deleted_facts: list[str] = [],
+        timeout: float = 0.0,
+    ) -> str:
+        """Start running Sledgehammer in the background, return a job id for `hammer_status()`."""
+        r = self._post(
+            "/hammerAsync",
+            {
+                "stateName": state_name,
+                "addedFacts": added_facts,
+                "deletedFacts": deleted_facts,
+                "timeout": timeout,
+            },
+        )
+        return cast(str, r["jobId"])
+
+    def hammer_status(self, job_id: str, wait: float = 0.0) -> tuple[str, str]:
+        """
+        Status of a hammer job, waiting at most `wait` seconds for it to finish.
+
+        Returns (status, proof_or_message), where status is one of HAMMER_JOB_STATUSES:
+        "success" comes with the proof, "failure" with the error message `hammer()` would raise.
+        """
+        r = self._post("/hammerStatus", {"jobId": job_id, "waitSeconds": wait})
+        return parse_hammer_status(r)
+
+    def hammer_cancel(self, job_id: str) -> tuple[str, str]:
+        """Cancel a hammer job (if not finished yet), return its status like `hammer_status()`."""
+        return parse_hammer_status(self._post("/hammerCancel", {"jobId": job_id}))
+
+    def stats(self) -> JSON:
+        """Server statistics: state counts, evictions, JVM and ML memory (see `/stats`)."""
+        return self._post("/stats")
+
+
+def check_result(result: JSON) -> JSON:
+    """Raise QIsabelleServerError if a server response is an error, otherwise return it."""
+    if "error" in result:
+        msg = result["error"]
+        if result.get("traceback"):
+            msg += "\nTraceback:\n" + result["traceback"]
+        raise QIsabelleServerError(msg)
+    return result
+
+
+HAMMER_JOB_STATUSES = ("queued", "running", "success", "failure", "cancelled")
+HAMMER_JOB_FINISHED = ("success", "failure", "cancelled")
+
+
+def parse_hammer_status(result: JSON) -> tuple[str, str]:
+    """Parse a `/hammerStatus` or `/hammerCancel` response into (status, proof_or_message)."""
+    status = cast(str, result["status"])
+    assert status in HAMMER_JOB_STATUSES, status
+    return status, cast(str, result["proof"] if status == "success" else result["message"])
+
+
+def many_state_names(new_state_prefix: str, n: int) -> list[str]:
+    """State names for results of `execute_many()` (empty if results are not to be saved)."""
+    return [f"{new_state_prefix}.{i}" for i in range(n)] if new_state_prefix else []
+
+
+def parse_many_result(
+    result: JSON, goals: GoalsCache, parent_goals: str, new_state_name: str
+) -> tuple[bool, str] | QIsabelleServerError:
+    """Parse one result from an `/executeMany` response (see `GoalsCache.read` for the rest)."""
+    try:
+        r = check_result(result)
+    except QIsabelleServerError as e:
+        return e
+    return cast(bool, r["proofDone"]), read_goals(goals, r, parent_goals, new_state_name)
+
+
+def parse_chain_results(
+    results: list[JSON], goals: GoalsCache, parent_goals: str, new_state_names: list[str]
+) -> list[tuple[bool, str] | QIsabelleServerError]:
+    """Parse the results of an `/executeChain` response (diffs are against the previous result)."""
+    parsed = list[tuple[bool, str] | QIsabelleServerError]()
+    for i, result in enumerate(results):
+        name = new_state_names[i] if i < len(new_state_names) else ""
+        parsed.append(parse_many_result(result, goals, parent_goals, name))
+        if isinstance(parsed[-1], tuple):
+            parent_goals = parsed[-1][1]
+    return parsed
+
+
+def read_goals(goals: GoalsCache, result: JSON, parent_goals: str, new_state_name: str) -> str:
+    """Proof goals of a result with goals sent in full or as a diff (see `GoalsCache.read`)."""
+    proof_goals = goals.read(result, parent_goals, new_state_name)
+    assert proof_goals is not None, "Proof goals were not sent."
+    return proof_goals
+
+
+def guess_session_name(theory_path: Path) -> str:
+    """Guess name of the Isabelle session containing a theory, like the server does.
+
+    Mirrors `IsabelleSession.guessSessionName` in `server/src/IsabelleSession.scala`.
+    """
+    parts = theory_path.parts
+    if "afp" in str(theory_path):
+        return parts[parts.index("thys") + 1]
+    elif "Isabelle" in str(theory_path) and "src" in parts:
+        return "-".join(theory_path.parent.parts[parts.index("src") + 1 :])
+    elif "miniF2F" in str(theory_path):
+        return "HOL"
+    else:
+        raise ValueError(f"Unsupported file path: {theory_path}")
+
+
+# Server errors meaning our session is gone (e.g. closed to make room for others).
+SESSION_FAILURES = ("No Isabelle session open", "Session not found", "Session closed")
+# Server errors meaning the Isabelle process is gone.
+PROCESS_FAILURES = ("IsabelleDestroyedException", "OutOfMemoryError")
+
 
 def get_exception_kind(e: Exception) -> str:
     s = repr(e)
     if "Transition not found" in s:
         return "not-found"
+    elif "State evicted" in s:
+        return "state-evicted"
     elif "NoSuchFileException" in s:
         return "no-such-file"
     elif "Sledgehammer timeout: Timed out" in s:
@@ -170,6 +504,8 @@ def get_exception_kind(e: Exception) -> str:
         return "timeout-hard"
     elif "IsabelleMLException: Timeout" in s:
         return "execution-timeout"
+    elif "Proof search timeout" in s:
+        return "search-timeout"
     elif "Failed to apply initial proof method" in s:
         return "failed-proof"
     else:
@@ -0,0 +1,197 @@
+"""Reusing Isabelle sessions across test cases."""
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from typing_extensions import Self
+
+from .cache import CachedQIsabelleSession, ResultCache
+from .router import ReplicaRouter, RoutedQIsabelleSession
+from .session import QIsabelleSession, guess_session_name
+from .test_cases import TestCase
+
+AFP_THYS_DIR = Path("/afp/thys")
+
+
+class SessionManager:
+    """Keeps a QIsabelleSession open between theories that need the same Isabelle session.
+
+    Opening a session (starting Isabelle with a session heap) takes a dozen seconds,
+    so we only reopen when the session guessed for a theory changes.
+    Between uses, all states of a reused session are forgotten.
+    If a cache is given, sessions are CachedQIsabelleSessions using it. If a router is given
+    instead, sessions are RoutedQIsabelleSessions opened on the replica it picks (port is ignored),
+    that fail over to another replica if theirs dies.
+
+    With prefetch, `prefetch()` prepares the session of the next test in the background, while the
+    current one is in use: it opens a second session on the same server (sharing the Isabelle
+    process if the session is the same, see "shared" in `QIsabelleSession`) and preloads the
+    lemma (see `QIsabelleSession.preload_theory`). `get()` then switches to it. This needs a
+    server with QISABELLE_MAX_SESSIONS at least 2 (prefetching is disabled otherwise), and twice
+    the memory when consecutive tests need different Isabelle sessions.
+    """
+
+    def __init__(
+        self,
+        port: int = 17000,
+        debug: bool = True,
+        cache: Optional[ResultCache] = None,
+        prefetch: bool = False,
+        router: Optional[ReplicaRouter] = None,
+    ):
+        assert cache is None or router is None, "Sessions can't be both cached and routed."
+        self.port = port
+        self.debug = debug
+        self.cache = cache
+        self.router = router
+        self.prefetch_enabled = prefetch
+        self._capacity_checked = False
+        self.session: Optional[QIsabelleSession] = None
+        self.session_name: Optional[str] = None
+        self.n_opened = 0
+        self.n_reused = 0
+        self.n_prefetched = 0  # Sessions taken from a prefetch.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"prefetch-{port}")
+        # The prefetched session and the (theory_path, lemma_statement) it was prepared for.
+        self._warm: Optional[Future[QIsabelleSession]] = None
+        self._warm_for: Optional[tuple[Path, str]] = None
+
+    def get(self, theory_path: Path) -> QIsabelleSession:
+        """Get a session in which `theory_path` can be loaded.
+
+        It has no states, except the one preloaded if it was prefetched (see `prefetch()`).
+        """
+        session_name = guess_session_name(theory_path)
+        warm = self._take_warm(session_name)
+        if warm is not None:
+            self.close()
+            self.session, self.session_name = warm, session_name
+            self.n_prefetched += 1
+            return warm
+        if self.session is not None and self.session_name == session_name:
+            try:
+                self.session.forget_all_states()
+                self.n_reused += 1
+                return self.session
+            except Exception as e:
+                print(f"SessionManager: reopening session {session_name} after error: {e}")
+        self.close()
+        self.session = self._open(theory_path)
+        self.session_name = session_name
+        return self.session
+
+    def prefetch(self, theory_path: Path, lemma_statement: str, state_name: str) -> None:
+        """Start preparing a session for a next test in the background, if prefetch is enabled.
+
+        Args:
+        - theory_path: of the next test.
+        - lemma_statement: of the next test, loaded in advance.
+        - state_name: the state name the next test will load the lemma under.
+        """
+        if not self.prefetch_enabled or self._warm_for == (theory_path, lemma_statement):
+            return
+        if not self._capacity_checked and self.session is not None:
+            self._capacity_checked = True
+            if self.session.stats().get("sessionCapacity", 1) < 2:
+                print("SessionManager: prefetch disabled, server has QISABELLE_MAX_SESSIONS < 2.")
+                self.prefetch_enabled = False
+                return
+        self._discard_warm()
+
+        def prepare() -> QIsabelleSession:
+            session = self._open(theory_path)
+            try:
+                session.preload_theory(theory_path, lemma_statement, True, state_name)
+            except Exception as e:
+                # Let the test itself fail on load_theory, with the usual error handling.
+                print(f"SessionManager: preloading failed: {e}")
+            return session
+
+        self._warm = self._executor.submit(prepare)
+        self._warm_for = (theory_path, lemma_statement)
+
+    def _open(self, theory_path: Path) -> QIsabelleSession:
+        # Prefetching keeps two sessions open, sharing the Isabelle process if they can.
+        shared = self.prefetch_enabled
+        session: QIsabelleSession
+        if self.cache is not None:
+            session = CachedQIsabelleSession(
+                self.cache,
+                theory_path=theory_path,
+                port=self.port,
+                debug=self.debug,
+                shared=shared,
+            )
+        elif self.router is not None:
+            session = RoutedQIsabelleSession(
+                self.router, theory_path=theory_path, debug=self.debug, shared=shared
+            )
+        else:
+            session = QIsabelleSession(
+                theory_path=theory_path, port=self.port, debug=self.debug, shared=shared
+            )
+        self.n_opened += 1
+        return session
+
+    def _take_warm(self, session_name: str) -> Optional[QIsabelleSession]:
+        """The prefetched session, if it's for session_name (waiting for it to be ready)."""
+        if self._warm is None or self._warm_for is None:
+            return None
+        if guess_session_name(self._warm_for[0]) != session_name:
+            self._discard_warm()
+            return None
+        warm, self._warm, self._warm_for = self._warm, None, None
+        try:
+            return warm.result()
+        except Exception as e:
+            print(f"SessionManager: prefetched session failed to open: {e}")
+            return None
+
+    def _discard_warm(self) -> None:
+        """Close the prefetched session, if any (in the background)."""
+        warm, self._warm, self._warm_for = self._warm, None, None
+        if warm is not None:
+            self._executor.submit(lambda: _close_quietly(warm.result()))
+
+    def close(self) -> None:
+        """Close the current session, if any (ignoring errors, the server may be dead)."""
+        session, self.session, self.session_name = self.session, None, None
+        if session is not None:
+            _close_quietly(session)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self._discard_warm()
+        self._executor.shutdown()
+        self.close()
+
+
+def _close_quietly(session: QIsabelleSession) -> None:
+    """Close a session, ignoring errors (the server may be dead)."""
+    try:
+        session.__exit__(None, None, None)
+    except Exception as e:
+        print(f"SessionManager: error when closing session: {e}")
+
+
+def group_by_session(tests: list[TestCase]) -> list[list[TestCase]]:
+    """Group test cases by the Isabelle session they need, largest groups first.
+
+    Within a group, tests on the same theory file are kept together (in their original order).
+    """
+    groups: dict[str, list[TestCase]] = defaultdict(list)
+    for test_case in tests:
+        groups[guess_session_name(AFP_THYS_DIR / test_case.thy_file)].append(test_case)
+    result = list[list[TestCase]]()
+    for group in groups.values():
+        first_index: dict[Path, int] = {}
+        for i, test_case in enumerate(group):
+            first_index.setdefault(test_case.thy_file, i)
+        result.append(sorted(group, key=lambda t: first_index[t.thy_file]))
+    result.sort(key=len, reverse=True)
+    return result
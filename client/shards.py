@@ -0,0 +1,78 @@
+"""Splitting a test suite into shards, to evaluate it on several machines.
+
+Each machine runs `python -m client.main run --shard i/n ...` with the same suite and options, and
+gets a deterministic, disjoint part of the tests. Tests are assigned by the Isabelle session they
+need (the AFP entry of their theory file, see `group_by_session`), so that each session is only
+opened on one machine, and shards are balanced by expected cost: the durations of previous runs
+if given (see `results.py`), else a default per test, plus the time to open the session.
+Per-shard results files are then merged with `python -m client.main merge`.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from statistics import mean
+from typing import Optional
+
+from .results import TestResult
+from .session import guess_session_name
+from .session_manager import AFP_THYS_DIR
+from .test_cases import TestCase
+
+DEFAULT_TEST_SECONDS = 60.0  # Expected duration of a test, without previous results.
+SESSION_OPEN_SECONDS = 15.0  # Expected time to open an Isabelle session.
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse "i/n" into (i, n), with 0 <= i < n."""
+    i, sep, n = spec.partition("/")
+    if not sep or not i.isdigit() or not n.isdigit() or not 0 <= int(i) < int(n):
+        raise ValueError(f"Invalid shard: {spec!r} (expected i/n with 0 <= i < n)")
+    return int(i), int(n)
+
+
+def expected_costs(
+    tests: list[TestCase], priors: Optional[dict[str, TestResult]] = None
+) -> dict[str, float]:
+    """Expected seconds of each test (by name): its previous duration, else the mean one."""
+    priors = priors or {}
+    durations = [priors[t.name].duration for t in tests if t.name in priors]
+    default = mean(durations) if durations else DEFAULT_TEST_SECONDS
+    return {t.name: priors[t.name].duration if t.name in priors else default for t in tests}
+
+
+def assign_shards(
+    tests: list[TestCase], n_shards: int, priors: Optional[dict[str, TestResult]] = None
+) -> list[list[TestCase]]:
+    """Split tests into n_shards lists, keeping tests of an Isabelle session together.
+
+    Sessions are assigned greedily, most expensive first, each to the currently cheapest shard
+    (ties are broken by session name and shard index, so this is deterministic). Tests keep their
+    original order within each shard.
+    """
+    costs = expected_costs(tests, priors)
+    session_costs: dict[str, float] = defaultdict(lambda: SESSION_OPEN_SECONDS)
+    session_names = dict[str, str]()  # Test name -> session name.
+    for test in tests:
+        session_name = guess_session_name(AFP_THYS_DIR / test.thy_file)
+        session_names[test.name] = session_name
+        session_costs[session_name] += costs[test.name]
+    shard_costs = [0.0] * n_shards
+    shard_of = dict[str, int]()  # Session name -> shard index.
+    for session_name, cost in sorted(session_costs.items(), key=lambda item: (-item[1], item[0])):
+        shard = min(range(n_shards), key=lambda i: (shard_costs[i], i))
+        shard_of[session_name] = shard
+        shard_costs[shard] += cost
+    shards = [list[TestCase]() for _ in range(n_shards)]
+    for test in tests:
+        shards[shard_of[session_names[test.name]]].append(test)
+    return shards
+
+
+def shard_tests(
+    tests: list[TestCase],
+    shard: int,
+    n_shards: int,
+    priors: Optional[dict[str, TestResult]] = None,
+) -> list[TestCase]:
+    """The tests of one shard (see `assign_shards`)."""
+    return assign_shards(tests, n_shards, priors)[shard]
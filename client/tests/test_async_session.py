@@ -0,0 +1,66 @@
+"""Tests of AsyncQIsabelleSession and AsyncHTTPTransport against the mock server."""
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+
+from client.async_session import AsyncQIsabelleSession
+from client.mock_server import MockQIsabelleServer
+from client.transport import AsyncHTTPTransport
+
+THEORY_PATH = Path("/afp/thys/Foo/Foo.thy")
+
+
+def test_async_session_against_mock_server() -> None:
+    async def run(port: int) -> None:
+        async with AsyncQIsabelleSession(theory_path=THEORY_PATH, port=port, debug=False) as s:
+            assert s.session_id
+            proof_done, goals = await s.load_theory(THEORY_PATH, "lemma foo: x", True, "s")
+            assert not proof_done and "lemma foo: x" in goals
+            assert await s.get_mode("s") == "Proof"
+            proof_done, goals = await s.execute("s", "apply simp", "s1")
+            assert not proof_done and goals.rstrip().endswith("apply simp")
+            results = await s.execute_chain("s1", ["apply auto", "done"], None, ["", "s3"])
+            assert len(results) == 2 and results[1] == (True, "")
+            assert await s.get_mode("s3") == "Theory"
+            assert await s.hammer("s1") == "by auto"
+            await s.forget_all_states()
+            assert (await s.stats())["stateCount"] == 0
+        assert len(server.sessions) == 0
+
+    with MockQIsabelleServer() as server:
+        asyncio.run(run(server.port))
+
+
+def test_async_transport_retries_stale_connection() -> None:
+    """A kept-alive connection closed by the server is replaced, the request isn't lost."""
+    n_connections = 0
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Answer one request, then close the connection when the next one arrives (without
+        # "Connection: close"), like a server that timed out the idle connection meanwhile.
+        nonlocal n_connections
+        n_connections += 1
+        for answer in (True, False):
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass  # Skip the request line and headers.
+            await reader.readexactly(2)  # The body, "{}".
+            if answer:
+                body = b'{"success": "success"}'
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+                await writer.drain()
+        writer.close()
+
+    async def run() -> None:
+        server = await asyncio.start_server(handle, "localhost", 0)
+        port = server.sockets[0].getsockname()[1]
+        transport = AsyncHTTPTransport(port=port, connect_retries=0)
+        try:
+            assert await transport.post("/a", {}) == {"success": "success"}
+            assert await transport.post("/b", {}) == {"success": "success"}
+        finally:
+            await transport.close()
+            server.close()
+        assert n_connections == 2
+
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+"""Tests of BudgetScheduler, with fake priors (no server needed)."""
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import pytest
+
+from client.budget import DEFAULT_HAMMER_TIMEOUT, Budget, BudgetScheduler
+# Renamed, so that pytest doesn't try to collect them as test classes.
+from client.results import TestResult as Result
+from client.test_cases import TestCase as Case
+
+
+def _test(name: str) -> Case:
+    return Case(name, Path("Foo/A.thy"), f"lemma {name}: True")
+
+
+def _result(name: str, kind: str, **kwargs: Any) -> Result:
+    return Result(name, "Foo/A.thy", kind, **kwargs)
+
+
+def test_priors_order_and_budgets() -> None:
+    tests = [_test(name) for name in ["unknown", "slow", "fast", "failed", "timed_out"]]
+    priors = {
+        "slow": _result("slow", "success", duration=40.0, hammer_timeout=0.0),  # No budget.
+        "fast": _result("fast", "success", duration=5.0, hammer_timeout=15.0),
+        "failed": _result("failed", "failure"),
+        "timed_out": _result("timed_out", "timeout-soft", search_time=100.0, hammer_timeout=10.0),
+    }
+    scheduler = BudgetScheduler(tests, total_time=1000.0, priors=priors, hammer_timeout=10.0)
+    assert scheduler.peek() == tests[2]
+
+    handed_out = list[tuple[str, Budget]]()
+    while (next_test := scheduler.next()) is not None:
+        test, budget = next_test
+        handed_out.append((test.name, budget))
+        scheduler.report(test, budget, _result(test.name, "success"))
+    assert [name for name, _ in handed_out] == ["fast", "slow", "unknown", "failed", "timed_out"]
+    budgets = dict(handed_out)
+    # Previous successes: twice their previous duration (at least min_search_time), and the
+    # hammer timeout they were solved with (the server's default if none was given).
+    assert budgets["fast"] == Budget(30.0, 15.0)
+    assert budgets["slow"] == Budget(80.0, DEFAULT_HAMMER_TIMEOUT)
+    # Fair shares of the remaining time (capped by max_search_time), short hammer timeouts.
+    assert budgets["unknown"].search_time == pytest.approx(1000.0 / 2, abs=0.5)
+    assert budgets["unknown"].hammer_timeout == 10.0
+    assert budgets["failed"] == Budget(500.0, 10.0)
+    # Previous timeouts are retried last, with a larger hammer timeout.
+    assert budgets["timed_out"] == Budget(100.0, 20.0, attempt=1)
+
+
+def test_retries_wait_for_running_tests() -> None:
+    test = _test("a")
+    scheduler = BudgetScheduler([test], total_time=2000.0, hammer_timeout=10.0, max_attempts=3)
+    next_test = scheduler.next()
+    assert next_test == (test, Budget(500.0, 10.0))
+
+    # Nothing is left to hand out, but the running test may be retried: next() waits for it.
+    retried: list[Optional[tuple[Case, Budget]]] = []
+    waiting = threading.Thread(target=lambda: retried.append(scheduler.next()))
+    waiting.start()
+    time.sleep(0.2)
+    assert waiting.is_alive()
+    scheduler.report(test, next_test[1], _result("a", "timeout-soft"))
+    waiting.join(timeout=5.0)
+    # The hammer timeout grows, and the search time leaves room for it.
+    assert retried == [(test, Budget(500.0, 20.0, attempt=1))]
+
+    scheduler.report(test, Budget(500.0, 20.0, attempt=1), _result("a", "search-timeout"))
+    next_test = scheduler.next()
+    assert next_test is not None
+    assert next_test[1].hammer_timeout == 20.0 and next_test[1].attempt == 2
+    assert next_test[1].search_time == 1000.0
+
+    # After max_attempts runs, a test isn't retried anymore.
+    scheduler.report(test, next_test[1], _result("a", "timeout-hard"))
+    assert scheduler.next() is None and scheduler.n_pending == 0
+
+
+def test_deadline() -> None:
+    a, b = _test("a"), _test("b")
+    priors = {"a": _result("a", "success", duration=100.0)}
+    scheduler = BudgetScheduler([a, b], total_time=60.0, priors=priors, min_search_time=30.0)
+    # Budgets are capped so that tests end by the deadline.
+    next_test = scheduler.next()
+    assert next_test is not None and next_test[0] == a
+    assert 59.0 < next_test[1].search_time <= 60.0
+    # Retries that don't fit in the remaining time aren't handed out.
+    scheduler.report(a, next_test[1], _result("a", "search-timeout"))
+    next_test = scheduler.next()
+    assert next_test is not None and next_test[0] == b
+    scheduler.report(b, next_test[1], _result("b", "success"))
+    assert scheduler.next() is None and scheduler.n_pending == 1
+
+    # No tests are handed out after the deadline.
+    scheduler = BudgetScheduler([a, b], total_time=0.1)
+    time.sleep(0.2)
+    assert scheduler.next() is None and scheduler.n_pending == 2
@@ -0,0 +1,81 @@
+"""Round-trip tests of the extraction store format."""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import pytest
+
+from client.extraction_store import ExtractionStore, KnownNextStepModel, build_extraction_store
+from client.extractions import Extraction
+
+EXTRACTIONS = [
+    Extraction(
+        thy_file=Path("Foo/A.thy"),
+        working_directory=Path("Foo"),
+        lemma_statements=["lemma a: \"x = x\"", "lemma b: True", "lemma unproved: False"],
+        translations=[
+            ("", "lemma a: \"x = x\""),
+            ("proof (prove)\ngoal (1 subgoal):\n 1. x = x", "by simp"),
+            ("", "lemma b: True"),
+            ("proof (prove)\ngoal (1 subgoal):\n 1. True", "apply auto"),
+            ("proof (prove)\ngoal: No subgoals!", "done"),
+        ],
+    ),
+    Extraction(
+        thy_file=Path("Bar/B.thy"),
+        working_directory=Path("Bar"),
+        lemma_statements=["lemma a: \"x = x\""],
+        translations=[("", "lemma a: \"x = x\""), ("unicode: ∀x. x = x ⟹ ⊤", "by blast")],
+    ),
+    Extraction(Path("Baz/C.thy"), Path("Baz"), [], []),
+]
+
+
+def test_round_trip(tmp_path: Path) -> None:
+    path = tmp_path / "store.bin"
+    build_extraction_store(EXTRACTIONS, path)
+    with ExtractionStore(path) as store:
+        assert (store.n_extractions, store.n_lemmas, store.n_translations) == (3, 4, 7)
+        assert list(store) == EXTRACTIONS
+        assert [store.thy_file(i) for i in range(3)] == [e.thy_file for e in EXTRACTIONS]
+        all_translations = [t for e in EXTRACTIONS for t in e.translations]
+        assert list(store.translations(0, store.n_translations)) == all_translations
+
+        # Lemmas are looked up by theory file and statement (ignoring whitespace).
+        assert store.lemma_translations(Path("Foo/A.thy"), "lemma  b:\nTrue") == [
+            ("", "lemma b: True"),
+            ("proof (prove)\ngoal (1 subgoal):\n 1. True", "apply auto"),
+            ("proof (prove)\ngoal: No subgoals!", "done"),
+        ]
+        assert store.lemma_translations(Path("Bar/B.thy"), "lemma a: \"x = x\"")[1] == (
+            "unicode: ∀x. x = x ⟹ ⊤",
+            "by blast",
+        )
+        assert store.lemma_span(Path("Foo/A.thy"), "lemma unproved: False") == (5, 5)
+        assert store.lemma_span(Path("Foo/A.thy"), "lemma missing: False") is None
+        assert store.lemma_span(Path("Baz/C.thy"), "lemma b: True") is None
+
+        # Next steps are looked up by proof state (ignoring whitespace).
+        assert store.next_step("proof (prove) goal (1 subgoal): 1. True") == "apply auto"
+        assert store.next_step("unicode: ∀x. x = x ⟹ ⊤") == "by blast"
+        assert store.next_step("unknown") is None
+        assert KnownNextStepModel(store)("", "unicode: ∀x.  x = x ⟹ ⊤") == [("by blast", 0.1)]
+
+
+def _n_open_files() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="Needs /proc to count open files.")
+def test_rejects_other_files(tmp_path: Path) -> None:
+    n_open_files = _n_open_files()
+    path = tmp_path / "not_a_store.bin"
+    for content in [b"x" * 100, b"x"]:
+        path.write_bytes(content)
+        with pytest.raises(ValueError, match="Not an extraction store"):
+            ExtractionStore(path)
+    path.write_bytes(b"")
+    with pytest.raises(ValueError):
+        ExtractionStore(path)
+    assert _n_open_files() == n_open_files  # The file and its mmap were closed.
@@ -0,0 +1,94 @@
+"""Tests of the offline lemma index, on a small fake AFP."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from client.lemma_index import LemmaIndex, LemmaLocation, validate_test_cases
+from client.test_cases import TestCase as Case  # Renamed, so that pytest doesn't collect it.
+
+A_THY = """theory A imports Main begin
+
+lemma foo: "x = x"
+  by simp
+
+lemma foo_bar:
+  "x = x \\<and>
+   True"
+  by simp
+
+  theorem long: "LONG"
+  by auto
+
+lemma foo: "y = y"
+  by simp
+
+lemma last: "z"
+""".replace("LONG", "a  \n   " * 100)  # 100 more lines.
+
+B_THY = """theory B imports A begin
+lemma foo: "x = x" by simp
+end
+"""
+
+
+@pytest.fixture
+def thys_dir(tmp_path: Path) -> Path:
+    (tmp_path / "Foo").mkdir()
+    (tmp_path / "Foo" / "A.thy").write_text(A_THY)
+    (tmp_path / "Foo" / "B.thy").write_text(B_THY)
+    return tmp_path
+
+
+A, B = Path("Foo/A.thy"), Path("Foo/B.thy")
+
+
+def test_locate(thys_dir: Path) -> None:
+    index = LemmaIndex.build(thys_dir)
+    assert index.locate(A, 'lemma foo: "x = x"') == LemmaLocation(A, 3)
+    assert index.locate(A, 'lemma foo: "y = y"') == LemmaLocation(A, 114)  # Same key as line 3.
+    assert index.locate(B, 'lemma foo: "x = x"') == LemmaLocation(B, 2)
+    assert index.locate(Path("Foo/C.thy"), 'lemma foo: "x = x"') is None
+    assert index.locate(A, 'lemma foo: "z = z"') is None
+    assert index.locate(A, 'lemma bar: "x = x"') is None
+    assert index.find('lemma foo: "x = x"') == [LemmaLocation(A, 3), LemmaLocation(B, 2)]
+    assert index.exists(A) and not index.exists(Path("Foo/C.thy"))
+
+
+def test_matches_whole_statements(thys_dir: Path) -> None:
+    index = LemmaIndex.build(thys_dir, thy_files=[A, Path("Foo/C.thy")])
+    # Whitespace (including newlines) is ignored.
+    assert index.locate(A, 'lemma   foo_bar: "x = x \\<and> True"') == LemmaLocation(A, 6)
+    # Statements much longer once their whitespace is normalized.
+    long_statement = 'theorem long: "' + "a " * 100 + '"'
+    assert index.locate(A, long_statement) == LemmaLocation(A, 11)
+    assert index.locate(A, long_statement + " and more") is None
+    # The statement must end where a word ends.
+    assert index.locate(A, 'lemma foo_bar: "x = x \\<and> Tru') is None
+    assert index.locate(A, 'lemma foo_bar: "x = x \\<and>') == LemmaLocation(A, 6)
+    # At the end of a file.
+    assert index.locate(A, 'lemma last: "z"') == LemmaLocation(A, 117)
+    assert index.locate(A, 'lemma last: "z" and more') is None
+    # Only the given files are indexed.
+    assert index.locate(B, 'lemma foo: "x = x"') is None
+
+
+def test_save_load(thys_dir: Path, tmp_path: Path) -> None:
+    index = LemmaIndex.build(thys_dir)
+    index.save(tmp_path / "index.json")
+    loaded = LemmaIndex.load(tmp_path / "index.json", thys_dir)
+    assert loaded.entries == index.entries
+    assert loaded.locate(A, 'lemma foo: "y = y"') == LemmaLocation(A, 114)
+
+
+def test_validate_test_cases(thys_dir: Path) -> None:
+    tests = [
+        Case("b", B, 'lemma foo: "x = x"'),
+        Case("missing_file", Path("Foo/C.thy"), 'lemma foo: "x = x"'),
+        Case("a", A, 'lemma foo:\n"x = x"'),
+        Case("missing_lemma", A, 'lemma foo: "z = z"'),
+    ]
+    valid, invalid = validate_test_cases(tests, LemmaIndex.build(thys_dir))
+    assert valid == [tests[0], tests[2]]  # In the original order.
+    assert invalid == {"no-such-file": [tests[1]], "not-found": [tests[3]]}
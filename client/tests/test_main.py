@@ -0,0 +1,37 @@
+"""Tests of evaluate_model's bookkeeping that don't need a server."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from client.main import evaluate_model, skip_invalid_tests
+from client.model import DummyHammerModel
+from client.results import load_results
+from client.test_cases import TestCase as Case  # Renamed, so that pytest doesn't collect it.
+
+
+def test_skipped_tests_are_recorded(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    thy_file = tmp_path / "afp" / "thys" / "Foo" / "A.thy"
+    thy_file.parent.mkdir(parents=True)
+    thy_file.write_text('theory A imports Main begin\nlemma foo: "x = x" by simp\nend\n')
+    monkeypatch.setenv("AFP_DIR", str(tmp_path / "afp"))
+    tests = [
+        Case("valid", Path("Foo/A.thy"), 'lemma foo: "x = x"'),
+        Case("missing_file", Path("Foo/B.thy"), 'lemma foo: "x = x"'),
+        Case("missing_lemma", Path("Foo/A.thy"), 'lemma bar: "x = x"'),
+    ]
+    valid, skipped = skip_invalid_tests(tests)
+    assert valid == tests[:1]
+    assert {r.name: r.kind for r in skipped} == {
+        "missing_file": "no-such-file",
+        "missing_lemma": "not-found",
+    }
+
+    # Skipped tests are logged and counted like the others, once.
+    results_path = tmp_path / "results.jsonl"
+    for resume in [False, True]:
+        evaluate_model(DummyHammerModel(), [], skipped, results_path=results_path, resume=resume)
+    assert len(results_path.read_text().splitlines()) == 2
+    results = load_results([results_path])
+    assert {name: r.kind for name, r in results.items()} == {r.name: r.kind for r in skipped}
@@ -0,0 +1,73 @@
+"""Tests of BatchingModel."""
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import pytest
+
+from client.model import BatchingModel, DummyKnownSolutionModel
+
+
+class _RecordingModel(DummyKnownSolutionModel):
+    """Answers the known solution, recording each batch() call."""
+
+    def __init__(self) -> None:
+        self.calls = list[tuple[float, int, list[str]]]()  # (temperature, max_expansion, solutions)
+        self.lock = threading.Lock()
+
+    def batch(
+        self,
+        inputs: list[tuple[str, str]],
+        known_solutions: Optional[list[str]] = None,
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[list[tuple[str, float]]]:
+        assert known_solutions is not None
+        with self.lock:
+            self.calls.append((temperature, max_expansion, list(known_solutions)))
+        return super().batch(inputs, known_solutions, temperature, max_expansion)
+
+
+def test_batches_concurrent_calls_by_parameters() -> None:
+    model = _RecordingModel()
+    params = [(1.0, 8), (1.0, 16), (0.5, 8)]
+    # A long max_wait, so that all calls (and only those) end up in the first batch.
+    with BatchingModel(model, max_batch_size=30, max_wait=2.0) as batching_model:
+        with ThreadPoolExecutor(max_workers=30) as executor:
+            futures = [
+                executor.submit(batching_model, "", "", f"step {i}", *params[i % 3])
+                for i in range(30)
+            ]
+            assert [f.result() for f in futures] == [[(f"step {i}", 0.1)] for i in range(30)]
+        stats = batching_model.stats()
+
+    assert stats == {"batches": 3, "requests": 30, "mean_batch_size": 10.0}
+    assert sorted((t, m, sorted(s)) for t, m, s in model.calls) == sorted(
+        (*params[j], sorted(f"step {i}" for i in range(j, 30, 3))) for j in range(3)
+    )
+
+
+def test_batch_is_split_by_max_batch_size() -> None:
+    model = _RecordingModel()
+    with BatchingModel(model, max_batch_size=4, max_wait=1.0) as batching_model:
+        outputs = batching_model.batch([("", "")] * 10, [str(i) for i in range(10)])
+    assert outputs == [[(str(i), 0.1)] for i in range(10)]
+    assert [len(solutions) for _, _, solutions in model.calls] == [4, 4, 2]
+
+
+def test_calls_racing_with_close_never_hang() -> None:
+    for _ in range(20):
+        batching_model = BatchingModel(_RecordingModel(), max_wait=0.001)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(batching_model, "", "", str(i)) for i in range(50)]
+            batching_model.close()
+            for i, future in enumerate(futures):
+                try:
+                    assert future.result(timeout=5.0) == [(str(i), 0.1)]
+                except RuntimeError as e:
+                    assert str(e) == "BatchingModel is closed."
+    with pytest.raises(RuntimeError, match="closed"):
+        batching_model("", "")
+    batching_model.close()  # Closing twice is fine.
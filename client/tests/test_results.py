@@ -0,0 +1,45 @@
+"""Tests of the results log, including recovery from a crash mid-write."""
+from __future__ import annotations
+
+from dataclasses import asdict
+from pathlib import Path
+
+import pytest
+
+from client.results import ResultsLog, load_results, merge_results
+from client.results import TestResult as Result  # Renamed, so that pytest doesn't collect it.
+from client.transport import json_dumps
+
+
+def _result(name: str, kind: str = "success") -> Result:
+    return Result(name, "Foo/A.thy", kind, proof=["by simp"], duration=1.5, timings={"x": 0.5})
+
+
+def test_recovers_from_truncated_line(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    path = tmp_path / "results.jsonl"
+    assert load_results([path]) == {}  # Missing files are like a new run.
+    with ResultsLog(path) as log:
+        log.append(_result("a", "failure"))
+        log.append(_result("b"))
+    # A crash while writing the next line leaves it truncated.
+    with open(path, "ab") as f:
+        f.write(json_dumps(asdict(_result("c")))[:30])
+    assert load_results([path]) == {"a": _result("a", "failure"), "b": _result("b")}
+    assert "Skipping malformed line 3" in capsys.readouterr().err
+
+    # Appending after a restart starts a new line, so no result is lost.
+    with ResultsLog(path) as log:
+        log.append(_result("c"))
+        log.append(_result("a"))  # Retried: overrides the previous result.
+    assert len(path.read_bytes().splitlines()) == 5
+    expected = {"a": _result("a"), "b": _result("b"), "c": _result("c")}
+    assert load_results([path]) == expected
+
+    # Other malformed lines are skipped too.
+    with open(path, "ab") as f:
+        f.write(b"\n[1, 2]\n{}\n")
+    with ResultsLog(path) as log:
+        log.append(_result("d"))
+    assert load_results([path]) == expected | {"d": _result("d")}
+    assert merge_results([path], tmp_path / "merged.jsonl") == 4
+    assert load_results([tmp_path / "merged.jsonl"]) == expected | {"d": _result("d")}
@@ -0,0 +1,99 @@
+"""Tests of replica routing and failover against mock servers."""
+from __future__ import annotations
+
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from client.mock_server import MockConfig, MockQIsabelleServer
+from client.router import NoHealthyReplicaError, ReplicaRouter, RoutedQIsabelleSession
+from client.transport import JSON
+
+THEORY_PATH = Path("/afp/thys/Foo/Foo.thy")
+
+
+@pytest.fixture
+def replicas() -> Iterator[tuple[MockQIsabelleServer, MockQIsabelleServer]]:
+    a = MockQIsabelleServer(MockConfig(max_sessions=2))
+    b = MockQIsabelleServer(MockConfig(max_sessions=2))
+    with a, b:
+        yield a, b
+
+
+def _make_proof(session: RoutedQIsabelleSession) -> tuple[bool, str]:
+    """Make a few states, return the result of executing "-" on the last one."""
+    session.load_theory(THEORY_PATH, "lemma foo: x", True, "s")
+    session.execute("s", "apply simp", "s1")
+    session.execute_chain("s1", ["apply x", "apply y"], None, ["", "s3"])
+    session.execute_many("s1", ["apply z", "fail"], "m")
+    return session.execute("s3", "-", "s4")
+
+
+def test_routes_to_least_loaded(replicas: tuple[MockQIsabelleServer, MockQIsabelleServer]) -> None:
+    a, b = replicas
+    router = ReplicaRouter([a.port, b.port])
+    assert all(h is not None and h["sessionCount"] == 0 for h in router.health().values())
+    s1 = RoutedQIsabelleSession(router, theory_path=THEORY_PATH, debug=False)
+    s2 = RoutedQIsabelleSession(router, theory_path=THEORY_PATH, debug=False)
+    assert (s1.port, s2.port) == (a.port, b.port)
+    s3 = RoutedQIsabelleSession(router, theory_path=THEORY_PATH, debug=False)
+    assert s3.port == a.port  # Ties go to the first port.
+
+
+def test_failover_replays_states(
+    replicas: tuple[MockQIsabelleServer, MockQIsabelleServer]
+) -> None:
+    a, b = replicas
+    router = ReplicaRouter([a.port, b.port])
+    session = RoutedQIsabelleSession(router, theory_path=THEORY_PATH, debug=False)
+    expected = _make_proof(session)
+    assert session.origins["s3"].steps == (("apply simp", 0), ("apply x", 0), ("apply y", 0))
+    assert "m.1" not in session.origins and session.origins["m.0"].steps[-1] == ("apply z", 0)
+
+    a.stop()
+    session.transport.close()  # Drop kept-alive connections to the stopped server.
+    assert session.execute("s3", "-", "s5") == expected
+    assert session.port == b.port and session.n_failovers == 1
+    assert sorted(b.sessions[session.session_id]) == ["s3", "s5"]  # Replayed lazily.
+    assert session.get_mode("m.0") == "Proof"
+
+    # A session closed by the server is reopened (on any replica, here the only healthy one).
+    with b.lock:
+        b._close_session(session.session_id)
+    assert session.get_mode("s5") == "Proof"
+    assert session.port == b.port and session.n_failovers == 2
+
+    b.stop()
+    session.transport.close()
+    with pytest.raises(NoHealthyReplicaError):
+        session.get_mode("s5")
+
+
+def test_failover_from_wedged_replica(
+    replicas: tuple[MockQIsabelleServer, MockQIsabelleServer], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    a, b = replicas
+    router = ReplicaRouter([a.port, b.port])
+    session = RoutedQIsabelleSession(
+        router, read_timeout=1.0, timeout_margin=0.5, theory_path=THEORY_PATH, debug=False
+    )
+    expected = _make_proof(session)
+    handle = a.handle
+
+    def wedged(path: str, args: JSON) -> JSON:
+        time.sleep(5.0)
+        return handle(path, args)
+
+    a.handle = wedged  # type: ignore[method-assign]
+    start = time.time()
+    assert session.execute("s3", "-", "s5") == expected
+    assert session.port == b.port and time.time() - start < 4.0
+    # Hammer calls time out after their own timeout, HAMMER_GRACE and the margin.
+    monkeypatch.setattr("client.router.HAMMER_GRACE", 1.0)
+    b.config.latency["/hammer"] = 60.0
+    start = time.time()
+    with pytest.raises(NoHealthyReplicaError):
+        session.hammer("s5", timeout=0.5)
+    assert 2.0 < time.time() - start < 4.0
@@ -0,0 +1,59 @@
+"""Tests of proof search against the mock server."""
+from __future__ import annotations
+
+import io
+from pathlib import Path
+from typing import Literal
+
+import pytest
+
+from client.mock_server import MockQIsabelleServer
+from client.model import Model
+from client.search import search_proof
+from client.session import QIsabelleSession
+
+THEORY_PATH = Path("/afp/thys/Foo/Foo.thy")
+
+
+class _StepsModel(Model):
+    """Proposes the same steps everywhere (the mock appends unfinished steps to the goal)."""
+
+    def __init__(self, steps: list[str]):
+        self.steps = steps
+
+    def __call__(
+        self,
+        context: str,
+        proof_state: str,
+        known_solution: str = "",
+        temperature: float = 1.2,
+        max_expansion: int = 32,
+    ) -> list[tuple[str, float]]:
+        return [(step, -0.1 * i) for i, step in enumerate(self.steps)]
+
+
+@pytest.mark.parametrize("mode", ["best-first", "beam"])
+@pytest.mark.parametrize(
+    "steps, max_nodes, proved",
+    [
+        (["apply a", "apply b", "fail", "by simp", "apply c"], 100, True),
+        (["apply a", "apply b", "apply c"], 20, False),  # Out of budget.
+    ],
+)
+def test_search_forgets_all_states(
+    mode: Literal["best-first", "beam"], steps: list[str], max_nodes: int, proved: bool
+) -> None:
+    with MockQIsabelleServer() as server:
+        with QIsabelleSession(theory_path=THEORY_PATH, port=server.port, debug=False) as session:
+            proof = search_proof(
+                _StepsModel(steps),
+                THEORY_PATH,
+                "lemma foo: x",
+                session,
+                mode=mode,
+                beam_width=2,
+                max_nodes=max_nodes,
+                out=io.StringIO(),
+            )
+            assert (proof == ["by simp"]) if proved else proof is None
+            assert server.states == {}
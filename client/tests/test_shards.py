@@ -0,0 +1,61 @@
+"""Tests of splitting a suite into shards (no server needed)."""
+from __future__ import annotations
+
+import random
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from client.results import TestResult as Result  # Renamed, so that pytest doesn't collect them.
+from client.shards import assign_shards, parse_shard, shard_tests
+from client.test_cases import TestCase as Case
+
+
+def _tests(n: int, seed: int = 0) -> list[Case]:
+    rng = random.Random(seed)
+    entries = [f"Entry{i}" for i in range(12)]
+    return [
+        Case(f"test_{i}", Path(rng.choice(entries)) / f"T{rng.randrange(3)}.thy", f"lemma l{i}: x")
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 5, 20])
+def test_shards_partition_tests_by_session(n_shards: int) -> None:
+    tests = _tests(100)
+    rng = random.Random(1)
+    priors = {
+        t.name: Result(t.name, str(t.thy_file), "success", duration=100 * rng.random())
+        for t in tests[::2]
+    }
+    for costs in [None, priors]:
+        shards = assign_shards(tests, n_shards, costs)
+        assert len(shards) == n_shards
+        # Disjoint and covering all tests, in their original order within each shard.
+        assert sorted(t.name for shard in shards for t in shard) == sorted(t.name for t in tests)
+        for shard in shards:
+            assert shard == [t for t in tests if t in shard]
+        # Tests of an AFP entry (an Isabelle session) are on the same shard.
+        entry_shards = {(t.thy_file.parts[0], i) for i, shard in enumerate(shards) for t in shard}
+        assert len(entry_shards) == len({t.thy_file.parts[0] for t in tests})
+        # Deterministic, also regardless of the order of priors.
+        reversed_costs = None if costs is None else dict(reversed(list(costs.items())))
+        assert assign_shards(tests, n_shards, reversed_costs) == shards
+        assert [shard_tests(tests, i, n_shards, costs) for i in range(n_shards)] == shards
+
+
+def test_shards_are_balanced() -> None:
+    tests = _tests(600)  # About 50 tests in each of 12 entries.
+    sizes = [len(shard) for shard in assign_shards(tests, 4)]
+    entry_sizes = Counter(t.thy_file.parts[0] for t in tests)
+    # Entries are assigned greedily, so shards differ by at most one entry.
+    assert max(sizes) - min(sizes) <= max(entry_sizes.values())
+
+
+def test_parse_shard() -> None:
+    assert parse_shard("0/3") == (0, 3)
+    assert parse_shard("2/3") == (2, 3)
+    for spec in ["3/3", "-1/3", "1", "a/b", "1/0"]:
+        with pytest.raises(ValueError):
+            parse_shard(spec)
@@ -0,0 +1,152 @@
+"""Timing of server calls and model inference, with summaries and trace export.
+
+Each QIsabelleSession records the client wall time of every request in its `timings`, along with
+the time the server spent handling it (the "X-Server-Time-Ms" response header). The difference is
+network and (de)serialization overhead. Other phases (like model inference) are recorded with
+`Timings.span()`.
+
+Traces can be exported as JSONL (one record per line) or in the Chrome trace event format
+(open in chrome://tracing or https://ui.perfetto.dev).
+"""
+from __future__ import annotations
+
+import contextlib
+import os
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from .transport import JSON, json_dumps
+
+
+@dataclass
+class TimingRecord:
+    name: str  # Endpoint path like "/execute", or a phase like "model".
+    start: float  # Unix time in seconds.
+    duration: float  # Client wall time in seconds.
+    server_time: Optional[float] = None  # Seconds spent by the server, if known.
+    thread: str = ""
+    test: str = ""  # Name of the test case, if any.
+
+
+class Timings:
+    """A thread-safe list of timing records."""
+
+    def __init__(self, test: str = ""):
+        """test: name of the test case, attached to new records."""
+        self.test = test
+        self.records = list[TimingRecord]()
+        self.lock = threading.Lock()
+
+    def record(
+        self, name: str, start: float, duration: float, server_time: Optional[float] = None
+    ) -> None:
+        record = TimingRecord(
+            name, start, duration, server_time, threading.current_thread().name, self.test
+        )
+        with self.lock:
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Record the wall time of a block of code."""
+        start, start_counter = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start_counter)
+
+    def extend(self, other: Timings) -> None:
+        with other.lock:
+            records = list(other.records)
+        with self.lock:
+            self.records.extend(records)
+
+    def summary(self) -> dict[str, JSON]:
+        """Per-name count, total and percentiles of client time, and total server time."""
+        by_name = defaultdict[str, list[TimingRecord]](list)
+        with self.lock:
+            for r in self.records:
+                by_name[r.name].append(r)
+        result = dict[str, JSON]()
+        for name, records in sorted(by_name.items()):
+            server_times = [r.server_time for r in records if r.server_time is not None]
+            result[name] = latency_summary([r.duration for r in records]) | {
+                "total_s": sum(r.duration for r in records),
+                "server_total_s": sum(server_times) if server_times else None,
+            }
+        return result
+
+    def table(self) -> str:
+        """The summary as a text table, most time-consuming first."""
+        summary = sorted(self.summary().items(), key=lambda item: -float(item[1]["total_s"]))
+        lines = [
+            f"{'name':<32}{'n':>7}{'total s':>10}{'server s':>10}"
+            f"{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'max ms':>10}"
+        ]
+        for name, s in summary:
+            server = "-" if s["server_total_s"] is None else f"{s['server_total_s']:.2f}"
+            lines.append(
+                f"{name:<32}{s['n']:>7}{s['total_s']:>10.2f}{server:>10}{s['mean_ms']:>10.1f}"
+                f"{s['p50_ms']:>10.1f}{s['p90_ms']:>10.1f}{s['max_ms']:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def export(self, path: Path) -> None:
+        """Write records as JSONL if path ends with ".jsonl", else as a Chrome trace."""
+        with self.lock:
+            records = list(self.records)
+        if path.suffix == ".jsonl":
+            path.write_bytes(b"".join(json_dumps(asdict(r)) + b"\n" for r in records))
+        else:
+            path.write_bytes(json_dumps({"traceEvents": list(_trace_events(records))}))
+
+
+def latency_summary(latencies: list[float]) -> JSON:
+    """Count, mean and percentiles (nearest-rank) of latencies, in milliseconds."""
+    s = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return 1000 * s[min(len(s) - 1, int(p / 100 * len(s)))]
+
+    return {
+        "n": len(s),
+        "mean_ms": 1000 * sum(s) / len(s),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": 1000 * s[-1],
+    }
+
+
+def _trace_events(records: Iterable[TimingRecord]) -> Iterator[JSON]:
+    """Chrome trace "complete" events, one row per thread."""
+    pid = os.getpid()
+    thread_ids = dict[str, int]()
+    for r in records:
+        if r.thread not in thread_ids:
+            thread_ids[r.thread] = len(thread_ids)
+            yield {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": thread_ids[r.thread],
+                "args": {"name": r.thread},
+            }
+        args: JSON = {"test": r.test}
+        if r.server_time is not None:
+            args["server_ms"] = 1000 * r.server_time
+        yield {
+            "name": r.name,
+            "cat": "server" if r.name.startswith("/") else "client",
+            "ph": "X",
+            "ts": 1e6 * r.start,
+            "dur": 1e6 * r.duration,
+            "pid": pid,
+            "tid": thread_ids[r.thread],
+            "args": args,
+        }
@@ -0,0 +1,288 @@
+"""Transports for sending JSON requests to a QIsabelle server."""
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import logging
+from typing import Any, Optional, Protocol, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    def json_dumps(o: Any) -> bytes:
+        return orjson.dumps(o)
+
+    def json_loads(s: bytes | str) -> Any:
+        return orjson.loads(s)
+
+except ImportError:
+
+    def json_dumps(o: Any) -> bytes:
+        return json.dumps(o, ensure_ascii=False).encode("utf-8")
+
+    def json_loads(s: bytes | str) -> Any:
+        return json.loads(s)
+
+
+JSON = dict[str, Any]
+# A requests-style timeout: None (wait forever), seconds, or (connect seconds, read seconds).
+Timeout = Union[None, float, tuple[float, Optional[float]]]
+
+logger = logging.getLogger(__name__)
+
+_HEADERS = {"Content-Type": "application/json"}
+
+
+class HTTPStatusError(IOError):
+    """The server responded with an HTTP status other than 200."""
+
+
+SERVER_TIME_HEADER = "X-Server-Time-Ms"
+SERVER_TIME_KEY = "serverTimeMs"
+
+
+class Transport(Protocol):
+    """Anything that can POST a JSON object to a server path and return the JSON response.
+
+    If the server reports the time it took to handle the request (SERVER_TIME_HEADER, in
+    milliseconds), it is added to the response under SERVER_TIME_KEY.
+    """
+
+    def post(self, path: str, json_data: JSON, timeout: Timeout = None) -> JSON:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class HTTPTransport:
+    """HTTP transport keeping connections alive in a pool.
+
+    Failed connection attempts (e.g. while a server is starting up) are retried with
+    exponential backoff. Requests that reached the server are never retried, since most
+    endpoints are not idempotent (they start sessions, store states, etc.).
+    Large responses are gzipped by the server (requests accepts and decodes gzip by default).
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 17000,
+        connect_timeout: float = 10.0,
+        read_timeout: Optional[float] = None,
+        connect_retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 4,
+    ):
+        """
+        Args:
+        - host, port: of the server.
+        - connect_timeout, read_timeout: default timeouts in seconds (None means no timeout).
+          Loading theories and hammering can take minutes, so there's no read timeout by default.
+        - connect_retries: how many times to retry failed connections.
+        - backoff_factor: seconds to sleep before retries are backoff_factor * 2^(retry number).
+        - pool_size: maximum number of kept-alive connections (for use from multiple threads).
+        """
+        self.base_url = f"http://{host}:{port}"
+        self.timeout: Timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=connect_retries,
+            connect=connect_retries,
+            read=0,
+            status=0,
+            other=0,
+            redirect=0,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount("http://", adapter)
+
+    def post(self, path: str, json_data: JSON, timeout: Timeout = None) -> JSON:
+        """POST json_data to a path like "/execute"; timeout overrides the default for this call."""
+        logger.debug("Request to %s%s with %s", self.base_url, path, json_data)
+        response = self.http.post(
+            self.base_url + path,
+            data=json_dumps(json_data),
+            headers=_HEADERS,
+            timeout=self.timeout if timeout is None else timeout,
+        )
+        response.raise_for_status()
+        result = json_loads(response.content)
+        assert isinstance(result, dict)
+        if SERVER_TIME_HEADER in response.headers:
+            result[SERVER_TIME_KEY] = float(response.headers[SERVER_TIME_HEADER])
+        return result
+
+    def close(self) -> None:
+        self.http.close()
+
+
+class _StaleConnectionError(ConnectionError):
+    """The connection failed before any part of a response arrived."""
+
+
+class AsyncTransport(Protocol):
+    """Like Transport, but for asyncio."""
+
+    async def post(self, path: str, json_data: JSON, timeout: Timeout = None) -> JSON:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class AsyncHTTPTransport:
+    """Minimal HTTP/1.1 client for asyncio (standard library only), keeping connections alive.
+
+    Same semantics as HTTPTransport: failed connection attempts are retried with exponential
+    backoff, requests that reached the server are not retried. A request on a kept-alive
+    connection that the server closed meanwhile (it fails before any response arrives) is retried
+    once on a new connection, like urllib3 does.
+    At most pool_size requests are in flight at once, others wait for a free connection.
+    Large responses are gzipped by the server, like for HTTPTransport.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 17000,
+        connect_timeout: float = 10.0,
+        read_timeout: Optional[float] = None,
+        connect_retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 4,
+    ):
+        """Arguments are as in HTTPTransport."""
+        self.host = host
+        self.port = port
+        self.base_url = f"http://{host}:{port}"
+        self.timeout: Timeout = (connect_timeout, read_timeout)
+        self.connect_retries = connect_retries
+        self.backoff_factor = backoff_factor
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def post(self, path: str, json_data: JSON, timeout: Timeout = None) -> JSON:
+        """POST json_data to a path like "/execute"; timeout overrides the default for this call."""
+        logger.debug("Request to %s%s with %s", self.base_url, path, json_data)
+        timeout = self.timeout if timeout is None else timeout
+        connect_timeout: Optional[float]
+        read_timeout: Optional[float]
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout = read_timeout = timeout
+        body = json_dumps(json_data)
+        request = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            "Accept-Encoding: gzip\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode("ascii") + body
+
+        async with self._slots:
+            reuse = True
+            while True:
+                reader, writer, reused = await self._connect(connect_timeout, reuse)
+                try:
+                    writer.write(request)
+                    status, headers, content, keep_alive = await asyncio.wait_for(
+                        self._read_response(reader, writer), read_timeout
+                    )
+                    break
+                except _StaleConnectionError:
+                    writer.close()
+                    if not reused:
+                        raise
+                    reuse = False  # Retry once, on a new connection.
+                except BaseException:
+                    writer.close()
+                    raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+
+        if status != 200:
+            raise HTTPStatusError(f"{status} error for url: {self.base_url}{path}")
+        if headers.get("content-encoding", "").lower() == "gzip":
+            content = gzip.decompress(content)
+        result = json_loads(content)
+        assert isinstance(result, dict)
+        if SERVER_TIME_HEADER.lower() in headers:
+            result[SERVER_TIME_KEY] = float(headers[SERVER_TIME_HEADER.lower()])
+        return result
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for _reader, writer in idle:
+            writer.close()
+
+    async def _connect(
+        self, connect_timeout: Optional[float], reuse: bool = True
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """Take an idle connection that's still open (if reuse), or open a new one.
+
+        Returns the reader, the writer, and whether the connection was reused.
+        """
+        while reuse and self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        for retry in range(self.connect_retries + 1):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), connect_timeout
+                )
+                return reader, writer, False
+            except (OSError, asyncio.TimeoutError):
+                if retry == self.connect_retries:
+                    raise
+                await asyncio.sleep(self.backoff_factor * 2**retry)
+        raise AssertionError("unreachable")
+
+    async def _read_response(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> tuple[int, dict[str, str], bytes, bool]:
+        """Read a response; return (status, headers, content, whether the connection is reusable).
+
+        Header names are lowercase.
+        """
+        try:
+            await writer.drain()
+            status_line = await reader.readline()
+        except ConnectionError as e:
+            raise _StaleConnectionError(f"Connection lost before a response: {e}") from e
+        if not status_line:
+            raise _StaleConnectionError("Server closed the connection without a response")
+        version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+        headers = dict[str, str]()
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = list[bytes]()
+            while size := int((await reader.readline()).split(b";")[0], 16):
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Skip trailers.
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return int(status), headers, content, keep_alive
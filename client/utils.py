@@ -1,3 +1,5 @@
+import re
+import textwrap
 from pathlib import Path
 
 
@@ -5,3 +7,23 @@ def read_env_dict(p: Path) -> dict[str, str]:
     """Read an .env file as a dictionary (no quotes handling, no bash expressions)."""
     lines = [line.strip() for line in p.read_text().splitlines() if line.strip()]
     return dict(line.split("=", maxsplit=1) for line in lines)
+
+
+def indent(text: str, indentation: str = "\t") -> str:
+    """Indend text with tabs, strip the final newline."""
+    return textwrap.indent(text.strip(), indentation)
+
+
+def header(title: str, fill_char: str = "%") -> str:
+    """Center a string in % chars."""
+    return (" " + title + " ").center(100, fill_char)
+
+
+def normalize_whitespace(s: str) -> str:
+    """Normalize a transition's text like the server does (`ParsedTheory.normalizeWhitespace`)."""
+    return re.sub(" +", " ", s.strip().replace("\n", " "))
+
+
+def normalize_goals(proof_goals: str) -> str:
+    """Normalize a proof state description for deduplication (whitespace is ignored)."""
+    return " ".join(proof_goals.split())
@@ -0,0 +1,174 @@
+package server
+
+import scala.collection.mutable
+import scala.jdk.CollectionConverters._
+
+import de.unruh.isabelle.pure.ToplevelState
+
+/** An Isabelle process, with the objects built on it, used by one or more client sessions. */
+class IsabelleProcess(
+    val key: IsabelleProcess.Key,
+    val session: IsabelleSession,
+    val sledgehammer: Sledgehammer,
+    val checkpoints: TheoryCheckpoints,
+    val hammerJobs: HammerJobs
+) {
+  def close(): Unit = {
+    hammerJobs.shutdown()
+    session.close()
+  }
+}
+
+object IsabelleProcess {
+
+  /** Session name, session roots and working directory: processes with equal keys are the same. */
+  type Key = (String, Seq[String], String)
+}
+
+/** A client's handle on an Isabelle process, with its own named states. */
+class ClientSession(
+    val id: String,
+    val process: IsabelleProcess,
+    val stateMap: StateStore[ToplevelState]
+)
+
+/** Open client sessions by id, at most `capacity` at once.
+  *
+  * Opening a session beyond capacity closes the least recently used ones (like states evicted from
+  * a `StateStore`); using them afterwards raises a "Session closed" error. Sessions opened as
+  * shared reuse an open Isabelle process with the same key, if any; a process is closed with the
+  * last session using it. The id "" means the default session, the one opened last, for clients
+  * that use a single session.
+  *
+  * Access is synchronized, except for starting and closing Isabelle processes (which takes
+  * seconds), so that requests of other sessions are not blocked meanwhile.
+  *
+  * @param capacity
+  *   Maximum number of open sessions.
+  */
+class ClientSessions(val capacity: Int) {
+  require(capacity > 0, "ClientSessions capacity must be positive")
+
+  /** Sessions in access order (least recently used first). */
+  protected val sessions = new java.util.LinkedHashMap[String, ClientSession](16, 0.75f, true)
+
+  /** Number of sessions using each open process (including sessions being opened). */
+  protected val users = mutable.Map[IsabelleProcess, Int]()
+
+  /** Why recently closed sessions were closed (bounded), to give better error messages. */
+  protected val closed = new java.util.LinkedHashMap[String, String]()
+
+  protected var defaultId: String = ""
+  protected var nOpened: Long     = 0
+
+  /** Open a new session.
+    *
+    * @param key
+    *   Key of the Isabelle process needed.
+    * @param shared
+    *   Whether to reuse an open process with the same key.
+    * @param startProcess
+    *   Starts a new process, if none is reused.
+    * @param newStateMap
+    *   Makes the state map of the new session.
+    */
+  def open(
+      key: IsabelleProcess.Key,
+      shared: Boolean,
+      startProcess: () => IsabelleProcess,
+      newStateMap: () => StateStore[ToplevelState]
+  ): ClientSession = {
+    val (reused, toClose) = synchronized {
+      val reused = if (shared) users.keys.find(_.key == key) else None
+      reused.foreach(process => users(process) += 1) // So that evicting doesn't close it.
+      (reused, evict(sessions.size + 1 - capacity))
+    }
+    toClose.foreach(_.close())
+    val process =
+      try reused.getOrElse(startProcess())
+      catch {
+        case e: Throwable => {
+          reused.foreach(release(_).foreach(_.close()))
+          throw e
+        }
+      }
+    val (session, moreToClose) = synchronized {
+      if (reused.isEmpty)
+        users(process) = 1
+      nOpened += 1
+      val session = new ClientSession(s"session-$nOpened", process, newStateMap())
+      sessions.put(session.id, session)
+      defaultId = session.id
+      (session, evict(sessions.size - capacity)) // In case of concurrent opens.
+    }
+    moreToClose.foreach(_.close())
+    session
+  }
+
+  /** Get an open session by id ("" means the default session), marking it as recently used.
+    *
+    * @throws QIsabelleException
+    *   "No Isabelle session open", "Session not found: id" or "Session closed: id (...)".
+    */
+  def get(id: String): ClientSession = synchronized {
+    val session = sessions.get(if (id.isEmpty) defaultId else id)
+    if (session != null)
+      session
+    else if (id.isEmpty)
+      throw QIsabelleException("No Isabelle session open")
+    else if (closed.containsKey(id))
+      throw QIsabelleException(s"Session closed: $id (${closed.get(id)})")
+    else
+      throw QIsabelleException(s"Session not found: $id")
+  }
+
+  /** Close a session ("" means the default session); return false if it wasn't open. */
+  def close(id: String): Boolean = {
+    val session = synchronized {
+      Option(sessions.remove(if (id.isEmpty) defaultId else id)).map { session =>
+        forget(session, "closed by the client")
+        session
+      }
+    }
+    session.flatMap(s => release(s.process)).foreach(_.close())
+    session.isDefined
+  }
+
+  /** Open sessions, least recently used first. */
+  def all: Seq[ClientSession] = synchronized { sessions.values.asScala.toList }
+
+  def processCount: Int = synchronized { users.size }
+
+  /** Remove the n least recently used sessions, return processes no longer used (to close). */
+  protected def evict(n: Int): Seq[IsabelleProcess] = {
+    val toEvict = sessions.values.asScala.take(n.max(0)).toList
+    toEvict.flatMap { session =>
+      sessions.remove(session.id)
+      forget(session, "too many sessions, see QISABELLE_MAX_SESSIONS")
+      release(session.process)
+    }
+  }
+
+  /** Record why a session was closed, clear its states. */
+  protected def forget(session: ClientSession, reason: String): Unit = {
+    session.stateMap.clear()
+    if (session.id == defaultId)
+      defaultId = ""
+    closed.put(session.id, reason)
+    // Remember at most `capacity` closed sessions.
+    val overflow = closed.size - capacity
+    if (overflow > 0)
+      closed.keySet.iterator.asScala.take(overflow).toList.foreach(id => closed.remove(id))
+  }
+
+  /** One session less uses a process; return it if it's not used anymore (to close). */
+  protected def release(process: IsabelleProcess): Option[IsabelleProcess] = synchronized {
+    users(process) -= 1
+    if (users(process) > 0)
+      None
+    else {
+      users.remove(process)
+      Some(process)
+    }
+  }
+}
@@ -0,0 +1,119 @@
+package server
+
+import java.util.concurrent.{
+  Callable,
+  CancellationException,
+  ExecutionException,
+  Executors,
+  Future => JFuture,
+  TimeUnit,
+  TimeoutException
+}
+
+/** Sledgehammer calls running in the background, at most `maxConcurrent` at once.
+  *
+  * Jobs are queued on a fixed thread pool and identified by string ids. Cancelling a queued job
+  * means it never starts; cancelling a running job interrupts the thread waiting for the result,
+  * but prover processes started by the ML side may run until the mid timeout (see
+  * `Sledgehammer`).
+  *
+  * @param maxConcurrent
+  *   Maximum number of jobs running at once (others wait in the queue).
+  * @param maxJobs
+  *   Maximum number of jobs remembered; the oldest finished jobs are forgotten beyond that.
+  */
+class HammerJobs(val maxConcurrent: Int, val maxJobs: Int = 1000) {
+  require(maxConcurrent > 0, "HammerJobs maxConcurrent must be positive")
+
+  protected class Job(val id: String, val startTime: Long) {
+    @volatile var running: Boolean = false
+    @volatile var future: JFuture[String] = null
+  }
+
+  protected val executor = Executors.newFixedThreadPool(maxConcurrent)
+
+  /** Jobs in submission order. */
+  protected val jobs = new java.util.LinkedHashMap[String, Job]()
+  protected var nSubmitted: Long = 0
+
+  /** Submit a job running `findProof` (which should return a proof or throw), return its id. */
+  def submit(findProof: () => String): String = synchronized {
+    nSubmitted += 1
+    val job = new Job(s"hammer-$nSubmitted", System.currentTimeMillis())
+    job.future = executor.submit(new Callable[String] {
+      def call(): String = {
+        job.running = true
+        findProof()
+      }
+    })
+    jobs.put(job.id, job)
+    forgetOldJobs()
+    job.id
+  }
+
+  /** Status of a job, waiting at most `waitSeconds` for it to finish.
+    *
+    * @return
+    *   {"status": str, "proof": str, "message": str, "elapsed": float}, where status is one of
+    *   "queued", "running", "success" (proof is then set), "failure" (message is then set),
+    *   "cancelled"; elapsed is the time since submission in seconds.
+    * @throws QIsabelleException
+    *   "Job not found: id".
+    */
+  def status(jobId: String, waitSeconds: Double = 0): ujson.Obj = {
+    val job = getJob(jobId)
+    if (waitSeconds > 0 && !job.future.isDone) {
+      try job.future.get((waitSeconds * 1000).toLong, TimeUnit.MILLISECONDS)
+      catch { case _: TimeoutException | _: ExecutionException | _: CancellationException => () }
+    }
+    val elapsed = (System.currentTimeMillis() - job.startTime) / 1000.0
+    val (status, proof, message) = {
+      if (job.future.isCancelled)
+        ("cancelled", "", "")
+      else if (!job.future.isDone)
+        (if (job.running) "running" else "queued", "", "")
+      else {
+        try ("success", job.future.get(), "")
+        catch {
+          case e: ExecutionException => {
+            val cause = e.getCause()
+            cause match {
+              case q: QIsabelleException => ("failure", "", q.message)
+              case _                     => ("failure", "", cause.toString())
+            }
+          }
+        }
+      }
+    }
+    ujson.Obj("status" -> status, "proof" -> proof, "message" -> message, "elapsed" -> elapsed)
+  }
+
+  /** Cancel a job (if it's not finished yet) and return its status. */
+  def cancel(jobId: String): ujson.Obj = {
+    getJob(jobId).future.cancel(true)
+    status(jobId)
+  }
+
+  /** Number of jobs queued or running. */
+  def pendingCount: Int = synchronized { jobs.values.stream.filter(!_.future.isDone).count.toInt }
+
+  /** Cancel all jobs and stop the thread pool. */
+  def shutdown(): Unit = synchronized {
+    executor.shutdownNow()
+    jobs.clear()
+  }
+
+  protected def getJob(jobId: String): Job = synchronized {
+    val job = jobs.get(jobId)
+    if (job == null)
+      throw QIsabelleException(s"Job not found: $jobId")
+    job
+  }
+
+  protected def forgetOldJobs(): Unit = {
+    val it = jobs.values.iterator
+    while (jobs.size > maxJobs && it.hasNext)
+      if (it.next().future.isDone)
+        it.remove()
+  }
+}
@@ -12,7 +12,7 @@ import sys.process._
 import _root_.java.nio.file.{Files, Path}
 import _root_.java.io.File
 
-import de.unruh.isabelle.control.{Isabelle, IsabelleMLException}
+import de.unruh.isabelle.control.{Isabelle, IsabelleMLException, OperationCollection}
 import de.unruh.isabelle.mlvalue.{AdHocConverter, MLValue, MLValueWrapper}
 import de.unruh.isabelle.mlvalue.MLValue.{compileFunction, compileFunction0, compileValue}
 import de.unruh.isabelle.pure.{Context, Position, Theory, TheoryHeader, ToplevelState, Transition}
@@ -20,6 +20,7 @@ import de.unruh.isabelle.mlvalue.Implicits._
 import de.unruh.isabelle.pure.Implicits._
 
 import server.Sledgehammer
+import IsabelleSession.Ops
 
 /** @param isabelleDir
   *   Path to the Isabelle distribution directory (should contain bin/isabelle).
@@ -81,6 +82,11 @@ class IsabelleSession(
     isabelle.destroy()
   }
 
+  /** Statistics of the ML process, like "heap_size" and "heap_used" (in bytes, as strings). */
+  def mlStatistics(): Map[String, String] = {
+    Ops.mlStatistics(()).retrieveNow.toMap
+  }
+
   /** Parse and execute Isar code.
     *
     * @param isarCode
@@ -127,7 +133,7 @@ class IsabelleSession(
   }
 }
 
-object IsabelleSession {
+object IsabelleSession extends OperationCollection {
 
   /** Guess name of session (as defined in an Isabelle ROOT file) from theory file path.
     *
@@ -174,4 +180,11 @@ object IsabelleSession {
   protected def getPathPrefix(path: os.Path, n_segments: Int): os.Path = {
     os.Path("/" + path.segments.take(n_segments).mkString("/"))
   }
+
+  protected final class Ops(implicit isabelle: Isabelle) {
+    import MLValue.compileFunction
+
+    lazy val mlStatistics = compileFunction[Unit, List[(String, String)]]("ML_Statistics.get")
+  }
+  override protected def newOps(implicit isabelle: Isabelle): Ops = new Ops()
 }
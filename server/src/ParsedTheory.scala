@@ -74,14 +74,31 @@ class ParsedTheory(
 
   /** Transitions (with their text) until a given one. */
   def takeUntil(isarString: String, inclusive: Boolean): List[(Transition, String)] = {
-    val s     = normalizeWhitespace(isarString)
-    val index = transitions.indexWhere(t => normalizeWhitespace(t._2) == s)
-    if (index == -1)
-      throw new Exception("Transition not found: " + isarString)
-    if (inclusive)
-      transitions.take(index + 1).toList
-    else
-      transitions.take(index).toList
+    transitions.take(endIndex(isarString, inclusive)).toList
+  }
+
+  /** Index of the first transition with each (whitespace-normalized) text, built on first use. */
+  lazy val transitionIndex: Map[String, Int] = {
+    transitions.zipWithIndex.reverseIterator.map { case ((_, text), i) =>
+      normalizeWhitespace(text) -> i
+    }.toMap // Reversed, so that the first transition with a given text wins.
+  }
+
+  /** Index of the first transition with a given text (whitespace is ignored when comparing).
+    *
+    * @throws Exception
+    *   "Transition not found: ..." if there's no such transition.
+    */
+  def indexOf(isarString: String): Int = {
+    find(isarString).getOrElse(throw new Exception("Transition not found: " + isarString))
+  }
+
+  /** Same as `indexOf()`, but returns None if there's no such transition. */
+  def find(isarString: String): Option[Int] = transitionIndex.get(normalizeWhitespace(isarString))
+
+  /** Number of transitions to execute to get to a given transition (inclusive or not). */
+  def endIndex(isarString: String, inclusive: Boolean): Int = {
+    if (inclusive) indexOf(isarString) + 1 else indexOf(isarString)
   }
 
   def normalizeWhitespace(s: String): String = {
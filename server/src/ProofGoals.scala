@@ -0,0 +1,75 @@
+package server
+
+import java.nio.charset.StandardCharsets
+import java.security.MessageDigest
+
+/** Compact encodings of proof goals (`ToplevelState.proofStateDescription`) in responses.
+  *
+  * Every response with a proof state has a "proofStateHash", so that clients can tell states apart
+  * without comparing (or even receiving) their text. Depending on the requested goals mode, the
+  * text itself is sent:
+  *   - "full": as "proofGoals";
+  *   - "diff": as "proofGoalsDiff", a diff against the goals of the state executed on (see `diff`);
+  *   - "none": not at all (it can be fetched later with `/getProofGoals`).
+  */
+object ProofGoals {
+  val modes: Seq[String] = Seq("full", "diff", "none")
+
+  def checkMode(mode: String): Unit = {
+    if (!modes.contains(mode))
+      throw QIsabelleException(s"Unknown goals mode: $mode (expected ${modes.mkString(", ")})")
+  }
+
+  /** A stable hash of proof goals: the first 16 hex digits of the SHA-256 of their UTF-8 bytes. */
+  def hash(goals: String): String = {
+    val digest = MessageDigest.getInstance("SHA-256").digest(goals.getBytes(StandardCharsets.UTF_8))
+    digest.take(8).map(b => f"${b & 0xff}%02x").mkString
+  }
+
+  /** A diff from `parent` to `goals`: {"prefix": int, "suffix": int, "middle": str}.
+    *
+    * Then goals == parent[:prefix] + middle + parent[len(parent) - suffix:], where lengths count
+    * Unicode code points (like Python string indices). Goals usually change only in a few places
+    * (the first subgoal, mostly), so the common prefix and suffix cover most of the text.
+    */
+  def diff(parent: String, goals: String): ujson.Obj = {
+    val maxLength = parent.length.min(goals.length)
+    var prefix    = 0
+    while (prefix < maxLength && parent(prefix) == goals(prefix))
+      prefix += 1
+    if (prefix > 0 && Character.isHighSurrogate(goals(prefix - 1)))
+      prefix -= 1 // Don't split a surrogate pair.
+    var suffix = 0
+    while (
+      suffix < maxLength - prefix &&
+      parent(parent.length - 1 - suffix) == goals(goals.length - 1 - suffix)
+    )
+      suffix += 1
+    if (suffix > 0 && Character.isLowSurrogate(goals(goals.length - suffix)))
+      suffix -= 1
+    ujson.Obj(
+      "prefix" -> parent.codePointCount(0, prefix),
+      "suffix" -> parent.codePointCount(parent.length - suffix, parent.length),
+      "middle" -> goals.substring(prefix, goals.length - suffix)
+    )
+  }
+
+  /** The JSON of a proof state, with its goals in a given mode.
+    *
+    * @param parentGoals
+    *   Goals of the state executed on, only evaluated in "diff" mode.
+    * @return
+    *   {"proofDone": bool, "proofStateHash": str} with "proofGoals" or "proofGoalsDiff", depending
+    *   on the mode.
+    */
+  def json(goals: String, proofDone: Boolean, mode: String, parentGoals: => String): ujson.Obj = {
+    val result = ujson.Obj("proofDone" -> proofDone, "proofStateHash" -> hash(goals))
+    mode match {
+      case "full" => result("proofGoals") = goals
+      case "diff" => result("proofGoalsDiff") = diff(parentGoals, goals)
+      case "none" => ()
+      case _      => checkMode(mode)
+    }
+    result
+  }
+}
@@ -1,6 +1,8 @@
 package server
 
 import scala.concurrent.duration._
+import scala.concurrent.{Await, Future, blocking}
+import scala.util.{Failure, Success, Try}
 import scala.util.matching.Regex
 
 import de.unruh.isabelle.pure.{Theory, ToplevelState}
@@ -12,6 +14,11 @@ import de.unruh.isabelle.mlvalue.Implicits._
 import org.checkerframework.checker.units.qual
 
 case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) extends cask.Routes {
+  // Report the time spent on each request, so clients can tell it apart from network overhead.
+  // Also gzip large responses, for clients that accept it.
+  val timer               = new serverTime()
+  override def decorators = Seq(timer, new compress())
+
   // These are the timeouts originally used in PISA.
   val perTransitionTimeout: Duration   = 10.seconds
   val parseAndExecuteTimeout: Duration = Duration.Inf
@@ -19,11 +26,27 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
   val midHammerTimeout: Duration       = 35.seconds
   val hardHammerTimeout: Duration      = 40.seconds
 
-  var session: IsabelleSession   = null
-  var sledgehammer: Sledgehammer = null
+  /** Maximum number of states remembered, least recently used ones are evicted beyond that. */
+  val maxStates: Int = sys.env.getOrElse("QISABELLE_MAX_STATES", "2000").toInt
+
+  /** Maximum number of theory checkpoints remembered, see `TheoryCheckpoints`. */
+  val maxCheckpoints: Int = sys.env.getOrElse("QISABELLE_MAX_CHECKPOINTS", "200").toInt
+
+  /** Number of transitions between two theory checkpoints. */
+  val checkpointEvery: Int = sys.env.getOrElse("QISABELLE_CHECKPOINT_EVERY", "100").toInt
 
-  /** Remembering states by name for the API. */
-  var stateMap: Map[String, ToplevelState] = null
+  /** Maximum number of hammer jobs (see `/hammerAsync`) running at once. */
+  val maxConcurrentHammers: Int = sys.env.getOrElse("QISABELLE_MAX_CONCURRENT_HAMMERS", "2").toInt
+
+  /** Maximum number of client sessions open at once, least recently used ones are closed beyond. */
+  val maxSessions: Int = sys.env.getOrElse("QISABELLE_MAX_SESSIONS", "1").toInt
+
+  /** Open client sessions, each remembering its states by name for the API (see `ClientSessions`).
+    *
+    * All endpoints after `openIsabelleSession()` take an optional `sessionId` argument: the id it
+    * returned, or "" (the default) for the session opened last.
+    */
+  val sessions = new ClientSessions(maxSessions)
 
   /** A dummy endpoint to just check if the server is running. */
   @cask.get("/")
@@ -31,6 +54,28 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     "Hello from QIsabelle"
   }
 
+  /** Like `/`, but also report how loaded the server is, for clients choosing a replica.
+    *
+    * This doesn't call Isabelle, so it answers quickly even when Isabelle processes are busy.
+    *
+    * @return
+    *   {"status": "ok", "activeRequests": int, "sessionCount": int, "sessionCapacity": int,
+    *   "processCount": int, "pendingHammerCount": int}; activeRequests is the number of requests
+    *   being handled (besides this one), pendingHammerCount is over all Isabelle processes.
+    */
+  @cask.get("/health")
+  def health() = {
+    val open = sessions.all
+    ujson.Obj(
+      "status"             -> "ok",
+      "activeRequests"     -> (timer.activeCount - 1),
+      "sessionCount"       -> open.length,
+      "sessionCapacity"    -> maxSessions,
+      "processCount"       -> sessions.processCount,
+      "pendingHammerCount" -> open.map(_.process).distinct.map(_.hammerJobs.pendingCount).sum
+    )
+  }
+
   /** Start an Isabelle process by loading a given session.
     *
     * @param sessionName
@@ -45,39 +90,36 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     * @param workingDir
     *   Working directory for the Isabelle process. This doesn't influence a lot, mostly how
     *   relative paths are resolved for imports that are not found in the session heap.
+    * @param shared
+    *   If true, reuse an Isabelle process already open with the same arguments, if any, instead
+    *   of starting a new one (as clients prefetching their next session do). The new session
+    *   still has its own states.
+    *
+    * At most QISABELLE_MAX_SESSIONS (environment variable, default 1) sessions are open at once:
+    * opening another one closes the least recently used session.
     *
     * @return
-    *   {"success": "success"} or {"error": str, "traceback": str}
+    *   {"success": "success", "sessionId": str} or {"error": str, "traceback": str}
     */
   @cask.postJson("/openIsabelleSession")
   def openIsabelleSession(
       sessionName: String,
       sessionRoots: Seq[String],
-      workingDir: String
+      workingDir: String,
+      shared: Boolean = false
   ): ujson.Obj = {
     println("openIsabelleSession: start")
     try {
-      session = new IsabelleSession(
-        isabelleDir = os.Path("/home/isabelle/Isabelle/"),
-        sessionName = sessionName,
-        sessionRoots = sessionRoots.map(os.Path(_)),
-        workingDir = os.Path(workingDir),
-        defaultPerTransitionTimeout = perTransitionTimeout,
-        defaultParseAndExecuteTimeout = parseAndExecuteTimeout,
-        debug = true
-      )
-      implicit val isabelle = session.isabelle
-      sledgehammer = new Sledgehammer(
-        softTimeout = softHammerTimeout,
-        midTimeout = midHammerTimeout,
-        hardTimeout = hardHammerTimeout,
-        debug = true
+      val client = sessions.open(
+        (sessionName, sessionRoots, workingDir),
+        shared,
+        () => startIsabelleProcess(sessionName, sessionRoots, workingDir),
+        () => new StateStore[ToplevelState](maxStates)
       )
-      stateMap = Map()
-      println("openIsabelleSession: end")
-      return ujson.Obj("success" -> "success")
+      println(s"openIsabelleSession: end (${client.id})")
+      return ujson.Obj("success" -> "success", "sessionId" -> client.id)
     } catch {
-      case e: Throwable => { closeIsabelleSession(); exceptionJson(e) }
+      case e: Throwable => exceptionJson(e)
     }
   }
 
@@ -88,39 +130,39 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     * @param theoryPath
     *   Path to .thy file from which we guess the session to load, along with session roots and
     *   working directiory. E.g.: '/home/isabelle/Isabelle/src/HOL/Main.thy'
+    * @param shared
+    *   Same as in `openIsabelleSession()`.
     *
     * @return
-    *   {"success": "success"} or {"error": str, "traceback": str}
+    *   Same as `openIsabelleSession()`.
     */
   @cask.postJson("/openIsabelleSessionForTheory")
-  def openIsabelleSessionForTheory(theoryPath: String): ujson.Obj = {
+  def openIsabelleSessionForTheory(theoryPath: String, shared: Boolean = false): ujson.Obj = {
     try {
       val sessionName  = IsabelleSession.guessSessionName(os.Path(theoryPath))
       val sessionRoots = IsabelleSession.guessSessionRoots(os.Path(theoryPath))
       val workingDir   = os.Path(theoryPath) / os.up
-      openIsabelleSession(sessionName, sessionRoots.map(_.toString), workingDir.toString)
+      openIsabelleSession(sessionName, sessionRoots.map(_.toString), workingDir.toString, shared)
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
 
-  /** Stop the Isabelle process and clear the state map and theory from memory.
+  /** Close a session, clearing its state map, and stop its Isabelle process (unless shared).
     *
     * @return
     *   {"success": "Closed"} or {"error": "Already closed", "traceback": ""}
     */
   @cask.postJson("/closeIsabelleSession")
-  def closeIsabelleSession(): ujson.Obj = {
-    stateMap = null
-    sledgehammer = null
-    if (session == null)
+  def closeIsabelleSession(sessionId: String = ""): ujson.Obj = {
+    if (!sessions.close(sessionId))
       return ujson.Obj("error" -> "Already closed", "traceback" -> "")
-    session.close()
-    session = null
     return ujson.Obj("success" -> "Closed")
   }
 
   /** Make a new state as if executing `theory Foo imports Bar Baz begin`.
+    *
+    * The new state is pinned: it's never evicted from the state map, until forgotten.
     *
     * @param theoryName
     *   Name of the new theory.
@@ -142,20 +184,22 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
       newStateName: String,
       imports: List[String],
       masterDir: String,
-      onlyImportFromSessionHeap: Boolean
+      onlyImportFromSessionHeap: Boolean,
+      sessionId: String = ""
   ): ujson.Obj = {
     try {
-      implicit val isabelle = session.isabelle
+      val client            = sessions.get(sessionId)
+      implicit val isabelle = client.process.session.isabelle
       val importedTheories =
         ParsedTheory.loadImports(
           imports,
-          session.sessionName,
+          client.process.session.sessionName,
           debug = true,
           masterDir = os.Path(masterDir),
           onlyFromSessionHeap = onlyImportFromSessionHeap
         )
       val theory = Theory.mergeTheories(theoryName, endTheory = false, theories = importedTheories)
-      stateMap += (newStateName -> ToplevelState(theory))
+      client.stateMap.put(newStateName, ToplevelState(theory), pin = true)
       return ujson.Obj("success" -> "success")
     } catch {
       case e: Throwable => exceptionJson(e)
@@ -163,6 +207,12 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
   }
 
   /** Load a given theory file until a specified transition.
+    *
+    * The new state is pinned: it's never evicted from the state map, until forgotten.
+    *
+    * The parsed theory and states along its execution are checkpointed (see
+    * `TheoryCheckpoints`), so loading another lemma from the same theory only executes transitions
+    * after the nearest checkpoint.
     *
     * @param theoryPath:
     *   path to .thy file; it is actually loaded and fully parsed (unlike imports, which are loaded
@@ -175,6 +225,8 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     *   whether to include the transition specified by `until` in the result.
     * @param newStateName:
     *   name of the new state to save the result under.
+    * @param goalsMode
+    *   Same as in `execute()` ("diff" is against empty goals).
     * @return
     *   Same as `execute()`.
     */
@@ -185,22 +237,58 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
       inclusive: Boolean,
       newStateName: String,
       initOnly: Boolean,
+      goalsMode: String = "full",
+      sessionId: String = ""
   ): ujson.Obj = {
     try {
-      implicit val isabelle = session.isabelle
-      val parsedTheory = new ParsedTheory(os.Path(theoryPath), session.sessionName, debug = true)
+      val client            = sessions.get(sessionId)
+      implicit val isabelle = client.process.session.isabelle
+      ProofGoals.checkMode(goalsMode)
+      val path         = os.Path(theoryPath)
+      val checkpoints  = client.process.checkpoints
+      val parsedTheory = checkpoints.parsedTheory(path)
       val newState = {
         if (initOnly)
           parsedTheory.execute(parsedTheory.initTransitions())
         else if (until.nonEmpty)
-          parsedTheory.executeUntil(until, inclusive = inclusive, nDebug = 3)
+          checkpoints.executeUntil(path, parsedTheory.endIndex(until, inclusive = inclusive))
         else
-          parsedTheory.executeAll(stopBeforeEnd = !inclusive, nDebug = 3)
+          checkpoints.executeUntil(
+            path,
+            parsedTheory.transitions.length,
+            stopBeforeEnd = !inclusive
+          )
       }
-      stateMap += (newStateName -> newState)
+      client.stateMap.put(newStateName, newState, pin = true)
+      return proofStateJson(client, newState, goalsMode, "")
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Find the transition of a lemma statement in a theory file, without executing anything.
+    *
+    * The theory is parsed (and kept, like in `loadTheory()`), so this is a cheap way to check that
+    * a lemma can be loaded.
+    *
+    * @param theoryPath
+    *   Path to .thy file.
+    * @param lemmaStatement
+    *   Transition to look for, like `until` in `loadTheory()` (whitespace is ignored).
+    * @return
+    *   {"found": bool, "transitionIndex": int, "transitionCount": int} (transitionIndex is -1 if
+    *   not found), or {"error": str, "traceback": str} (e.g. NoSuchFileException).
+    */
+  @cask.postJson("/locateLemma")
+  def locateLemma(theoryPath: String, lemmaStatement: String, sessionId: String = ""): ujson.Obj = {
+    try {
+      val checkpoints  = sessions.get(sessionId).process.checkpoints
+      val parsedTheory = checkpoints.parsedTheory(os.Path(theoryPath))
+      val index        = parsedTheory.find(lemmaStatement)
       return ujson.Obj(
-        "proofGoals" -> newState.proofStateDescription,
-        "proofDone"  -> (newState.proofLevel == 0)
+        "found"           -> index.isDefined,
+        "transitionIndex" -> index.getOrElse(-1),
+        "transitionCount" -> parsedTheory.transitions.length
       )
     } catch {
       case e: Throwable => exceptionJson(e)
@@ -215,46 +303,66 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     * The most common error is "State not found: {stateName}".
     */
   @cask.postJson("/describeState")
-  def describeState(stateName: String): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def describeState(stateName: String, sessionId: String = ""): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
       return ujson.Obj("description" -> ParsedTheory.describeState(state))
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
   @cask.postJson("/getMode")
-  def getMode(stateName: String): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def getMode(stateName: String, sessionId: String = ""): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
       return ujson.Obj("description" -> ParsedTheory.getMode(state))
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
   @cask.postJson("/getTheory")
-  def getTheory(stateName: String): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def getTheory(stateName: String, sessionId: String = ""): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
       return ujson.Obj("description" -> ParsedTheory.getTheory(state))
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
   @cask.postJson("/getProofStateDescription")
-  def getProofStateDescription(stateName: String): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def getProofStateDescription(stateName: String, sessionId: String = ""): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
       return ujson.Obj("description" -> ParsedTheory.getProofStateDescription(state))
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
 
+  /** Get the proof goals of a state, like `execute()` returns them in "full" goals mode.
+    *
+    * @return
+    *   {"proofGoals": str, "proofDone": bool, "proofStateHash": str} or {"error": str, "traceback":
+    *   str}
+    */
+  @cask.postJson("/getProofGoals")
+  def getProofGoals(stateName: String, sessionId: String = ""): ujson.Obj = {
+    try {
+      val client = sessions.get(sessionId)
+      return proofStateJson(client, client.stateMap.get(stateName), "full", "")
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
   /** Parse an execute Isar code on a given state, save the resulting state under a new name.
     *
     * @param stateName
@@ -263,46 +371,183 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     *   Isar code to execute (can be multiple transitions, like lemma statements or proofs).
     * @param newStateName
     *   Name of new state to save the result under.
+    * @param goalsMode
+    *   How to send proof goals: "full" (default), "diff" (against the goals of the state executed
+    *   on) or "none" (see `ProofGoals`).
     * @return
     *   - On successful execuction, a JSON object with keys:
-    *     - proofGoals: like "proof (prove) goal (1 subgoal): ..." (empty if not in proof mode).
+    *     - proofGoals: like "proof (prove) goal (1 subgoal): ..." (empty if not in proof mode);
+    *       only in "full" goals mode.
+    *     - proofGoalsDiff: {"prefix": int, "suffix": int, "middle": str}, only in "diff" goals
+    *       mode (see `ProofGoals.diff`).
+    *     - proofStateHash: a hash of proofGoals, to compare states without their text.
     *     - proofDone: true if there are no more subgoals (proof level is 0, the resulting toplevel
     *       state is not in proof nor skipped-proof mode).
     *   - On error: {"error": str, "traceback": str}
     */
   @cask.postJson("/execute")
-  def execute(stateName: String, isarCode: String, newStateName: String, timeout: Int): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def execute(
+      stateName: String,
+      isarCode: String,
+      newStateName: String,
+      timeout: Int,
+      goalsMode: String = "full",
+      sessionId: String = ""
+  ): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
-      val newState: ToplevelState =
-        if (timeout == 0)
-          session.parseAndExecute(isarCode, state, debug = true)
-        else
-          session.parseAndExecute(isarCode, state, debug = true, perTransitionTimeout = timeout.seconds)
-      stateMap += (newStateName -> newState)
+      val client            = sessions.get(sessionId)
+      implicit val isabelle = client.process.session.isabelle
+      ProofGoals.checkMode(goalsMode)
+      val state: ToplevelState    = client.stateMap.get(stateName)
+      val newState: ToplevelState = parseAndExecute(client, isarCode, state, timeout)
+      client.stateMap.put(newStateName, newState)
+      return proofStateJson(client, newState, goalsMode, state.proofStateDescription)
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
 
-      return ujson.Obj(
-        "proofGoals" -> newState.proofStateDescription,
-        "proofDone"  -> (newState.proofLevel == 0)
-      )
+  /** Execute several alternative Isar snippets, each one independently on the same state.
+    *
+    * The snippets are executed concurrently, as separate calls to `execute()` would be, but in a
+    * single request. An error in one snippet doesn't affect the others.
+    *
+    * @param stateName
+    *   Name of state to execute on.
+    * @param isarCodes
+    *   Isar code snippets to execute.
+    * @param timeouts
+    *   Per-transition timeouts in seconds, one for each snippet (0 means the default). If shorter
+    *   than isarCodes (e.g. empty), the remaining snippets use the default.
+    * @param newStateNames
+    *   Names to save the resulting states under, one for each snippet ("" means don't save). If
+    *   shorter than isarCodes (e.g. empty), the remaining results are not saved.
+    * @param goalsMode
+    *   Same as in `execute()`.
+    * @return
+    *   - {"results": [result, ...]}, where each result is like the result of `execute()`:
+    *     {"proofGoals": str, "proofDone": bool, "proofStateHash": str} (depending on goalsMode)
+    *     or {"error": str, "traceback": str}.
+    *   - On error (like "State not found"): {"error": str, "traceback": str}
+    */
+  @cask.postJson("/executeMany")
+  def executeMany(
+      stateName: String,
+      isarCodes: List[String],
+      timeouts: List[Int] = List(),
+      newStateNames: List[String] = List(),
+      goalsMode: String = "full",
+      sessionId: String = ""
+  ): ujson.Obj = {
+    try {
+      val client            = sessions.get(sessionId)
+      implicit val isabelle = client.process.session.isabelle
+      implicit val ec       = client.process.session.ec
+      ProofGoals.checkMode(goalsMode)
+      val state: ToplevelState = client.stateMap.get(stateName)
+      lazy val parentGoals     = state.proofStateDescription
+      val futures = isarCodes.zipWithIndex.map { case (isarCode, i) =>
+        val timeout = timeouts.lift(i).getOrElse(0)
+        Future { blocking { Try(parseAndExecute(client, isarCode, state, timeout)) } }
+      }
+      val newStates = futures.map(Await.result(_, Duration.Inf))
+      val results = newStates.zipWithIndex.map {
+        case (Success(newState), i) => {
+          val newStateName = newStateNames.lift(i).getOrElse("")
+          if (newStateName.nonEmpty)
+            client.stateMap.put(newStateName, newState)
+          proofStateJson(client, newState, goalsMode, parentGoals)
+        }
+        case (Failure(e), _) => exceptionJson(e)
+      }
+      return ujson.Obj("results" -> ujson.Arr.from(results))
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
 
-  /** Erase a given state from the state map. */
+  /** Execute a chain of Isar code snippets, each one on the result of the previous one.
+    *
+    * This is like a sequence of calls to `execute()`, in a single request, stopping at the first
+    * snippet that fails. Intermediate states are only saved if asked for.
+    *
+    * @param stateName
+    *   Name of state to execute the first snippet on.
+    * @param isarCodes
+    *   Isar code snippets to execute, in order.
+    * @param timeouts
+    *   Same as in `executeMany()`.
+    * @param newStateNames
+    *   Same as in `executeMany()`.
+    * @param goalsMode
+    *   Same as in `execute()` (diffs are against the result of the previous snippet).
+    * @return
+    *   - {"results": [result, ...]}, where each result is like the result of `execute()`, for each
+    *     snippet until the first one that failed (included, its result is {"error": str,
+    *     "traceback": str}).
+    *   - On error (like "State not found"): {"error": str, "traceback": str}
+    */
+  @cask.postJson("/executeChain")
+  def executeChain(
+      stateName: String,
+      isarCodes: List[String],
+      timeouts: List[Int] = List(),
+      newStateNames: List[String] = List(),
+      goalsMode: String = "full",
+      sessionId: String = ""
+  ): ujson.Obj = {
+    try {
+      val client            = sessions.get(sessionId)
+      implicit val isabelle = client.process.session.isabelle
+      ProofGoals.checkMode(goalsMode)
+      var state: ToplevelState = client.stateMap.get(stateName)
+      val results              = ujson.Arr()
+      val codes                = isarCodes.iterator.zipWithIndex
+      var failed               = false
+      while (!failed && codes.hasNext) {
+        val (isarCode, i) = codes.next()
+        Try(parseAndExecute(client, isarCode, state, timeouts.lift(i).getOrElse(0))) match {
+          case Success(newState) => {
+            val newStateName = newStateNames.lift(i).getOrElse("")
+            if (newStateName.nonEmpty)
+              client.stateMap.put(newStateName, newState)
+            val parent           = state
+            lazy val parentGoals = parent.proofStateDescription // Only needed in "diff" mode.
+            results.value += proofStateJson(client, newState, goalsMode, parentGoals)
+            state = newState
+          }
+          case Failure(e) => {
+            results.value += exceptionJson(e)
+            failed = true
+          }
+        }
+      }
+      return ujson.Obj("results" -> results)
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Erase a given state from the state map (even if pinned). */
   @cask.postJson("/forgetState")
-  def forgetState(stateName: String): ujson.Obj = {
-    stateMap -= stateName
-    return ujson.Obj("success" -> "success")
+  def forgetState(stateName: String, sessionId: String = ""): ujson.Obj = {
+    try {
+      sessions.get(sessionId).stateMap.remove(stateName)
+      return ujson.Obj("success" -> "success")
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
   }
 
   /** Clear the state map. */
   @cask.postJson("/forgetAllStates")
-  def forgetAllStates(stateName: String): ujson.Obj = {
-    stateMap = Map()
-    return ujson.Obj("success" -> "success")
+  def forgetAllStates(sessionId: String = ""): ujson.Obj = {
+    try {
+      sessions.get(sessionId).stateMap.clear()
+      return ujson.Obj("success" -> "success")
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
   }
 
   /** Run Sledgehammer on a given state.
@@ -313,6 +558,9 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     *   List of fact names to suggest to Sledgehammer.
     * @param deletedFacts
     *   List of fact names to forbid to Sledgehammer.
+    * @param timeout
+    *   Soft timeout in seconds for this call (0 means the default of 30s); the mid and hard
+    *   timeouts are 5s and 10s longer, like the defaults.
     * @return
     *   - On success: {"proof": proof}; proof is e.g. "using .. by ..."; the proof is not guaranteed
     *     to be correct.
@@ -320,16 +568,222 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     *     timeout" or "Sledgehammer no proof found".
     */
   @cask.postJson("/hammer")
-  def hammer(stateName: String, addedFacts: List[String], deletedFacts: List[String]): ujson.Obj = {
-    implicit val isabelle = session.isabelle
+  def hammer(
+      stateName: String,
+      addedFacts: List[String],
+      deletedFacts: List[String],
+      timeout: Double = 0,
+      sessionId: String = ""
+  ): ujson.Obj = {
+    try {
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
+      val hammer               = sledgehammerWithTimeout(client, timeout)
+      return ujson.Obj("proof" -> hammer.findProofOrThrow(state, addedFacts, deletedFacts))
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Start running Sledgehammer on a given state in the background.
+    *
+    * At most QISABELLE_MAX_CONCURRENT_HAMMERS (environment variable, default 2) jobs run at once,
+    * others are queued. The state is looked up immediately, so it can be forgotten afterwards.
+    *
+    * @param stateName
+    *   Same as in `hammer()`.
+    * @param addedFacts
+    *   Same as in `hammer()`.
+    * @param deletedFacts
+    *   Same as in `hammer()`.
+    * @param timeout
+    *   Same as in `hammer()`.
+    * @return
+    *   {"jobId": str} or {"error": str, "traceback": str}
+    */
+  @cask.postJson("/hammerAsync")
+  def hammerAsync(
+      stateName: String,
+      addedFacts: List[String],
+      deletedFacts: List[String],
+      timeout: Double = 0,
+      sessionId: String = ""
+  ): ujson.Obj = {
+    try {
+      val client               = sessions.get(sessionId)
+      implicit val isabelle    = client.process.session.isabelle
+      val state: ToplevelState = client.stateMap.get(stateName)
+      val hammer               = sledgehammerWithTimeout(client, timeout)
+      val jobs                 = client.process.hammerJobs
+      val jobId = jobs.submit(() => hammer.findProofOrThrow(state, addedFacts, deletedFacts))
+      return ujson.Obj("jobId" -> jobId)
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Get the status of a hammer job.
+    *
+    * @param jobId
+    *   Id returned by `hammerAsync()`.
+    * @param waitSeconds
+    *   Wait at most this long for the job to finish before replying (0 means reply immediately).
+    * @return
+    *   {"status": str, "proof": str, "message": str, "elapsed": float} or {"error": str,
+    *   "traceback": str}. Status is one of "queued", "running", "success" (then proof is set, like
+    *   in `hammer()`), "failure" (then message is set, like the error in `hammer()`), "cancelled".
+    */
+  @cask.postJson("/hammerStatus")
+  def hammerStatus(jobId: String, waitSeconds: Double = 0, sessionId: String = ""): ujson.Obj = {
+    try {
+      return sessions.get(sessionId).process.hammerJobs.status(jobId, waitSeconds)
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Cancel a hammer job (if it's not finished yet).
+    *
+    * Queued jobs never start. Running provers may continue for a few seconds in the background.
+    *
+    * @return
+    *   Same as `hammerStatus()`.
+    */
+  @cask.postJson("/hammerCancel")
+  def hammerCancel(jobId: String, sessionId: String = ""): ujson.Obj = {
+    try {
+      return sessions.get(sessionId).process.hammerJobs.cancel(jobId)
+    } catch {
+      case e: Throwable => exceptionJson(e)
+    }
+  }
+
+  /** Report server statistics, and those of a session.
+    *
+    * @return
+    *   {"stateCount": int, "pinnedStateCount": int, "stateCapacity": int, "evictionCount": int,
+    *   "jvmHeapUsed": int, "jvmHeapMax": int, "ml": {str: str}, "checkpoints": {str: int},
+    *   "pendingHammerCount": int, "sessionCount": int, "sessionCapacity": int, "processCount":
+    *   int}; all sizes are in bytes. State counts are 0 and "ml", "checkpoints" are empty if
+    *   there's no Isabelle session open. "ml" contains the ML process statistics (like
+    *   "heap_size", "heap_used"). "checkpoints" contains "hits" and "misses" (loads of a theory
+    *   that did or didn't resume from a checkpoint), "transitionsExecuted", "transitionsSkipped",
+    *   "checkpointCount", "theoryCount". "pendingHammerCount" is the number of hammer jobs queued
+    *   or running. Except for the last three, these are about the given session (its Isabelle
+    *   process, for "ml", "checkpoints" and "pendingHammerCount"), if any.
+    */
+  @cask.postJson("/stats")
+  def stats(sessionId: String = ""): ujson.Obj = {
     try {
-      val state: ToplevelState = getState(stateName)
-      return ujson.Obj("proof" -> sledgehammer.findProofOrThrow(state, addedFacts, deletedFacts))
+      val runtime = Runtime.getRuntime()
+      val client =
+        if (sessionId.isEmpty) Try(sessions.get(sessionId)).toOption
+        else Some(sessions.get(sessionId))
+      val store = client.map(_.stateMap).orNull
+      val ml    = client.map(_.process.session.mlStatistics()).getOrElse(Map[String, String]())
+      val cps   = client.map(_.process.checkpoints).orNull
+      val jobs  = client.map(_.process.hammerJobs).orNull
+      return ujson.Obj(
+        "stateCount"         -> (if (store == null) 0 else store.size),
+        "pinnedStateCount"   -> (if (store == null) 0 else store.pinnedCount),
+        "stateCapacity"      -> maxStates,
+        "evictionCount"      -> (if (store == null) 0.0 else store.evictionCount.toDouble),
+        "jvmHeapUsed"        -> (runtime.totalMemory() - runtime.freeMemory()).toDouble,
+        "jvmHeapMax"         -> runtime.maxMemory().toDouble,
+        "ml"                 -> ujson.Obj.from(ml.map { case (k, v) => k -> ujson.Str(v) }),
+        "checkpoints"        -> (if (cps == null) ujson.Obj() else cps.stats()),
+        "pendingHammerCount" -> (if (jobs == null) 0 else jobs.pendingCount),
+        "sessionCount"       -> sessions.all.length,
+        "sessionCapacity"    -> maxSessions,
+        "processCount"       -> sessions.processCount
+      )
     } catch {
       case e: Throwable => exceptionJson(e)
     }
   }
 
+  /** Start an Isabelle process, see `openIsabelleSession()`. */
+  protected def startIsabelleProcess(
+      sessionName: String,
+      sessionRoots: Seq[String],
+      workingDir: String
+  ): IsabelleProcess = {
+    val session = new IsabelleSession(
+      isabelleDir = os.Path("/home/isabelle/Isabelle/"),
+      sessionName = sessionName,
+      sessionRoots = sessionRoots.map(os.Path(_)),
+      workingDir = os.Path(workingDir),
+      defaultPerTransitionTimeout = perTransitionTimeout,
+      defaultParseAndExecuteTimeout = parseAndExecuteTimeout,
+      debug = true
+    )
+    try {
+      implicit val isabelle = session.isabelle
+      val sledgehammer = new Sledgehammer(
+        softTimeout = softHammerTimeout,
+        midTimeout = midHammerTimeout,
+        hardTimeout = hardHammerTimeout,
+        debug = true
+      )
+      val checkpoints = new TheoryCheckpoints(
+        sessionName,
+        maxCheckpoints = maxCheckpoints,
+        checkpointEvery = checkpointEvery
+      )
+      new IsabelleProcess(
+        (sessionName, sessionRoots, workingDir),
+        session,
+        sledgehammer,
+        checkpoints,
+        new HammerJobs(maxConcurrentHammers)
+      )
+    } catch {
+      case e: Throwable => { session.close(); throw e }
+    }
+  }
+
+  /** Parse and execute Isar code with a per-transition timeout in seconds (0 means default). */
+  protected def parseAndExecute(
+      client: ClientSession,
+      isarCode: String,
+      state: ToplevelState,
+      timeout: Int
+  ): ToplevelState = {
+    val session           = client.process.session
+    implicit val isabelle = session.isabelle
+    if (timeout == 0)
+      session.parseAndExecute(isarCode, state, debug = true)
+    else
+      session.parseAndExecute(isarCode, state, debug = true, perTransitionTimeout = timeout.seconds)
+  }
+
+  /** The default Sledgehammer, or one with a given soft timeout in seconds (0 means default). */
+  protected def sledgehammerWithTimeout(client: ClientSession, timeout: Double): Sledgehammer = {
+    implicit val isabelle = client.process.session.isabelle
+    if (timeout <= 0)
+      client.process.sledgehammer
+    else {
+      val softTimeout = (timeout * 1000).toLong.millis
+      new Sledgehammer(
+        softTimeout = softTimeout,
+        midTimeout = softTimeout + (midHammerTimeout - softHammerTimeout),
+        hardTimeout = softTimeout + (hardHammerTimeout - softHammerTimeout),
+        debug = true
+      )
+    }
+  }
+
+  protected def proofStateJson(
+      client: ClientSession,
+      state: ToplevelState,
+      goalsMode: String,
+      parentGoals: => String
+  ): ujson.Obj = {
+    implicit val isabelle = client.process.session.isabelle
+    ProofGoals.json(state.proofStateDescription, state.proofLevel == 0, goalsMode, parentGoals)
+  }
+
   protected def exceptionJson(e: Throwable): ujson.Obj = {
     e match {
       case q: QIsabelleException => ujson.Obj("error" -> q.message, "traceback" -> "")
@@ -341,13 +795,6 @@ case class QIsabelleRoutes()(implicit cc: castor.Context, log: cask.Logger) exte
     }
   }
 
-  protected def getState(stateName: String): ToplevelState = {
-    stateMap.get(stateName) match {
-      case Some(state) => state
-      case None        => throw QIsabelleException(s"State not found: $stateName")
-    }
-  }
-
   initialize()
 }
 
@@ -362,6 +809,62 @@ object QISabelleServer extends cask.Main {
   }
 }
 
+/** Adds the time spent handling a request to its response, as a X-Server-Time-Ms header.
+  *
+  * Also counts requests being handled (see `activeCount`).
+  */
+class serverTime extends cask.RawDecorator {
+  protected val active = new java.util.concurrent.atomic.AtomicInteger()
+
+  /** Number of requests being handled. */
+  def activeCount: Int = active.get()
+
+  def wrapFunction(ctx: cask.Request, delegate: Delegate) = {
+    val start = System.nanoTime()
+    active.incrementAndGet()
+    try {
+      delegate(Map()).map { response =>
+        val ms        = (System.nanoTime() - start) / 1e6
+        val formatted = "%.3f".formatLocal(java.util.Locale.ROOT, ms)
+        response.copy(headers = response.headers :+ ("X-Server-Time-Ms" -> formatted))
+      }
+    } finally active.decrementAndGet()
+  }
+}
+
+/** Gzips response bodies of at least `minSize` bytes, if the request accepts gzip encoding. */
+class compress(minSize: Int = 1024) extends cask.RawDecorator {
+  def wrapFunction(ctx: cask.Request, delegate: Delegate) = {
+    val acceptsGzip = ctx.headers.get("accept-encoding").exists(_.exists(_.contains("gzip")))
+    delegate(Map()).map { response =>
+      if (!acceptsGzip)
+        response
+      else {
+        val body = new java.io.ByteArrayOutputStream()
+        response.data.write(body)
+        if (body.size < minSize)
+          response.copy(data = new BytesData(body.toByteArray, response.data.headers))
+        else {
+          val gzipped = new java.io.ByteArrayOutputStream()
+          val gzip    = new java.util.zip.GZIPOutputStream(gzipped)
+          body.writeTo(gzip)
+          gzip.close()
+          response.copy(
+            data = new BytesData(gzipped.toByteArray, response.data.headers),
+            headers = response.headers :+ ("Content-Encoding" -> "gzip")
+          )
+        }
+      }
+    }
+  }
+
+  /** An already serialized response body (keeping the headers, like Content-Type, of the data). */
+  class BytesData(bytes: Array[Byte], val headers: Seq[(String, String)])
+      extends cask.Response.Data {
+    def write(out: java.io.OutputStream): Unit = out.write(bytes)
+  }
+}
+
 final case class QIsabelleException(
     val message: String = "",
     private val cause: Throwable = None.orNull
@@ -0,0 +1,84 @@
+package server
+
+import scala.collection.mutable
+import scala.jdk.CollectionConverters._
+
+/** A map from names to states with bounded capacity, evicting least recently used states.
+  *
+  * Pinned states (like states of loaded lemmas, from which searches start) are never evicted, but
+  * they do count towards the capacity. Access is synchronized, so the store can be shared between
+  * request threads.
+  *
+  * @param capacity
+  *   Maximum number of states (exceeded only if all states are pinned).
+  */
+class StateStore[T](val capacity: Int) {
+  require(capacity > 0, "StateStore capacity must be positive")
+
+  /** States in access order (least recently used first). */
+  protected val states = new java.util.LinkedHashMap[String, T](16, 0.75f, true)
+  protected val pinned = mutable.Set[String]()
+
+  /** Names of recently evicted states (bounded), to give better error messages. */
+  protected val evicted = new java.util.LinkedHashMap[String, Unit]()
+
+  protected var _evictionCount: Long = 0
+
+  /** Get a state, marking it as recently used.
+    *
+    * @throws QIsabelleException
+    *   "State not found: name" or "State evicted: name".
+    */
+  def get(name: String): T = synchronized {
+    val state = states.get(name)
+    if (state != null)
+      state
+    else if (evicted.containsKey(name))
+      throw QIsabelleException(s"State evicted: $name (too many states, see QISABELLE_MAX_STATES)")
+    else
+      throw QIsabelleException(s"State not found: $name")
+  }
+
+  /** Store a state under a name (replacing any existing one), evicting others if needed. */
+  def put(name: String, state: T, pin: Boolean = false): Unit = synchronized {
+    states.put(name, state)
+    evicted.remove(name)
+    if (pin) pinned += name else pinned -= name
+    evictIfNeeded()
+  }
+
+  def remove(name: String): Unit = synchronized {
+    states.remove(name)
+    pinned -= name
+    evicted.remove(name)
+  }
+
+  def clear(): Unit = synchronized {
+    states.clear()
+    pinned.clear()
+    evicted.clear()
+  }
+
+  def size: Int                       = synchronized { states.size }
+  def pinnedCount: Int                = synchronized { pinned.size }
+  def evictionCount: Long             = synchronized { _evictionCount }
+  def contains(name: String): Boolean = synchronized { states.containsKey(name) }
+
+  protected def evictIfNeeded(): Unit = {
+    if (states.size <= capacity)
+      return
+    val it = states.entrySet.iterator.asScala
+    val toEvict = it.map(_.getKey).filterNot(pinned.contains).take(states.size - capacity).toList
+    for (name <- toEvict) {
+      states.remove(name)
+      evicted.put(name, ())
+      _evictionCount += 1
+    }
+    // Remember at most `capacity` evicted names.
+    val overflow = evicted.size - capacity
+    if (overflow > 0) {
+      val oldest = evicted.keySet.iterator.asScala.take(overflow).toList
+      oldest.foreach(name => evicted.remove(name))
+    }
+  }
+}
@@ -0,0 +1,130 @@
+package server
+
+import scala.concurrent.TimeoutException
+import scala.jdk.CollectionConverters._
+
+import de.unruh.isabelle.control.{Isabelle, IsabelleMLException}
+import de.unruh.isabelle.pure.ToplevelState
+
+/** Parsed theories and states along their execution, reused between loads of the same theory.
+  *
+  * Executing a theory until a lemma replays all transitions from the start of the file. Here we
+  * save a checkpoint (the state after the first k transitions) every `checkpointEvery` transitions
+  * and at each requested end, so that loading another lemma from the same theory resumes from the
+  * nearest earlier checkpoint. Least recently used checkpoints and parsed theories are evicted.
+  *
+  * @param sessionName
+  *   Name of the currently loaded session, see `ParsedTheory`.
+  * @param maxCheckpoints
+  *   Maximum number of checkpointed states kept, over all theories.
+  * @param maxTheories
+  *   Maximum number of parsed theories kept.
+  * @param checkpointEvery
+  *   Save a checkpoint every this many transitions.
+  */
+class TheoryCheckpoints(
+    val sessionName: String,
+    val maxCheckpoints: Int = 200,
+    val maxTheories: Int = 16,
+    val checkpointEvery: Int = 100,
+    val debug: Boolean = true
+)(implicit isabelle: Isabelle) {
+  protected val theories    = new java.util.LinkedHashMap[os.Path, ParsedTheory](16, 0.75f, true)
+  protected val checkpoints =
+    new java.util.LinkedHashMap[(os.Path, Int), ToplevelState](16, 0.75f, true)
+
+  /** Number of loads that resumed from a checkpoint, and that had to start from scratch. */
+  protected var hits: Long   = 0
+  protected var misses: Long = 0
+
+  /** Number of transitions executed and skipped thanks to checkpoints. */
+  protected var nExecuted: Long = 0
+  protected var nSkipped: Long  = 0
+
+  /** Get a parsed theory (parsing it if it's not cached). */
+  def parsedTheory(path: os.Path): ParsedTheory = {
+    val cached = synchronized { Option(theories.get(path)) }
+    cached.getOrElse {
+      val parsedTheory = new ParsedTheory(path, sessionName, debug = debug)
+      synchronized {
+        theories.put(path, parsedTheory)
+        if (theories.size > maxTheories) {
+          val oldest = theories.keySet.iterator.next()
+          theories.remove(oldest)
+          checkpoints.keySet.removeIf(_._1 == oldest)
+        }
+      }
+      parsedTheory
+    }
+  }
+
+  /** Execute the first `end` transitions of a theory, resuming from the nearest checkpoint.
+    *
+    * @param stopBeforeEnd
+    *   As in `ParsedTheory.execute`: stop before the "theory .. end" transition.
+    */
+  @throws(classOf[IsabelleMLException])
+  @throws(classOf[TimeoutException])
+  def executeUntil(path: os.Path, end: Int, stopBeforeEnd: Boolean = false): ToplevelState = {
+    val parsedTheory  = this.parsedTheory(path)
+    val (start, init)   = nearestCheckpoint(path, end)
+    synchronized {
+      if (start > 0) hits += 1 else misses += 1
+      nSkipped += start
+      nExecuted += end - start
+    }
+    if (debug) println(s"TheoryCheckpoints: executing transitions $start until $end of $path")
+
+    var state = init
+    var i     = start
+    while (i < end) {
+      val chunkEnd = ((i / checkpointEvery + 1) * checkpointEvery).min(end)
+      val isLast   = chunkEnd == end
+      state = parsedTheory.execute(
+        parsedTheory.transitions.slice(i, chunkEnd).toList,
+        state,
+        stopBeforeEnd = stopBeforeEnd && isLast
+      )
+      // With stopBeforeEnd, the last state may not be after all transitions, so don't save it.
+      if (!(stopBeforeEnd && isLast))
+        saveCheckpoint(path, chunkEnd, state)
+      i = chunkEnd
+    }
+    state
+  }
+
+  /** Statistics, for the `/stats` endpoint. */
+  def stats(): ujson.Obj = synchronized {
+    ujson.Obj(
+      "hits"                -> hits.toDouble,
+      "misses"              -> misses.toDouble,
+      "transitionsExecuted" -> nExecuted.toDouble,
+      "transitionsSkipped"  -> nSkipped.toDouble,
+      "checkpointCount"     -> checkpoints.size,
+      "theoryCount"         -> theories.size
+    )
+  }
+
+  def clear(): Unit = synchronized {
+    checkpoints.clear()
+    theories.clear()
+  }
+
+  /** The checkpoint with the largest index at most `end` (or the initial empty state). */
+  protected def nearestCheckpoint(path: os.Path, end: Int): (Int, ToplevelState) = synchronized {
+    val candidates = checkpoints.keySet.asScala.filter { case (p, k) => p == path && k <= end }
+    if (candidates.isEmpty)
+      (0, ToplevelState())
+    else {
+      val key = candidates.maxBy(_._2)
+      (key._2, checkpoints.get(key)) // Also marks it as recently used.
+    }
+  }
+
+  protected def saveCheckpoint(path: os.Path, index: Int, state: ToplevelState): Unit =
+    synchronized {
+      checkpoints.put((path, index), state)
+      if (checkpoints.size > maxCheckpoints)
+        checkpoints.remove(checkpoints.keySet.iterator.next())
+    }
+}
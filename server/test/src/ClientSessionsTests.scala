@@ -0,0 +1,57 @@
+package server
+
+import org.scalatest.funsuite.AnyFunSuite
+
+import de.unruh.isabelle.pure.ToplevelState
+
+class ClientSessionsTests extends AnyFunSuite {
+
+  /** A process that only records being closed. */
+  class FakeProcess(key: IsabelleProcess.Key) extends IsabelleProcess(key, null, null, null, null) {
+    var closed = false
+    override def close(): Unit = { closed = true }
+  }
+
+  def open(sessions: ClientSessions, name: String, shared: Boolean = false): ClientSession =
+    sessions.open(
+      (name, Seq(), "/"),
+      shared,
+      () => new FakeProcess((name, Seq(), "/")),
+      () => new StateStore[ToplevelState](10)
+    )
+
+  test("closes least recently used sessions beyond capacity") {
+    val sessions = new ClientSessions(capacity = 2)
+    val a        = open(sessions, "HOL")
+    val b        = open(sessions, "HOL")
+    assert(a.id != b.id && a.process != b.process)
+    assert(sessions.get("") == b)
+    assert(sessions.get(a.id) == a) // Now b is least recently used.
+    val c = open(sessions, "HOL")
+    assert(sessions.all == Seq(a, c))
+    assert(b.process.asInstanceOf[FakeProcess].closed)
+    val thrown = intercept[QIsabelleException] { sessions.get(b.id) }
+    assert(thrown.message.startsWith(s"Session closed: ${b.id}"))
+    val notFound = intercept[QIsabelleException] { sessions.get("nope") }
+    assert(notFound.message == "Session not found: nope")
+  }
+
+  test("shares processes until their last session is closed") {
+    val sessions = new ClientSessions(capacity = 3)
+    val a        = open(sessions, "HOL", shared = true)
+    val b        = open(sessions, "HOL", shared = true)
+    val c        = open(sessions, "Foo", shared = true)
+    assert(a.process == b.process && a.stateMap != b.stateMap && c.process != a.process)
+    assert(sessions.processCount == 2)
+
+    assert(sessions.close(a.id))
+    assert(!a.process.asInstanceOf[FakeProcess].closed)
+    assert(sessions.close(b.id))
+    assert(a.process.asInstanceOf[FakeProcess].closed)
+    assert(!sessions.close(b.id))
+    assert(sessions.get("") == c)
+    assert(sessions.close(""))
+    intercept[QIsabelleException] { sessions.get("") }
+    assert(sessions.processCount == 0)
+  }
+}
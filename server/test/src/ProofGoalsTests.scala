@@ -0,0 +1,37 @@
+package server
+
+import org.scalatest.funsuite.AnyFunSuite
+
+class ProofGoalsTests extends AnyFunSuite {
+  def applyDiff(parent: String, diff: ujson.Obj): String = {
+    val cps    = parent.codePoints.toArray
+    val prefix = diff("prefix").num.toInt
+    val suffix = diff("suffix").num.toInt
+    new String(cps, 0, prefix) + diff("middle").str + new String(cps, cps.length - suffix, suffix)
+  }
+
+  test("diffs reconstruct goals") {
+    val cases = Seq(
+      ("goal (1 subgoal):\n 1. x = x", "goal (1 subgoal):\n 1. y = x"),
+      ("goal (2 subgoals):\n 1. A\n 2. B", "goal (1 subgoal):\n 1. B"),
+      ("", "goal (1 subgoal):\n 1. A"),
+      ("goal (1 subgoal):\n 1. A", ""),
+      ("aaa", "aaaa"),
+      ("x 𝒜 y", "x 𝒝 y") // Characters outside the BMP differ.
+    )
+    for ((parent, goals) <- cases)
+      assert(applyDiff(parent, ProofGoals.diff(parent, goals)) == goals)
+    val unchanged = ProofGoals.diff("abc", "abc")
+    assert(unchanged("middle").str == "" && unchanged("prefix").num == 3)
+  }
+
+  test("modes") {
+    val full = ProofGoals.json("g", false, "full", throw new AssertionError("unused"))
+    assert(full("proofGoals").str == "g" && full("proofStateHash").str == ProofGoals.hash("g"))
+    val none = ProofGoals.json("g", true, "none", "")
+    assert(!none.value.contains("proofGoals") && none("proofDone").bool)
+    assert(ProofGoals.json("g", false, "diff", "f")("proofGoalsDiff")("middle").str == "g")
+    assert(ProofGoals.hash("g").length == 16 && ProofGoals.hash("g") != ProofGoals.hash("h"))
+    intercept[QIsabelleException] { ProofGoals.json("g", false, "zip", "") }
+  }
+}
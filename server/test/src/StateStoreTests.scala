@@ -0,0 +1,33 @@
+package server
+
+import org.scalatest.funsuite.AnyFunSuite
+
+class StateStoreTests extends AnyFunSuite {
+  test("evicts least recently used") {
+    val store = new StateStore[Int](capacity = 2)
+    store.put("a", 1)
+    store.put("b", 2)
+    assert(store.get("a") == 1) // Now "b" is least recently used.
+    store.put("c", 3)
+    assert(store.size == 2 && store.evictionCount == 1)
+    assert(store.contains("a") && store.contains("c"))
+    val thrown = intercept[QIsabelleException] { store.get("b") }
+    assert(thrown.message.startsWith("State evicted: b"))
+    val notFound = intercept[QIsabelleException] { store.get("d") }
+    assert(notFound.message == "State not found: d")
+  }
+
+  test("never evicts pinned states") {
+    val store = new StateStore[Int](capacity = 2)
+    store.put("root", 0, pin = true)
+    for (i <- 1 to 5)
+      store.put(s"s$i", i)
+    assert(store.get("root") == 0)
+    assert(store.contains("s5") && !store.contains("s4"))
+    assert(store.evictionCount == 4)
+
+    store.remove("root")
+    assert(store.pinnedCount == 0)
+    intercept[QIsabelleException] { store.get("root") }
+  }
+}